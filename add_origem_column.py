@@ -1,71 +1,28 @@
 #!/usr/bin/env python3
 """
 Script para adicionar coluna 'origem' na tabela notas_fiscais
+A alteração agora é a migração 0001_origem (ver migrations.py)
 """
 
 import os
-from sqlalchemy import create_engine, text
-from dotenv import load_dotenv
 import logging
+from migrations import aplicar_migracoes
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 def add_origem_column():
-    """Adiciona coluna origem na tabela notas_fiscais"""
+    """Adiciona coluna origem na tabela notas_fiscais (via migrações versionadas)"""
     
-    # Carregar configurações
-    load_dotenv()
-    database_url = os.getenv('DATABASE_URL')
-    
-    if not database_url:
+    # Verificar configuração
+    if not os.getenv('DATABASE_URL'):
         logger.error("DATABASE_URL não encontrada no arquivo .env")
         return False
     
     try:
-        # Conectar ao banco
-        engine = create_engine(database_url)
-        
-        with engine.connect() as conn:
-            # Verificar se a coluna já existe
-            logger.info("Verificando se a coluna 'origem' já existe...")
-            
-            result = conn.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'notas_fiscais' 
-                AND column_name = 'origem'
-            """))
-            
-            if result.fetchone():
-                logger.info("✅ Coluna 'origem' já existe na tabela notas_fiscais")
-                return True
-            
-            # Adicionar a coluna
-            logger.info("Adicionando coluna 'origem' na tabela notas_fiscais...")
-            
-            conn.execute(text("""
-                ALTER TABLE notas_fiscais 
-                ADD COLUMN origem VARCHAR(20) DEFAULT 'upload'
-            """))
-            
-            # Confirmar a transação
-            conn.commit()
-            
-            logger.info("✅ Coluna 'origem' adicionada com sucesso!")
-            
-            # Verificar quantos registros existem
-            result = conn.execute(text("SELECT COUNT(*) FROM notas_fiscais"))
-            count = result.fetchone()[0]
-            
-            logger.info(f"📊 Total de registros na tabela: {count}")
-            
-            if count > 0:
-                logger.info("ℹ️  Registros existentes foram marcados como 'upload' por padrão")
-                logger.info("ℹ️  Novos registros do email serão marcados como 'email'")
-            
-            return True
+        aplicar_migracoes()
+        return True
             
     except Exception as e:
         logger.error(f"❌ Erro ao adicionar coluna: {e}")
@@ -77,8 +34,8 @@ if __name__ == "__main__":
     
     if success:
         print("\n✅ Operação concluída com sucesso!")
-        print("A coluna 'origem' foi adicionada à tabela notas_fiscais")
+        print("A coluna 'origem' está presente na tabela notas_fiscais")
         print("- Registros existentes: marcados como 'upload'")
-        print("- Novos registros do email: serão marcados como 'email'")
+        print("- Registros com XML original (email): marcados como 'email'")
     else:
-        print("\n❌ Falha na operação!")
\ No newline at end of file
+        print("\n❌ Falha na operação!")
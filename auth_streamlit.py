@@ -5,16 +5,29 @@ Gerencia login, logout, sessões e proteção de páginas
 
 import streamlit as st
 import time
-from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Optional, Dict, Any
 from user_manager import UserManager
 
+# Tempo máximo de inatividade da sessão
+SESSION_TIMEOUT_SECONDS = 30 * 60
+
+@st.cache_data
+def _login_css() -> str:
+    """Lê o CSS da página de login (uma vez por processo)"""
+    return (Path(__file__).parent / "assets" / "login.css").read_text(encoding="utf-8")
+
+@st.cache_resource
+def _user_manager() -> UserManager:
+    """Retorna o UserManager compartilhado (engine e tabela criadas uma única vez)"""
+    return UserManager()
+
 class StreamlitAuth:
     """Classe para gerenciar autenticação no Streamlit"""
     
     def __init__(self):
-        self.user_manager = UserManager()
-        self.session_timeout = 30  # 30 minutos
+        self.user_manager = _user_manager()
+        self.session_timeout = SESSION_TIMEOUT_SECONDS // 60  # 30 minutos
         self._initialize_session_state()
     
     def _initialize_session_state(self):
@@ -25,24 +38,20 @@ class StreamlitAuth:
         if 'user_data' not in st.session_state:
             st.session_state.user_data = {}
         if 'last_activity' not in st.session_state:
-            st.session_state.last_activity = datetime.now()
+            st.session_state.last_activity = time.monotonic()
     
     def check_session_timeout(self) -> bool:
         """Verifica se a sessão expirou"""
         if st.session_state.authenticated:
-            last_activity = st.session_state.get('last_activity', datetime.now())
-            if isinstance(last_activity, str):
-                last_activity = datetime.fromisoformat(last_activity)
-            
-            time_diff = datetime.now() - last_activity
-            if time_diff > timedelta(minutes=self.session_timeout):
+            # Relógio monotônico: imune a ajustes do relógio do sistema
+            if time.monotonic() - st.session_state.get('last_activity', time.monotonic()) > SESSION_TIMEOUT_SECONDS:
                 self.logout()
                 return True
         return False
     
     def update_activity(self):
         """Atualiza timestamp da última atividade"""
-        st.session_state.last_activity = datetime.now()
+        st.session_state.last_activity = time.monotonic()
     
     def login(self, username: str, password: str) -> tuple[bool, str]:
         """Realiza login do usuário"""
@@ -51,7 +60,7 @@ class StreamlitAuth:
         if success:
             st.session_state.authenticated = True
             st.session_state.user_data = user_data
-            st.session_state.last_activity = datetime.now()
+            st.session_state.last_activity = time.monotonic()
             return True, message
         else:
             return False, message
@@ -60,7 +69,7 @@ class StreamlitAuth:
         """Realiza logout do usuário"""
         st.session_state.authenticated = False
         st.session_state.user_data = {}
-        st.session_state.last_activity = datetime.now()
+        st.session_state.last_activity = time.monotonic()
     
     def is_authenticated(self) -> bool:
         """Verifica se o usuário está autenticado"""
@@ -98,42 +107,7 @@ class StreamlitAuth:
         """Exibe página de login"""
         
         # CSS personalizado para a página de login
-        st.markdown("""
-        <style>
-        .login-container {
-            max-width: 400px;
-            margin: 0 auto;
-            padding: 2rem;
-            background: white;
-            border-radius: 10px;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-        }
-        .login-header {
-            text-align: center;
-            margin-bottom: 2rem;
-        }
-        .login-header h1 {
-            color: #1f77b4;
-            margin-bottom: 0.5rem;
-        }
-        .login-header p {
-            color: #666;
-            margin: 0;
-        }
-        .stButton > button {
-            width: 100%;
-            background-color: #1f77b4;
-            color: white;
-            border: none;
-            padding: 0.5rem 1rem;
-            border-radius: 5px;
-            font-weight: bold;
-        }
-        .stButton > button:hover {
-            background-color: #1565c0;
-        }
-        </style>
-        """, unsafe_allow_html=True)
+        st.markdown(f"<style>{_login_css()}</style>", unsafe_allow_html=True)
         
         # Container principal
         col1, col2, col3 = st.columns([1, 2, 1])
@@ -281,13 +255,9 @@ class StreamlitAuth:
                     st.rerun()
                 
                 # Mostrar tempo de sessão restante
-                last_activity = st.session_state.get('last_activity', datetime.now())
-                if isinstance(last_activity, str):
-                    last_activity = datetime.fromisoformat(last_activity)
-                
-                time_remaining = timedelta(minutes=self.session_timeout) - (datetime.now() - last_activity)
-                if time_remaining.total_seconds() > 0:
-                    minutes_remaining = int(time_remaining.total_seconds() / 60)
+                time_remaining = SESSION_TIMEOUT_SECONDS - (time.monotonic() - st.session_state.last_activity)
+                if time_remaining > 0:
+                    minutes_remaining = int(time_remaining / 60)
                     st.caption(f"⏱️ Sessão expira em: {minutes_remaining} min")
                 
                 st.markdown("---")
@@ -298,5 +268,11 @@ class StreamlitAuth:
         if "criado" in message:
             st.info(f"ℹ️ {message}")
 
+@st.cache_resource
+def get_auth() -> StreamlitAuth:
+    """Retorna a instância compartilhada do sistema de autenticação"""
+    # O estado de cada usuário fica em st.session_state, então a instância pode ser reutilizada
+    return StreamlitAuth()
+
 # Instância global do sistema de autenticação
-auth = StreamlitAuth()
\ No newline at end of file
+auth = get_auth()
\ No newline at end of file
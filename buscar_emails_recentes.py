@@ -1,10 +1,11 @@
 import imaplib
-import email
-from email.header import decode_header
+from email.parser import BytesHeaderParser
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import logging
+import re
+from imap_utils import obter_conexao, montar_criterio_assunto, fetch_em_lotes, listar_anexos, decodificar_assunto
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,6 +14,27 @@ logger = logging.getLogger(__name__)
 # Lista de palavras-chave para filtrar no assunto (em minúsculo)
 PALAVRAS_CHAVE = ["danfe", "nf-e", "nfc-e", "nf", "nfe", "xml", "nota fiscal"]
 
+# Varredura única do assunto: o lookahead encontra, em cada posição, a palavra-chave mais longa;
+# as palavras-chave que são prefixo dela (ex.: "nf" em "nfe") são incluídas pelo mapa abaixo
+PADRAO_PALAVRAS_CHAVE = re.compile(
+    "(?=(" + "|".join(map(re.escape, sorted(PALAVRAS_CHAVE, key=len, reverse=True))) + "))"
+)
+PREFIXOS_PALAVRAS_CHAVE = {
+    palavra: {outra for outra in PALAVRAS_CHAVE if palavra.startswith(outra)}
+    for palavra in PALAVRAS_CHAVE
+}
+
+# Parser só de cabeçalhos: para na fronteira cabeçalho/corpo
+_HEADER_PARSER = BytesHeaderParser()
+
+# Apenas cabeçalhos, flags e estrutura: os corpos/anexos não são baixados
+FETCH_RESUMO = '(FLAGS BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT DATE)])'
+
+# FETCH em lotes de UIDs; conexões paralelas extras só com mais de LOTES_POR_CONEXAO_FETCH lotes
+TAMANHO_LOTE_FETCH = 50
+CONEXOES_FETCH = 4
+LOTES_POR_CONEXAO_FETCH = 4
+
 def buscar_emails_recentes():
     """Busca emails dos últimos 7 dias que contenham palavras-chave"""
     
@@ -30,11 +52,16 @@ def buscar_emails_recentes():
     print(f"Palavras-chave: {', '.join(PALAVRAS_CHAVE)}")
     print()
     
+    # Conexões extras e descartáveis para o FETCH em paralelo (só abertas com muitos lotes)
+    def conectar():
+        conexao = imaplib.IMAP4_SSL(imap_server, imap_port)
+        conexao.login(email_user, email_password)
+        conexao.select('inbox', readonly=True)
+        return conexao
+    
     try:
-        # Conectar ao servidor
-        mail = imaplib.IMAP4_SSL(imap_server, imap_port)
-        mail.login(email_user, email_password)
-        mail.select('inbox')
+        # Conectar ao servidor (conexão reutilizada se a função for chamada de novo no mesmo processo)
+        mail = obter_conexao(imap_server, imap_port, email_user, email_password)
         
         # Calcular data de 7 dias atrás
         data_limite = datetime.now() - timedelta(days=7)
@@ -42,88 +69,79 @@ def buscar_emails_recentes():
         
         print(f"🔍 Buscando emails desde: {data_limite_str}")
         
-        # Buscar emails dos últimos 7 dias
-        status, messages = mail.search(None, f'SINCE {data_limite_str}')
+        # Buscar emails dos últimos 7 dias (apenas UIDs, sem conteúdo)
+        status, messages = mail.uid('SEARCH', None, f'SINCE {data_limite_str}')
         
         if status != 'OK' or not messages[0]:
             print("❌ Nenhum email encontrado nos últimos 7 dias")
-            mail.logout()
             return
         
         email_ids = messages[0].split()
         print(f"📧 Encontrados {len(email_ids)} emails nos últimos 7 dias")
         print()
         
+        status, messages = mail.uid('SEARCH', None, f'SINCE {data_limite_str} UNSEEN')
+        emails_nao_lidos = messages[0].split() if status == 'OK' and messages[0] else []
+        
+        # Filtro de palavras-chave executado no servidor
+        criterio = f'SINCE {data_limite_str} {montar_criterio_assunto(PALAVRAS_CHAVE)}'
+        status, messages = mail.uid('SEARCH', None, criterio)
+        uids_candidatos = messages[0].split() if status == 'OK' and messages[0] else []
+        
+        # FETCH em lotes pela conexão persistente; com muitos lotes, divididos também entre conexões extras
+        mensagens = fetch_em_lotes(
+            conectar, uids_candidatos, FETCH_RESUMO,
+            tamanho_lote=TAMANHO_LOTE_FETCH, max_conexoes=CONEXOES_FETCH,
+            principal=mail, lotes_por_conexao=LOTES_POR_CONEXAO_FETCH
+        )
+        
         emails_com_palavras_chave = []
-        emails_nao_lidos = []
         
-        for email_id in email_ids:
+        for email_id in uids_candidatos:
             try:
-                # Buscar informações do email
-                status, msg_data = mail.fetch(email_id, '(RFC822 FLAGS)')
-                if status != 'OK': 
+                dados = mensagens.get(email_id)
+                if not dados:
                     continue
                 
                 # Verificar se é não lido
-                flags_data = msg_data[0][0].decode()
-                is_unread = '\\Seen' not in flags_data
-                
-                if is_unread:
-                    emails_nao_lidos.append(email_id)
+                is_unread = b'\\Seen' not in (dados.get('FLAGS') or [])
                 
-                # Processar mensagem
-                msg = email.message_from_bytes(msg_data[0][1])
+                # Processar cabeçalhos
+                msg = _HEADER_PARSER.parsebytes(dados.get('BODY[HEADER.FIELDS (SUBJECT DATE)]') or b'', headersonly=True)
                 
                 # Decodificar assunto
-                subject_parts = decode_header(msg["Subject"])
-                subject_decoded = []
+                subject = decodificar_assunto(msg["Subject"])
+                subject_lower = subject.lower() if subject else ""
                 
-                for part, enc in subject_parts:
-                    if isinstance(part, bytes):
-                        if not enc or enc.lower() == "unknown-8bit":
-                            enc = "utf-8"
-                        try:
-                            subject_decoded.append(part.decode(enc, errors="ignore"))
-                        except LookupError:
-                            subject_decoded.append(part.decode("utf-8", errors="ignore"))
-                    else:
-                        subject_decoded.append(part)
+                # Palavras-chave presentes no assunto (o servidor já filtrou; lista só para exibição)
+                encontradas = {
+                    palavra
+                    for achada in PADRAO_PALAVRAS_CHAVE.findall(subject_lower)
+                    for palavra in PREFIXOS_PALAVRAS_CHAVE[achada]
+                }
+                palavras_encontradas = [palavra for palavra in PALAVRAS_CHAVE if palavra in encontradas]
                 
-                subject = " ".join(subject_decoded).strip()
-                subject_lower = subject.lower() if subject else ""
+                # Obter data do email
+                date_str = msg.get('Date', 'Data não disponível')
+                
+                # Verificar anexos pelo BODYSTRUCTURE (sem baixar o conteúdo)
+                anexos = listar_anexos(dados.get('BODYSTRUCTURE'))
+                tem_anexos = bool(anexos)
+                anexos_xml_pdf = [
+                    anexo['filename'] for anexo in anexos
+                    if anexo['filename'].lower().endswith(('.xml', '.pdf'))
+                ]
                 
-                # Verificar palavras-chave
-                palavras_encontradas = [palavra for palavra in PALAVRAS_CHAVE if palavra in subject_lower]
+                emails_com_palavras_chave.append({
+                    'id': email_id.decode(),
+                    'subject': subject,
+                    'date': date_str,
+                    'palavras_encontradas': palavras_encontradas,
+                    'is_unread': is_unread,
+                    'tem_anexos': tem_anexos,
+                    'anexos_xml_pdf': anexos_xml_pdf
+                })
                 
-                if palavras_encontradas:
-                    # Obter data do email
-                    date_str = msg.get('Date', 'Data não disponível')
-                    
-                    # Verificar anexos
-                    tem_anexos = False
-                    anexos_xml_pdf = []
-                    
-                    for part in msg.walk():
-                        if part.get_content_maintype() == 'multipart' or part.get('Content-Disposition') is None:
-                            continue
-                        
-                        filename = part.get_filename()
-                        if filename:
-                            tem_anexos = True
-                            filename_lower = filename.lower()
-                            if filename_lower.endswith('.xml') or filename_lower.endswith('.pdf'):
-                                anexos_xml_pdf.append(filename)
-                    
-                    emails_com_palavras_chave.append({
-                        'id': email_id.decode(),
-                        'subject': subject,
-                        'date': date_str,
-                        'palavras_encontradas': palavras_encontradas,
-                        'is_unread': is_unread,
-                        'tem_anexos': tem_anexos,
-                        'anexos_xml_pdf': anexos_xml_pdf
-                    })
-                    
             except Exception as e:
                 logger.error(f"Erro ao processar email {email_id}: {e}")
                 continue
@@ -154,8 +172,6 @@ def buscar_emails_recentes():
         else:
             print("❌ Nenhum email com palavras-chave encontrado nos últimos 7 dias")
         
-        mail.logout()
-        
     except Exception as e:
         print(f"❌ ERRO: {e}")
 
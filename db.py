@@ -0,0 +1,142 @@
+"""
+Módulo de acesso ao banco de dados compartilhado pelos scripts de manutenção
+Mantém uma única engine SQLAlchemy com pool de conexões configurado
+"""
+
+import os
+import functools
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from psycopg2.extras import execute_values
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+# Carregar variáveis de ambiente uma única vez
+load_dotenv()
+
+@functools.lru_cache(maxsize=1)
+def get_engine():
+    """Retorna a engine do banco (criada uma vez e reutilizada)"""
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        raise ValueError("A URL do banco de dados (DATABASE_URL) não foi configurada.")
+
+    return create_engine(
+        database_url,
+        pool_size=5,           # Conexões mantidas abertas no pool
+        max_overflow=10,       # Conexões extras em picos
+        pool_timeout=30,       # Espera máxima por uma conexão livre
+        pool_recycle=1800,     # Recicla conexões a cada 30 minutos
+        pool_pre_ping=True,    # Verifica conexões antes de usar
+        pool_use_lifo=True     # Reutiliza a conexão mais recente (mais "quente")
+    )
+
+def listar_colunas(conn, tabela: str) -> List[Tuple[str, str, bool]]:
+    """
+    Lista as colunas de uma tabela direto do catálogo pg_attribute
+
+    Mais barato que information_schema.columns, que junta várias tabelas do catálogo.
+
+    Returns:
+        Lista de (nome, tipo, nullable) na ordem da tabela; vazia se a tabela não existir
+    """
+    return [tuple(row) for row in conn.execute(text("""
+        SELECT attname, format_type(atttypid, atttypmod), NOT attnotnull
+        FROM pg_attribute
+        WHERE attrelid = to_regclass(:tabela) AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """), {"tabela": tabela})]
+
+def fingerprint_esquema(colunas: Dict[str, str]) -> str:
+    """Calcula a impressão digital (md5) de uma especificação de colunas {nome: tipo}"""
+    especificacao = ",".join(f"{nome}:{tipo}" for nome, tipo in sorted(colunas.items()))
+    return hashlib.md5(especificacao.encode("utf-8")).hexdigest()
+
+def esquema_em_dia(conn, tabela: str, fingerprint: str) -> bool:
+    """Indica se a especificação de colunas já foi aplicada à tabela (registro em _schema_state)"""
+    if conn.execute(text("SELECT to_regclass('_schema_state')")).scalar() is None:
+        return False
+    registrado = conn.execute(
+        text("SELECT fingerprint FROM _schema_state WHERE tabela = :tabela"), {"tabela": tabela}
+    ).scalar()
+    return registrado == fingerprint
+
+def registrar_esquema(conn, tabela: str, fingerprint: str) -> None:
+    """Registra em _schema_state a especificação aplicada com sucesso à tabela"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS _schema_state (
+            tabela TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    conn.execute(text("""
+        INSERT INTO _schema_state (tabela, fingerprint) VALUES (:tabela, :fingerprint)
+        ON CONFLICT (tabela) DO UPDATE
+        SET fingerprint = EXCLUDED.fingerprint, atualizado_em = CURRENT_TIMESTAMP
+    """), {"tabela": tabela, "fingerprint": fingerprint})
+
+# Conversão tolerante de texto para JSONB: valores vazios ou com JSON inválido viram NULL,
+# em vez de abortar o ALTER TABLE inteiro por causa de uma única linha antiga
+SQL_FUNCAO_JSONB_OU_NULO = """
+    CREATE OR REPLACE FUNCTION jsonb_ou_nulo(valor TEXT) RETURNS JSONB AS $$
+    BEGIN
+        RETURN NULLIF(valor, '')::jsonb;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+def tipo_texto(tipo: str) -> bool:
+    """Indica se um tipo de format_type (listar_colunas) é textual: text, varchar ou char"""
+    return tipo.lower().startswith(('text', 'character'))
+
+def commit_assincrono(conn) -> None:
+    """
+    Faz o COMMIT da transação atual não esperar o fsync do WAL (SET LOCAL synchronous_commit = off)
+
+    Uso exclusivo dos scripts de manutenção idempotentes: uma queda do servidor logo após
+    o commit pode perder a última transação, que é refeita ao rodar o script de novo.
+    Nunca usar em gravações de dados de usuários.
+    """
+    conn.execute(text("SET LOCAL synchronous_commit = off"))
+
+def backfill(tabela: str, coluna: str, linhas: Iterable[Tuple[Any, Any]],
+             tipo: Optional[str] = None, page_size: int = 1000) -> int:
+    """
+    Atualiza uma coluna linha a linha em lotes (UPDATE ... FROM (VALUES ...))
+
+    Cada página de até page_size pares (id, valor) vira um único comando,
+    em vez de um UPDATE por registro. Tabela e coluna vêm do código, nunca do usuário.
+
+    Args:
+        tabela: Nome da tabela (com coluna id)
+        coluna: Coluna a preencher
+        linhas: Pares (id, valor)
+        tipo: Tipo SQL para converter o valor (ex.: 'jsonb'); None usa o tipo inferido
+
+    Returns:
+        Quantidade de registros atualizados
+    """
+    linhas = list(linhas)
+    if not linhas:
+        return 0
+
+    valor = f"v.valor::{tipo}" if tipo else "v.valor"
+    sql = (
+        f"UPDATE {tabela} AS t SET {coluna} = {valor} "
+        f"FROM (VALUES %s) AS v(id, valor) WHERE t.id = v.id RETURNING t.id"
+    )
+
+    conexao = get_engine().raw_connection()
+    try:
+        with conexao.cursor() as cursor:
+            atualizados = execute_values(cursor, sql, linhas, page_size=page_size, fetch=True)
+        conexao.commit()
+        return len(atualizados)
+    except Exception:
+        conexao.rollback()
+        raise
+    finally:
+        conexao.close()
@@ -3,63 +3,83 @@
 Script para verificar e adicionar todas as colunas faltantes na tabela notas_fiscais
 """
 
-import psycopg2
+import sys
+from sqlalchemy import text
 from secure_config import get_secure_config
+from db import (
+    get_engine, listar_colunas, commit_assincrono, fingerprint_esquema, esquema_em_dia, registrar_esquema,
+    SQL_FUNCAO_JSONB_OU_NULO, tipo_texto
+)
+
+# Lista de todas as colunas esperadas baseadas no código
+COLUNAS_ESPERADAS = {
+    'id': 'SERIAL PRIMARY KEY',
+    'numero': 'VARCHAR(50) NOT NULL',
+    'serie': 'VARCHAR(10)',
+    'data_emissao': 'DATE',
+    'cnpj_emitente': 'VARCHAR(18)',
+    'nome_emitente': 'VARCHAR(255)',
+    'valor_total': 'DECIMAL(15,2)',
+    'chave_acesso': 'VARCHAR(44)',
+    'natureza_operacao': 'VARCHAR(255)',
+    'situacao': 'VARCHAR(50)',
+    'data_vencimento': 'DATE',
+    'cnpj_destinatario': 'VARCHAR(18)',
+    'nome_destinatario': 'VARCHAR(255)',
+    'valor_icms': 'DECIMAL(15,2)',
+    'valor_ipi': 'DECIMAL(15,2)',
+    'valor_pis': 'DECIMAL(15,2)',
+    'valor_cofins': 'DECIMAL(15,2)',
+    'xml_original': 'BYTEA',   # XML bruto, sem validação UTF-8
+    'processado_em': 'TIMESTAMP',
+    'itens': 'JSONB',          # Itens em JSON binário (operadores ->, @> e índice GIN)
+    'xml_content': 'BYTEA'
+}
+
+# Conversões das colunas criadas como TEXT em versões anteriores
+CONVERSOES = {
+    'xml_original': "BYTEA USING convert_to(xml_original, 'UTF8')",
+    'itens': "JSONB USING jsonb_ou_nulo(itens)",  # JSON inválido vira NULL (SQL_FUNCAO_JSONB_OU_NULO)
+    'xml_content': "BYTEA USING convert_to(xml_content, 'UTF8')"
+}
+
+# Impressão digital da especificação acima (muda sempre que COLUNAS_ESPERADAS mudar)
+FINGERPRINT_ESPERADO = fingerprint_esquema(COLUNAS_ESPERADAS)
 
 def main():
     try:
-        # Obter configuração
-        config = get_secure_config()
+        # Validar configuração
+        get_secure_config()
         
-        # Conectar ao banco
-        conn = psycopg2.connect(config.DATABASE_URL)
-        cursor = conn.cursor()
+        # Obter engine compartilhada
+        engine = get_engine()
         
         print("✅ Conectado ao banco de dados PostgreSQL")
         
-        # Verificar estrutura atual da tabela
-        cursor.execute("""
-            SELECT column_name, data_type, is_nullable
-            FROM information_schema.columns 
-            WHERE table_name = 'notas_fiscais'
-            ORDER BY ordinal_position;
-        """)
+        # Especificação já aplicada: nada a fazer (use --force para verificar mesmo assim)
+        if '--force' not in sys.argv:
+            with engine.connect() as conn:
+                if esquema_em_dia(conn, 'notas_fiscais', FINGERPRINT_ESPERADO):
+                    print("\n✅ Esquema de notas_fiscais já está atualizado (registro em _schema_state)")
+                    return
+        
+        # Verificar estrutura atual da tabela (uma consulta ao catálogo)
+        with engine.connect() as conn:
+            colunas_existentes = listar_colunas(conn, 'notas_fiscais')
         
-        colunas_existentes = cursor.fetchall()
         print("\n📋 Estrutura atual da tabela notas_fiscais:")
         for coluna in colunas_existentes:
-            print(f"  - {coluna[0]} ({coluna[1]}) - Nullable: {coluna[2]}")
+            print(f"  - {coluna[0]} ({coluna[1]}) - Nullable: {'YES' if coluna[2] else 'NO'}")
         
-        # Lista de todas as colunas esperadas baseadas no código
-        colunas_esperadas = {
-            'id': 'SERIAL PRIMARY KEY',
-            'numero': 'VARCHAR(50) NOT NULL',
-            'serie': 'VARCHAR(10)',
-            'data_emissao': 'DATE',
-            'cnpj_emitente': 'VARCHAR(18)',
-            'nome_emitente': 'VARCHAR(255)',
-            'valor_total': 'DECIMAL(15,2)',
-            'chave_acesso': 'VARCHAR(44)',
-            'natureza_operacao': 'VARCHAR(255)',
-            'situacao': 'VARCHAR(50)',
-            'data_vencimento': 'DATE',
-            'cnpj_destinatario': 'VARCHAR(18)',
-            'nome_destinatario': 'VARCHAR(255)',
-            'valor_icms': 'DECIMAL(15,2)',
-            'valor_ipi': 'DECIMAL(15,2)',
-            'valor_pis': 'DECIMAL(15,2)',
-            'valor_cofins': 'DECIMAL(15,2)',
-            'xml_original': 'TEXT',
-            'processado_em': 'TIMESTAMP',
-            'itens': 'TEXT',
-            'xml_content': 'TEXT'
-        }
+        # Estrutura final calculada a partir das alterações bem-sucedidas (sem nova consulta)
+        estrutura = {nome: (tipo, nullable) for nome, tipo, nullable in colunas_existentes}
+        sucesso = True
         
         # Verificar quais colunas estão faltando
         nomes_existentes = [col[0] for col in colunas_existentes]
         colunas_faltantes = []
         
-        for nome_coluna, tipo_coluna in colunas_esperadas.items():
+        for nome_coluna, tipo_coluna in COLUNAS_ESPERADAS.items():
             if nome_coluna not in nomes_existentes:
                 colunas_faltantes.append((nome_coluna, tipo_coluna))
         
@@ -68,43 +88,76 @@ def main():
             for nome, tipo in colunas_faltantes:
                 print(f"  - {nome} ({tipo})")
             
-            # Adicionar colunas faltantes
+            # Adicionar colunas faltantes em um único ALTER TABLE (uma ida ao banco, um lock)
             print("\n🔧 Adicionando colunas faltantes...")
-            for nome_coluna, tipo_coluna in colunas_faltantes:
-                try:
-                    # Remover PRIMARY KEY se existir (só para id)
-                    if 'PRIMARY KEY' in tipo_coluna:
-                        tipo_coluna = tipo_coluna.replace(' PRIMARY KEY', '')
-                    
-                    sql = f"ALTER TABLE notas_fiscais ADD COLUMN {nome_coluna} {tipo_coluna};"
-                    print(f"  Executando: {sql}")
-                    cursor.execute(sql)
-                    print(f"  ✅ Coluna '{nome_coluna}' adicionada com sucesso")
-                except Exception as e:
-                    print(f"  ❌ Erro ao adicionar coluna '{nome_coluna}': {e}")
+            clausulas = ", ".join(
+                # Remover PRIMARY KEY se existir (só para id)
+                f"ADD COLUMN IF NOT EXISTS {nome_coluna} {tipo_coluna.replace(' PRIMARY KEY', '')}"
+                for nome_coluna, tipo_coluna in colunas_faltantes
+            )
+            sql = f"ALTER TABLE notas_fiscais {clausulas};"
+            print(f"  Executando: {sql}")
             
-            # Commit das alterações
-            conn.commit()
-            print("\n✅ Todas as alterações foram salvas")
+            try:
+                with engine.begin() as conn:
+                    commit_assincrono(conn)
+                    conn.execute(text(sql))
+                print("\n✅ Todas as alterações foram salvas")
+                for nome_coluna, tipo_coluna in colunas_faltantes:
+                    tipo_final = tipo_coluna.replace(' PRIMARY KEY', '').replace(' NOT NULL', '').lower()
+                    estrutura[nome_coluna] = (tipo_final, 'NOT NULL' not in tipo_coluna)
+            except Exception as e:
+                print(f"  ❌ Erro ao adicionar colunas (nenhuma alteração aplicada): {e}")
+                sucesso = False
         else:
             print("\n✅ Todas as colunas necessárias já existem na tabela")
         
-        # Verificar estrutura final
-        cursor.execute("""
-            SELECT column_name, data_type, is_nullable
-            FROM information_schema.columns 
-            WHERE table_name = 'notas_fiscais'
-            ORDER BY ordinal_position;
-        """)
+        # Migrar colunas antigas em TEXT/VARCHAR para BYTEA/JSONB
+        colunas_texto = [col[0] for col in colunas_existentes if col[0] in CONVERSOES and tipo_texto(col[1])]
+        if colunas_texto:
+            print(f"\n🔧 Convertendo colunas TEXT: {', '.join(colunas_texto)}")
+            clausulas = ", ".join(
+                f"ALTER COLUMN {nome_coluna} TYPE {CONVERSOES[nome_coluna]}" for nome_coluna in colunas_texto
+            )
+            sql = f"ALTER TABLE notas_fiscais {clausulas};"
+            print(f"  Executando: {sql}")
+            
+            try:
+                with engine.begin() as conn:
+                    commit_assincrono(conn)
+                    conn.execute(text(SQL_FUNCAO_JSONB_OU_NULO))
+                    conn.execute(text(sql))
+                print("  ✅ Tipos convertidos")
+                for nome_coluna in colunas_texto:
+                    estrutura[nome_coluna] = (CONVERSOES[nome_coluna].split()[0].lower(), estrutura[nome_coluna][1])
+            except Exception as e:
+                print(f"  ❌ Erro ao converter tipos (nenhuma alteração aplicada): {e}")
+                sucesso = False
+        
+        # Índice GIN para consultas dentro de itens (itens @> '[{"codigo": "..."}]')
+        try:
+            with engine.begin() as conn:
+                commit_assincrono(conn)
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_nf_itens_gin ON notas_fiscais USING gin (itens jsonb_path_ops)"
+                ))
+            print("\n✅ Índice idx_nf_itens_gin verificado")
+        except Exception as e:
+            print(f"\n❌ Erro ao criar índice idx_nf_itens_gin: {e}")
+            sucesso = False
+        
+        # Registrar a especificação aplicada para pular as próximas execuções
+        if sucesso:
+            with engine.begin() as conn:
+                commit_assincrono(conn)
+                registrar_esquema(conn, 'notas_fiscais', FINGERPRINT_ESPERADO)
         
-        colunas_finais = cursor.fetchall()
-        print(f"\n📋 Estrutura final da tabela notas_fiscais ({len(colunas_finais)} colunas):")
-        for coluna in colunas_finais:
-            print(f"  - {coluna[0]} ({coluna[1]}) - Nullable: {coluna[2]}")
+        # Estrutura final
+        print(f"\n📋 Estrutura final da tabela notas_fiscais ({len(estrutura)} colunas):")
+        for nome, (tipo, nullable) in estrutura.items():
+            print(f"  - {nome} ({tipo}) - Nullable: {'YES' if nullable else 'NO'}")
         
-        cursor.close()
-        conn.close()
-        print("\n🔒 Conexão fechada")
+        print("\n🔒 Conexão devolvida ao pool")
         
     except Exception as e:
         print(f"❌ Erro: {e}")
@@ -5,45 +5,51 @@ mas estão marcados incorretamente como 'upload'
 """
 
 import os
-from sqlalchemy import create_engine, text
-from dotenv import load_dotenv
+from sqlalchemy import text
+from db import get_engine, commit_assincrono
 
 def main():
-    # Carregar configurações
-    load_dotenv()
-    DATABASE_URL = os.getenv('DATABASE_URL')
-    
-    if not DATABASE_URL:
+    # Verificar configuração
+    if not os.getenv('DATABASE_URL'):
         print("Erro: DATABASE_URL não configurada")
         return
     
-    engine = create_engine(DATABASE_URL)
+    engine = get_engine()
     
     with engine.connect() as conn:
-        # Primeiro, verificar quais registros têm xml_original (indicativo de email)
+        # Script idempotente: commits sem esperar o fsync do WAL
+        commit_assincrono(conn)
+        
+        # Índice parcial para o predicado "tem XML original" (indicativo de email)
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_nf_xml_not_null
+            ON notas_fiscais (id)
+            WHERE xml_original IS NOT NULL AND xml_original <> ''
+        """))
+        
+        # Atualizar em uma única passada, retornando apenas os registros que mudaram
         result = conn.execute(text("""
-            SELECT id, numero, nome_emitente, origem 
-            FROM notas_fiscais 
-            WHERE xml_original IS NOT NULL AND xml_original != ''
+            UPDATE notas_fiscais 
+            SET origem = 'email' 
+            WHERE xml_original IS NOT NULL AND xml_original <> ''
+              AND origem IS DISTINCT FROM 'email'
+            RETURNING id, numero, nome_emitente
         """))
-        registros_email = list(result)
+        registros_atualizados = result.fetchall()
+        conn.commit()
         
-        print(f"Encontrados {len(registros_email)} registros com XML original (provavelmente de email):")
-        for row in registros_email:
-            print(f"  ID: {row[0]} - Nota {row[1]} - {row[2]} - Origem atual: {row[3]}")
+        print(f"Atualizados {len(registros_atualizados)} registros com XML original para origem 'email':")
+        for row in registros_atualizados:
+            print(f"  ID: {row[0]} - Nota {row[1]} - {row[2]}")
         
-        # Atualizar esses registros para origem 'email'
-        if registros_email:
-            result = conn.execute(text("""
-                UPDATE notas_fiscais 
-                SET origem = 'email' 
-                WHERE xml_original IS NOT NULL AND xml_original != ''
-            """))
+        # Verificar o resultado final (view materializada quando a migração 0002 já foi aplicada)
+        if conn.execute(text("SELECT to_regclass('mv_origem_counts')")).scalar() is not None:
+            commit_assincrono(conn)
+            conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_origem_counts"))
             conn.commit()
-            print(f"\nAtualizados {len(registros_email)} registros para origem 'email'")
-        
-        # Verificar o resultado final
-        result = conn.execute(text("SELECT origem, COUNT(*) FROM notas_fiscais GROUP BY origem"))
+            result = conn.execute(text("SELECT origem, n FROM mv_origem_counts ORDER BY origem"))
+        else:
+            result = conn.execute(text("SELECT origem, COUNT(*) FROM notas_fiscais GROUP BY origem"))
         print("\nDistribuição atualizada por origem:")
         for row in result:
             origem = row[0] if row[0] is not None else 'NULL'
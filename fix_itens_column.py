@@ -4,7 +4,9 @@ Script para adicionar a coluna 'itens' na tabela notas_fiscais
 """
 
 from secure_config import get_secure_config
-from sqlalchemy import create_engine, text, inspect
+from sqlalchemy import text
+from db import get_engine, listar_colunas, commit_assincrono, esquema_em_dia, SQL_FUNCAO_JSONB_OU_NULO
+from fix_all_missing_columns import FINGERPRINT_ESPERADO
 
 def main():
     """Adiciona a coluna itens na tabela"""
@@ -13,42 +15,66 @@ def main():
         config = get_secure_config()
         print(f"🔧 Conectando ao banco: {config.DATABASE_URL[:50]}...")
         
-        # Criar engine
-        engine = create_engine(config.DATABASE_URL)
+        # Obter engine compartilhada
+        engine = get_engine()
         
-        # Verificar estrutura atual
-        inspector = inspect(engine)
-        columns = inspector.get_columns('notas_fiscais')
+        # Esquema completo já aplicado (inclui 'itens' JSONB e o índice GIN)
+        with engine.connect() as connection:
+            if esquema_em_dia(connection, 'notas_fiscais', FINGERPRINT_ESPERADO):
+                print("\n✅ Coluna 'itens' já está atualizada (registro em _schema_state)")
+                return
+        
+        # Verificar estrutura atual (uma consulta ao catálogo pg_attribute)
+        with engine.connect() as connection:
+            columns = listar_colunas(connection, 'notas_fiscais')
         
         print("\n📊 Estrutura atual da tabela 'notas_fiscais':")
         column_names = []
-        for column in columns:
-            column_names.append(column['name'])
-            print(f"   - {column['name']}: {column['type']}")
+        for nome, tipo, _ in columns:
+            column_names.append(nome)
+            print(f"   - {nome}: {tipo}")
         
         # Verificar se a coluna 'itens' existe
+        tipos = {nome: tipo.upper() for nome, tipo, _ in columns}
         if 'itens' not in column_names:
             print("\n🔧 Adicionando coluna 'itens'...")
             
             with engine.begin() as connection:
-                # Adicionar a coluna itens como TEXT para armazenar JSON
+                commit_assincrono(connection)
+                # Adicionar a coluna itens como JSONB (JSON binário, indexável)
                 alter_query = text("""
                     ALTER TABLE notas_fiscais 
-                    ADD COLUMN itens TEXT
+                    ADD COLUMN itens JSONB
                 """)
                 
                 connection.execute(alter_query)
                 print("   ✅ Coluna 'itens' adicionada com sucesso!")
+        elif tipos['itens'] != 'JSONB':
+            print(f"\n🔧 Convertendo coluna 'itens' de {tipos['itens']} para JSONB...")
+            
+            with engine.begin() as connection:
+                commit_assincrono(connection)
+                # JSON inválido em linhas antigas vira NULL em vez de abortar a conversão
+                connection.execute(text(SQL_FUNCAO_JSONB_OU_NULO))
+                connection.execute(text("""
+                    ALTER TABLE notas_fiscais 
+                    ALTER COLUMN itens TYPE JSONB USING jsonb_ou_nulo(itens::text)
+                """))
+                print("   ✅ Coluna 'itens' convertida com sucesso!")
         else:
             print("\n⚠️ Coluna 'itens' já existe")
         
-        # Verificar estrutura final
-        print("\n📊 Estrutura final da tabela:")
-        inspector = inspect(engine)
-        columns = inspector.get_columns('notas_fiscais')
+        # Índice GIN para consultas dentro dos itens
+        with engine.begin() as connection:
+            commit_assincrono(connection)
+            connection.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_nf_itens_gin 
+                ON notas_fiscais USING gin (itens jsonb_path_ops)
+            """))
+            print("   ✅ Índice idx_nf_itens_gin verificado")
         
-        for column in columns:
-            print(f"   - {column['name']}: {column['type']} {'(NOT NULL)' if not column['nullable'] else '(NULL)'}")
+        # Estrutura final: 'itens' existe como JSONB após as etapas acima
+        print(f"\n📊 Estrutura final: {len(set(column_names) | {'itens'})} colunas, 'itens' como JSONB")
         
     except Exception as e:
         print(f"❌ Erro: {e}")
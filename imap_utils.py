@@ -0,0 +1,391 @@
+# imap_utils.py
+# Funções auxiliares para consultas IMAP em lote (SEARCH no servidor, FETCH agrupado e BODYSTRUCTURE)
+
+import atexit
+import codecs
+import functools
+import imaplib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.header import decode_header
+from email.message import Message
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import unquote_to_bytes
+
+logger = logging.getLogger(__name__)
+
+# Marcadores internos do tokenizador
+_ABRE = object()
+_FECHA = object()
+_LITERAL = object()
+
+# Conexões IMAP reutilizadas entre execuções no mesmo processo (ex.: agendador)
+_CONEXOES: Dict[tuple, Any] = {}
+_LOCK_CONEXOES = threading.Lock()
+
+def _fechar(mail: Any) -> None:
+    """Encerra uma conexão IMAP ignorando erros (a conexão pode já ter caído)"""
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+def obter_conexao(servidor: str, porta: int, usuario: str, senha: str, caixa: str = 'inbox') -> Any:
+    """
+    Retorna uma conexão IMAP autenticada e com a caixa selecionada, reutilizada entre chamadas
+
+    Antes de reutilizar, um NOOP confirma que a conexão continua viva (e a mantém ativa
+    no servidor); se tiver caído, uma nova conexão é aberta. Não fazer logout na conexão retornada.
+    """
+    chave = (servidor, porta, usuario, caixa)
+    with _LOCK_CONEXOES:
+        mail = _CONEXOES.pop(chave, None)
+        if mail is not None:
+            try:
+                if mail.state == 'SELECTED' and mail.noop()[0] == 'OK':
+                    _CONEXOES[chave] = mail
+                    return mail
+            except (imaplib.IMAP4.error, OSError):
+                pass
+            logger.info("Conexão IMAP expirada; reconectando")
+            _fechar(mail)
+
+        mail = imaplib.IMAP4_SSL(servidor, porta)
+        mail.login(usuario, senha)
+        mail.select(caixa)
+        _CONEXOES[chave] = mail
+        return mail
+
+@atexit.register
+def fechar_conexoes() -> None:
+    """Encerra as conexões IMAP mantidas abertas"""
+    with _LOCK_CONEXOES:
+        for mail in _CONEXOES.values():
+            _fechar(mail)
+        _CONEXOES.clear()
+
+def montar_criterio_assunto(palavras: List[str]) -> str:
+    """Monta o critério SEARCH 'OR SUBJECT a OR SUBJECT b SUBJECT c' para as palavras-chave"""
+    criterios = [f'SUBJECT "{palavra}"' for palavra in palavras]
+    if not criterios:
+        return "ALL"
+
+    # OR do IMAP é binário: encadear da direita para a esquerda
+    criterio = criterios[-1]
+    for anterior in reversed(criterios[:-1]):
+        criterio = f"OR {anterior} {criterio}"
+    return criterio
+
+def _tokenizar(texto: bytes):
+    """Quebra uma linha de resposta IMAP em tokens (átomos, strings, parênteses e literais)"""
+    i, n = 0, len(texto)
+    while i < n:
+        c = texto[i:i + 1]
+        if c in (b' ', b'\r', b'\n'):
+            i += 1
+        elif c == b'(':
+            yield _ABRE
+            i += 1
+        elif c == b')':
+            yield _FECHA
+            i += 1
+        elif c == b'"':
+            j, buf = i + 1, bytearray()
+            while j < n and texto[j:j + 1] != b'"':
+                if texto[j:j + 1] == b'\\':
+                    j += 1
+                buf += texto[j:j + 1]
+                j += 1
+            yield bytes(buf)
+            i = j + 1
+        elif c == b'{':
+            # Literal "{N}": o conteúdo vem no próximo elemento da resposta
+            i = texto.index(b'}', i) + 1
+            yield _LITERAL
+        else:
+            # Átomo (inclui seções como BODY[HEADER.FIELDS (SUBJECT DATE)])
+            j, profundidade = i, 0
+            while j < n:
+                ch = texto[j:j + 1]
+                if ch == b'[':
+                    profundidade += 1
+                elif ch == b']':
+                    profundidade -= 1
+                elif profundidade == 0 and ch in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                j += 1
+            atomo = texto[i:j]
+            yield None if atomo.upper() == b'NIL' else atomo
+            i = j
+
+def _parse_resposta(dados: List[Any]) -> List[Any]:
+    """Converte a resposta bruta do imaplib em listas aninhadas"""
+    pilha = [[]]
+    for elemento in dados:
+        if elemento is None:
+            continue
+        if isinstance(elemento, tuple):
+            texto, literal = elemento[0], elemento[1]
+        else:
+            texto, literal = elemento, None
+
+        for token in _tokenizar(texto):
+            if token is _ABRE:
+                pilha.append([])
+            elif token is _FECHA:
+                if len(pilha) > 1:
+                    fechado = pilha.pop()
+                    pilha[-1].append(fechado)
+            elif token is _LITERAL:
+                pilha[-1].append(literal)
+            else:
+                pilha[-1].append(token)
+    return pilha[0]
+
+def parse_fetch(dados: List[Any]) -> Dict[bytes, Dict[str, Any]]:
+    """
+    Interpreta a resposta de um UID FETCH em lote
+
+    Returns:
+        Dicionário UID -> {atributo: valor}; seções BODY[...] ficam sob a chave 'BODY[...]'
+    """
+    mensagens: Dict[bytes, Dict[str, Any]] = {}
+    for item in _parse_resposta(dados):
+        if not isinstance(item, list):
+            continue  # número de sequência da mensagem
+
+        atributos: Dict[str, Any] = {}
+        for i in range(0, len(item) - 1, 2):
+            chave = item[i]
+            if not isinstance(chave, bytes):
+                continue
+            nome = chave.decode('ascii', errors='ignore').upper()
+            if nome.startswith('BODY[') or nome.startswith('BODY.PEEK['):
+                nome = 'BODY[' + nome.split('[', 1)[1]
+            atributos[nome] = item[i + 1]
+
+        uid = atributos.get('UID')
+        if uid is None:
+            continue
+        # Alguns servidores enviam FETCHs parciais (ex.: só FLAGS) para a mesma mensagem
+        mensagens.setdefault(uid, {}).update(atributos)
+    return mensagens
+
+def fetch_em_lotes(conectar: Callable[[], Any], uids: List[bytes], itens: str,
+                   tamanho_lote: int = 50, max_conexoes: int = 4,
+                   principal: Any = None, lotes_por_conexao: int = 1) -> Dict[bytes, Dict[str, Any]]:
+    """
+    Executa o UID FETCH em lotes, distribuindo-os entre conexões IMAP em paralelo quando compensa
+
+    O imaplib é síncrono (um comando por vez por conexão); abrir algumas conexões
+    esconde a latência de ida e volta de cada lote, mas cada uma custa um handshake
+    TLS + LOGIN. Por isso só são abertas conexões extras quando há mais de
+    lotes_por_conexao lotes, e apenas as necessárias (até max_conexoes).
+
+    Args:
+        conectar: Função que retorna uma conexão já autenticada e com a caixa selecionada
+        uids: UIDs a buscar
+        itens: Itens do FETCH, ex.: '(FLAGS BODYSTRUCTURE)'
+        principal: Conexão já aberta (ex.: de obter_conexao), usada para o primeiro grupo
+            de lotes e mantida aberta; sem ela, todos os grupos usam conexões de conectar()
+        lotes_por_conexao: Lotes que uma conexão atende antes de valer abrir outra
+
+    Returns:
+        Dicionário UID -> {atributo: valor}, como em parse_fetch
+    """
+    lotes = [uids[i:i + tamanho_lote] for i in range(0, len(uids), tamanho_lote)]
+    if not lotes:
+        return {}
+
+    necessarias = -(-len(lotes) // max(1, lotes_por_conexao))
+    quantidade = max(1, min(max_conexoes, necessarias))
+    grupos = [lotes[i::quantidade] for i in range(quantidade)]
+
+    def _baixar_com(mail: Any, grupo: List[List[bytes]]) -> Dict[bytes, Dict[str, Any]]:
+        resultado: Dict[bytes, Dict[str, Any]] = {}
+        for lote in grupo:
+            status, dados = mail.uid('FETCH', b','.join(lote), itens)
+            if status == 'OK':
+                resultado.update(parse_fetch(dados))
+            else:
+                logger.warning(f"FETCH em lote falhou ({len(lote)} mensagens): {status}")
+        return resultado
+
+    def _baixar(grupo: List[List[bytes]]) -> Dict[bytes, Dict[str, Any]]:
+        # Cada thread usa a própria conexão: objetos imaplib não são thread-safe
+        mail = conectar()
+        try:
+            return _baixar_com(mail, grupo)
+        finally:
+            _fechar(mail)
+
+    # Poucos lotes: tudo pela conexão já aberta, sem nenhum handshake extra
+    if principal is not None and quantidade == 1:
+        return _baixar_com(principal, grupos[0])
+
+    mensagens: Dict[bytes, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=quantidade) as executor:
+        futuros = [
+            executor.submit(_baixar_com, principal, grupo) if principal is not None and indice == 0
+            else executor.submit(_baixar, grupo)
+            for indice, grupo in enumerate(grupos)
+        ]
+        for futuro in futuros:
+            mensagens.update(futuro.result())
+    return mensagens
+
+@functools.lru_cache(maxsize=64)
+def _decodificador(encoding: Optional[str]):
+    """Resolve (uma vez por nome) a função de decodificação de um charset, com fallback para UTF-8"""
+    # Sem encoding ou 'unknown-8bit': assume UTF-8
+    if not encoding or encoding.lower() == "unknown-8bit":
+        encoding = "utf-8"
+    try:
+        info = codecs.lookup(encoding)
+        # Codecs bytes->bytes (ex.: base64) não servem para texto
+        if getattr(info, '_is_text_encoding', True):
+            return info.decode
+    except LookupError:  # caso encoding não seja reconhecido
+        pass
+    return codecs.lookup("utf-8").decode
+
+def decodificar_assunto(assunto: Optional[str]) -> str:
+    """Decodifica o cabeçalho Subject (RFC 2047) para texto"""
+    partes = decode_header(assunto or "")
+    if len(partes) == 1:
+        parte, enc = partes[0]
+        texto = _decodificador(enc)(parte, "ignore")[0] if isinstance(parte, bytes) else parte
+        return texto.strip()
+
+    return " ".join(
+        _decodificador(enc)(parte, "ignore")[0] if isinstance(parte, bytes) else parte
+        for parte, enc in partes
+    ).strip()
+
+def _decodificar_nome(valor: Any) -> Optional[str]:
+    """Decodifica nomes de arquivo (RFC 2047 / RFC 2231)"""
+    if not isinstance(valor, bytes):
+        return None
+    texto = valor.decode('utf-8', errors='ignore')
+    partes = []
+    for parte, enc in decode_header(texto):
+        if isinstance(parte, bytes):
+            try:
+                partes.append(parte.decode(enc or 'utf-8', errors='ignore'))
+            except LookupError:
+                partes.append(parte.decode('utf-8', errors='ignore'))
+        else:
+            partes.append(parte)
+    return ''.join(partes).strip() or None
+
+def _parametro(parametros: Any, nome: str) -> Optional[str]:
+    """
+    Busca um parâmetro (name/filename) em uma lista de pares do BODYSTRUCTURE
+
+    Aceita o valor simples (com RFC 2047) e as formas da RFC 2231: 'nome*' com
+    charset'idioma'valor-%XX e os segmentos 'nome*0', 'nome*1*', ... concatenados em ordem.
+    """
+    if not isinstance(parametros, list):
+        return None
+    nome = nome.lower()
+    simples = None
+    segmentos: Dict[int, tuple] = {}  # índice -> (valor, codificado)
+    for i in range(0, len(parametros) - 1, 2):
+        chave, valor = parametros[i], parametros[i + 1]
+        if not isinstance(chave, bytes) or not isinstance(valor, bytes):
+            continue
+        chave = chave.decode('ascii', errors='ignore').lower()
+        if chave == nome:
+            simples = valor
+        elif chave.startswith(f"{nome}*"):
+            sufixo = chave[len(nome) + 1:]
+            indice = sufixo.rstrip('*')
+            if indice == '' or indice.isdigit():
+                segmentos[int(indice or 0)] = (valor, sufixo == '' or sufixo.endswith('*'))
+
+    if not segmentos:
+        return _decodificar_nome(simples)
+
+    charset, bruto = 'utf-8', bytearray()
+    for posicao, indice in enumerate(sorted(segmentos)):
+        valor, codificado = segmentos[indice]
+        texto = valor.decode('ascii', errors='ignore')
+        if codificado:
+            # Só o primeiro segmento traz charset'idioma'
+            if posicao == 0 and texto.count("'") >= 2:
+                charset, _, texto = texto.split("'", 2)
+            bruto += unquote_to_bytes(texto)
+        else:
+            bruto += texto.encode('ascii')
+    return _decodificador(charset or None)(bytes(bruto), 'ignore')[0].strip() or None
+
+# Índice do body-fld-dsp em cada tipo de parte não-multipart do BODYSTRUCTURE
+_DISPOSICAO_BASICA = 8
+_DISPOSICAO_TEXTO = 9
+_DISPOSICAO_RFC822 = 11
+
+def listar_anexos(estrutura: Any, secao: str = "") -> List[Dict[str, str]]:
+    """
+    Lista os anexos descritos em um BODYSTRUCTURE sem baixar o conteúdo
+
+    Considera anexo toda parte com Content-Disposition e nome de arquivo,
+    mesmo critério do antigo msg.walk() + part.get_filename().
+
+    Returns:
+        Lista de {'filename', 'secao', 'encoding'}; 'secao' é o número da parte para BODY.PEEK[...]
+    """
+    anexos: List[Dict[str, str]] = []
+    if not isinstance(estrutura, list) or not estrutura:
+        return anexos
+
+    # Multipart: as primeiras posições são as subpartes
+    if isinstance(estrutura[0], list):
+        for indice, subparte in enumerate(estrutura, start=1):
+            if not isinstance(subparte, list):
+                break
+            anexos.extend(listar_anexos(subparte, f"{secao}.{indice}" if secao else str(indice)))
+        return anexos
+
+    secao = secao or "1"
+    tipo = (estrutura[0] or b'').lower()
+    subtipo = (estrutura[1] or b'').lower() if len(estrutura) > 1 else b''
+
+    # Posição fixa da disposição (RFC 3501): após md5, que vem depois dos campos do tipo
+    # (text/*: linhas; message/rfc822: envelope, corpo e linhas). A lista de idiomas vem
+    # logo depois e não pode ser tomada pela disposição quando esta é NIL.
+    if (tipo, subtipo) == (b'message', b'rfc822'):
+        indice_disposicao = _DISPOSICAO_RFC822
+    elif tipo == b'text':
+        indice_disposicao = _DISPOSICAO_TEXTO
+    else:
+        indice_disposicao = _DISPOSICAO_BASICA
+    campo = estrutura[indice_disposicao] if len(estrutura) > indice_disposicao else None
+    disposicao = campo if isinstance(campo, list) and campo and isinstance(campo[0], bytes) else None
+
+    if disposicao is not None:
+        filename = _parametro(disposicao[1] if len(disposicao) > 1 else None, 'filename') \
+            or _parametro(estrutura[2] if len(estrutura) > 2 else None, 'name')
+        if filename:
+            encoding = estrutura[5] if len(estrutura) > 5 and isinstance(estrutura[5], bytes) else b'7bit'
+            anexos.append({
+                'filename': filename,
+                'secao': secao,
+                'encoding': encoding.decode('ascii', errors='ignore').lower()
+            })
+
+    if (tipo, subtipo) == (b'message', b'rfc822') and len(estrutura) > 8:
+        interna = estrutura[8]
+        # Corpo não-multipart de uma mensagem anexada é a parte "<secao>.1"
+        eh_multipart = isinstance(interna, list) and interna and isinstance(interna[0], list)
+        anexos.extend(listar_anexos(interna, secao if eh_multipart else f"{secao}.1"))
+
+    return anexos
+
+def decodificar_parte(conteudo: Any, encoding: str) -> bytes:
+    """Decodifica o conteúdo de uma seção BODY[...] conforme seu Content-Transfer-Encoding"""
+    # Mesmo decodificador tolerante do part.get_payload(decode=True)
+    parte = Message()
+    parte['Content-Transfer-Encoding'] = encoding or '7bit'
+    parte.set_payload(conteudo or b'')
+    return parte.get_payload(decode=True) or b''
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Migrações versionadas do esquema do banco de dados
+Cada migração roda uma única vez; as já aplicadas ficam registradas em schema_migrations
+Uma migração que falha não é registrada e é tentada de novo na execução seguinte
+"""
+
+import logging
+from typing import List, Tuple
+from sqlalchemy import exc, text
+from db import get_engine, commit_assincrono, SQL_FUNCAO_JSONB_OU_NULO
+
+logger = logging.getLogger(__name__)
+
+# Migrações em ordem: (versão, descrição, comandos SQL)
+MIGRACOES: List[Tuple[str, str, List[str]]] = [
+    (
+        "0001_origem",
+        "Coluna origem em notas_fiscais e correção das notas vindas de email",
+        [
+            "ALTER TABLE notas_fiscais ADD COLUMN IF NOT EXISTS origem VARCHAR(20) DEFAULT 'upload'",
+            """
+            UPDATE notas_fiscais
+            SET origem = 'email'
+            WHERE xml_original IS NOT NULL AND xml_original <> ''
+              AND origem IS DISTINCT FROM 'email'
+            """,
+        ],
+    ),
+    (
+        "0002_mv_origem_counts",
+        "View materializada com a contagem de notas por origem",
+        [
+            """
+            CREATE MATERIALIZED VIEW IF NOT EXISTS mv_origem_counts AS
+            SELECT origem, COUNT(*) AS n FROM notas_fiscais GROUP BY origem
+            """,
+            # Índice único: exigido pelo REFRESH ... CONCURRENTLY
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_origem_counts_origem ON mv_origem_counts (origem)",
+        ],
+    ),
+    (
+        "0003_chave_acesso_unica",
+        "Índice único em notas_fiscais.chave_acesso (permite INSERT ... ON CONFLICT DO NOTHING)",
+        [
+            # Com chaves já duplicadas a migração falha e fica pendente (a aplicação segue com
+            # SELECT + INSERT); é aplicada na primeira execução depois de removidas as duplicatas
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM notas_fiscais
+                    WHERE chave_acesso IS NOT NULL
+                    GROUP BY chave_acesso HAVING COUNT(*) > 1
+                ) THEN
+                    RAISE EXCEPTION 'notas_fiscais possui chave_acesso duplicada; índice único não criado';
+                ELSE
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_nf_chave_acesso_unica ON notas_fiscais (chave_acesso);
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    (
+        "0004_indices_consultas",
+        "Índices para o filtro por data de emissão, busca por número e itens por nota",
+        [
+            # Sem CONCURRENTLY: as migrações rodam dentro de uma transação
+            "CREATE INDEX IF NOT EXISTS idx_nf_data_emissao ON notas_fiscais (data_emissao DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_nf_numero ON notas_fiscais (numero)",
+            """
+            DO $$
+            BEGIN
+                IF to_regclass('itens_nota_fiscal') IS NOT NULL THEN
+                    CREATE INDEX IF NOT EXISTS idx_itens_nota_fiscal_id ON itens_nota_fiscal (nota_fiscal_id);
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    (
+        "0005_tipos_binarios",
+        "xml_original/xml_content de TEXT/VARCHAR para BYTEA e itens para JSONB",
+        [
+            # A aplicação grava o XML em bytes: numa coluna TEXT o PostgreSQL guardaria o texto hexadecimal '\x3c3f...'
+            SQL_FUNCAO_JSONB_OU_NULO,
+            """
+            DO $$
+            DECLARE
+                coluna RECORD;
+            BEGIN
+                FOR coluna IN
+                    SELECT column_name, data_type FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'notas_fiscais'
+                      AND column_name IN ('xml_original', 'xml_content', 'itens')
+                LOOP
+                    IF coluna.column_name = 'itens' THEN
+                        IF coluna.data_type IN ('text', 'character varying', 'character', 'json') THEN
+                            ALTER TABLE notas_fiscais ALTER COLUMN itens TYPE JSONB USING jsonb_ou_nulo(itens::text);
+                        END IF;
+                    ELSIF coluna.data_type IN ('text', 'character varying', 'character') THEN
+                        EXECUTE format(
+                            'ALTER TABLE notas_fiscais ALTER COLUMN %1$I TYPE BYTEA USING convert_to(%1$I, ''UTF8'')',
+                            coluna.column_name
+                        );
+                    END IF;
+                END LOOP;
+            END $$
+            """,
+        ],
+    ),
+]
+
+# Chave do advisory lock que impede duas instâncias migrando ao mesmo tempo
+_LOCK_MIGRACOES = 7242001
+
+def aplicar_migracoes() -> List[str]:
+    """
+    Aplica as migrações pendentes
+
+    Com o esquema em dia, o custo é um único SELECT na tabela de versões.
+
+    Returns:
+        Lista das versões aplicadas nesta execução
+    """
+    engine = get_engine()
+    if engine.dialect.name != 'postgresql':
+        logger.info("Migrações ignoradas: disponíveis apenas para PostgreSQL")
+        return []
+
+    aplicadas: List[str] = []
+    pendentes: List[str] = []
+    with engine.begin() as conn:
+        commit_assincrono(conn)
+        conn.execute(text("SELECT pg_advisory_xact_lock(:chave)"), {"chave": _LOCK_MIGRACOES})
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                versao VARCHAR(50) PRIMARY KEY,
+                aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        # Banco novo: as tabelas ainda serão criadas pela aplicação
+        if conn.execute(text("SELECT to_regclass('notas_fiscais')")).scalar() is None:
+            logger.info("Tabela notas_fiscais ainda não existe; migrações adiadas")
+            return []
+
+        ja_aplicadas = {row[0] for row in conn.execute(text("SELECT versao FROM schema_migrations"))}
+
+        for versao, descricao, comandos in MIGRACOES:
+            if versao in ja_aplicadas:
+                continue
+
+            logger.info(f"Aplicando migração {versao}: {descricao}")
+            # SAVEPOINT por migração: a que falhar é desfeita e não registrada (nova tentativa na
+            # próxima execução), sem impedir as seguintes, que são independentes entre si
+            try:
+                with conn.begin_nested():
+                    for comando in comandos:
+                        conn.execute(text(comando))
+                    conn.execute(text("INSERT INTO schema_migrations (versao) VALUES (:versao)"), {"versao": versao})
+            except exc.DBAPIError as e:
+                logger.error(f"❌ Migração {versao} não aplicada (será tentada novamente): {e.orig}")
+                pendentes.append(versao)
+                continue
+            aplicadas.append(versao)
+
+    if aplicadas:
+        logger.info(f"✅ Migrações aplicadas: {', '.join(aplicadas)}")
+    elif not pendentes:
+        logger.info("✅ Esquema já está atualizado")
+    return aplicadas
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    aplicar_migracoes()
@@ -3,28 +3,32 @@
 import os
 import json
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Any, Tuple, Iterable, Iterator
 from dataclasses import dataclass, asdict
-from sqlalchemy import create_engine, text, exc
+from sqlalchemy import create_engine, text, exc, bindparam, inspect, insert, table, column
+from sqlalchemy.engine import make_url
 import pandas as pd
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
-import plotly.express as px
-from pathlib import Path
-import tempfile
 from dotenv import load_dotenv
-import google.generativeai as genai
 from decimal import Decimal, InvalidOperation
 import re
 import unicodedata
+import functools
+import hmac
+import time
 import io
+import csv
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from security_utils import (
     XMLSecurityValidator, 
     DataSanitizer, 
     SecurityAuditor,
-    SecurityConfig
+    SecurityConfig,
+    somente_digitos
 )
 from auth_streamlit import auth
 
@@ -35,52 +39,137 @@ logger = logging.getLogger(__name__)
 
 # --- CLASSES DE LÓGICA DE NEGÓCIO ---
 
-import io
-import pdfplumber
+import pypdfium2 as pdfium
+from lxml import etree
+
+# --- Expressões Regulares para DANFE (compiladas uma única vez) ---
+# Uma busca por campo: cada campo precisa do seu primeiro match independente dos demais.
+# As 8 buscas somam ~3 ms em 30 KB de texto, bem abaixo da extração do pdfplumber,
+# por isso não vale trocar por um motor multi-padrão (RE2/hyperscan).
+_PDF_PATTERNS = {
+    'cnpj': re.compile(r"CNPJ\s*[:\s]*([\d\.\-/]{14,18})", re.IGNORECASE),
+    'numero': re.compile(r"N[º°]\s*(\d{1,9})", re.IGNORECASE),
+    'data_emissao': re.compile(r"(?:Data\s+(?:de\s+)?Emiss[aã]o|Emiss[aã]o)\s*:?[\s]*(\d{2}/\d{2}/\d{4})", re.IGNORECASE),
+    'serie': re.compile(r"S[ée]rie\s*:?[\s]*([0-9]{1,3})", re.IGNORECASE),
+    # DOTALL: o texto não é mais normalizado, e '.' precisa atravessar quebras de linha como antes
+    'nome_emitente': re.compile(r"(?:Emitente\s*:?[\s]*(.+)|recebemos\s+de\s+(.+?)\s+os\s+produtos)", re.IGNORECASE | re.DOTALL),
+    'valor_total': re.compile(r"Valor\s+Total\s+(?:da\s+(?:Nota|nf-?e)|Nota)\s*(?:R\$)?\s*([\d\.,]+)", re.IGNORECASE),
+    'chave_acesso': re.compile(r"((?:\d{4}\s*){11})", re.IGNORECASE),
+    'natureza_operacao': re.compile(r"^natureza\s+(?:da|de\s+)?opera[cç][aã]o\Z", re.IGNORECASE),
+}
+# Sequências de espaços/quebras (grupos capturados do PDF e nomes de colunas de CSV)
+_RE_WHITESPACE = re.compile(r"\s+")
+
+# --- Datas: caminho rápido por regex, strptime só para formatos fora do comum ---
+_RE_DATA_BR = re.compile(r"([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})")
+_RE_DATA_ISO = re.compile(r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})")
+_RE_DATA_ISO_XML = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})(?:T|\Z)")
+
+# Caracteres descartados dos valores numéricos de CSV (tudo que não é dígito, vírgula, ponto ou sinal)
+_RE_NAO_NUMERICO_CSV = re.compile(r"[^\d,.-]")
+
+def converter_data_br(texto: str) -> datetime:
+    """Equivale a datetime.strptime(texto, '%d/%m/%Y'), sem reinterpretar o formato a cada chamada"""
+    m = _RE_DATA_BR.fullmatch(texto)
+    if m:
+        return datetime(int(m[3]), int(m[2]), int(m[1]))
+    return datetime.strptime(texto, '%d/%m/%Y')
+
+def converter_data_iso(texto: str) -> datetime:
+    """Equivale a datetime.strptime(texto, '%Y-%m-%d'), sem reinterpretar o formato a cada chamada"""
+    m = _RE_DATA_ISO.fullmatch(texto)
+    if m:
+        return datetime(int(m[1]), int(m[2]), int(m[3]))
+    return datetime.strptime(texto, '%Y-%m-%d')
+
+def dia_seguinte(data) -> str:
+    """
+    Dia seguinte a uma data, em aaaa-mm-dd
+
+    Usado como limite exclusivo de intervalos ("coluna < dia_seguinte(fim)"), que
+    aproveitam o índice da coluna ao contrário de "DATE(coluna) <= fim".
+    """
+    if isinstance(data, datetime):
+        data = data.date()
+    elif not isinstance(data, date):
+        data = date.fromisoformat(str(data)[:10])
+    return (data + timedelta(days=1)).isoformat()
+
+def _para_decimal(valor) -> Decimal:
+    """Mesmo resultado de Decimal(str(valor)), sem o str() quando o valor já é Decimal, int ou texto"""
+    tipo = type(valor)
+    if tipo is Decimal:
+        return valor
+    if tipo is int or tipo is str:
+        return Decimal(valor)
+    return Decimal(str(valor))  # float: str() preserva o valor decimal exibido (0.1 e não 0.1000000000000000055...)
 
 class PDFExtractor:
+    @staticmethod
+    def _extrair_texto(pdf_bytes) -> str:
+        """Extrai o texto bruto de todas as páginas (PDFium; pdfplumber como alternativa)"""
+        try:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                paginas = []
+                for indice in range(len(pdf)):
+                    pagina = pdf[indice]
+                    textpage = pagina.get_textpage()
+                    paginas.append(textpage.get_text_range())
+                    textpage.close()
+                    pagina.close()
+            finally:
+                pdf.close()
+
+            texto = "\n".join(paginas)
+            if texto.strip():
+                return texto
+            logger.info("PDFium não retornou texto; tentando pdfplumber")
+        except Exception as e:
+            logger.warning(f"PDFium falhou ao ler o PDF ({e}); tentando pdfplumber")
+
+        # Import tardio: o pdfplumber só é carregado quando o PDFium não resolve
+        import pdfplumber
+        
+        # Lê o PDF diretamente da memória
+        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+            return "\n".join(page.extract_text() or "" for page in pdf.pages)
+
     @staticmethod
     def extrair_dados_pdf(pdf_bytes):
         try:
-            def extrair_valor(pattern, texto, default=None):
-                match = re.search(pattern, texto, re.IGNORECASE)
+            def extrair_valor(pattern, texto, default=None, normalizar=False):
+                match = pattern.search(texto)
                 if (match != None): 
                     if (match.group(1) != None): 
-                        return match.group(1)
+                        return _RE_WHITESPACE.sub(" ", match.group(1)) if normalizar else match.group(1)
                     else: 
                         return default
                 else: 
                     return default
-            # Lê o PDF diretamente da memória
-            pdf_stream = io.BytesIO(pdf_bytes)
-            
-            texto_completo = ""
-            with pdfplumber.open(pdf_stream) as pdf:
-                texto_completo = "\n".join(page.extract_text() or "" for page in pdf.pages)
-
-            # Remove espaços duplos e normaliza
-            texto_completo = re.sub(r"\s+", " ", texto_completo)
+            # Sem normalizar o texto inteiro: os padrões já aceitam qualquer sequência de espaços (\s*, \s+)
+            texto_completo = PDFExtractor._extrair_texto(pdf_bytes)
 
             # --- Expressões Regulares para DANFE ---
-            cnpj_emitente = extrair_valor(r"CNPJ\s*[:\s]*([\d\.\-/]{14,18})", texto_completo,"CNPJ 00.111.111/0001-11")
-            numero_nf = extrair_valor(r"N[º°]\s*(\d{1,9})", texto_completo, "Nº: 0")
-            data_emissao_str = extrair_valor(r"(?:Data\s+(?:de\s+)?Emiss[aã]o|Emiss[aã]o)\s*:?[\s]*(\d{2}/\d{2}/\d{4})", texto_completo, None)
+            cnpj_emitente = extrair_valor(_PDF_PATTERNS['cnpj'], texto_completo,"CNPJ 00.111.111/0001-11")
+            numero_nf = extrair_valor(_PDF_PATTERNS['numero'], texto_completo, "Nº: 0")
+            data_emissao_str = extrair_valor(_PDF_PATTERNS['data_emissao'], texto_completo, None)
             
             # Processar data_emissao corretamente
             if data_emissao_str:
                 try:
-                    data_emissao = datetime.strptime(data_emissao_str, '%d/%m/%Y')
+                    data_emissao = converter_data_br(data_emissao_str)
                 except ValueError:
                     logger.warning(f"Formato de data inválido no PDF: {data_emissao_str}. Usando data atual.")
                     data_emissao = datetime.now()
             else:
                 data_emissao = datetime.now()
             
-            serie=extrair_valor(r"S[ée]rie\s*:?[\s]*([0-9]{1,3})", texto_completo,"SÉRIE 0")
-            nome_emitente=extrair_valor(r"(?:Emitente\s*:?[\s]*(.+)|recebemos\s+de\s+(.+?)\s+os\s+produtos)", texto_completo, "EMITENTE NÃO ENCONTRADO")
-            valor_total=extrair_valor(r"Valor\s+Total\s+(?:da\s+(?:Nota|nf-?e)|Nota)\s*(?:R\$)?\s*([\d\.,]+)", texto_completo, 0)
-            chave_acesso=extrair_valor(r"((?:\d{4}\s*){11})", texto_completo, "0000 0000 0000 0000 0000 0000 0000 0000 0000 0000 0000")
-            natureza_operacao=extrair_valor(r"^natureza\s+(?:da|de\s+)?opera[cç][aã]o$", texto_completo, "SEM NATUREZA")
+            serie=extrair_valor(_PDF_PATTERNS['serie'], texto_completo,"SÉRIE 0")
+            nome_emitente=extrair_valor(_PDF_PATTERNS['nome_emitente'], texto_completo, "EMITENTE NÃO ENCONTRADO", normalizar=True)
+            valor_total=extrair_valor(_PDF_PATTERNS['valor_total'], texto_completo, 0)
+            chave_acesso=extrair_valor(_PDF_PATTERNS['chave_acesso'], texto_completo, "0000 0000 0000 0000 0000 0000 0000 0000 0000 0000 0000", normalizar=True)
+            natureza_operacao=extrair_valor(_PDF_PATTERNS['natureza_operacao'], texto_completo, "SEM NATUREZA")
 
             # Cria o objeto NotaFiscal
 
@@ -102,18 +191,137 @@ class PDFExtractor:
             return None
 
 
+# --- Leitura da NF-e em uma única passada (iterparse) ---
+_NFE_NS = '{http://www.portalfiscal.inf.br/nfe}'
+
+# Seções lidas uma única vez (vale a primeira ocorrência dentro do infNFe) e seus campos
+_CAMPOS_SECOES_NFE = {
+    'ide': {'nNF': 'numero', 'serie': 'serie', 'dhEmi': 'data_emissao', 'natOp': 'natureza_operacao'},
+    'emit': {'CNPJ': 'cnpj_emitente', 'xNome': 'nome_emitente'},
+    'dest': {'CNPJ': 'cnpj_destinatario', 'xNome': 'nome_destinatario'},
+    'total': {},
+    'ICMSTot': {
+        'vNF': 'valor_total', 'vICMS': 'valor_icms', 'vIPI': 'valor_ipi',
+        'vPIS': 'valor_pis', 'vCOFINS': 'valor_cofins'
+    },
+}
+
+# Campos de cada item (det/prod)
+_CAMPOS_PROD_NFE = {
+    'cProd': 'codigo', 'xProd': 'descricao', 'NCM': 'ncm',
+    'qCom': 'quantidade', 'vUnCom': 'valor_unitario', 'vProd': 'valor_total'
+}
+
+# Tags que geram eventos no iterparse (com e sem namespace); o resto (impostos de cada
+# item, transporte, assinatura...) é percorrido pelo libxml2 sem passar pelo Python
+_TAGS_NFE = [
+    prefixo + local
+    for local in {'infNFe', 'det', 'prod', *_CAMPOS_SECOES_NFE, *_CAMPOS_PROD_NFE,
+                  *(campo for campos in _CAMPOS_SECOES_NFE.values() for campo in campos)}
+    for prefixo in (_NFE_NS, '')
+]
+
+def _ler_nfe(eventos) -> Optional[Dict[str, Any]]:
+    """
+    Lê os campos da NF-e consumindo os eventos do iterparse uma única vez
+
+    Cada elemento é descartado (clear) ao terminar, então a árvore nunca é
+    montada por inteiro. Vale a primeira ocorrência de cada seção/campo, como
+    nas buscas './/tag' usadas antes.
+
+    Args:
+        eventos: Iterador de (evento, elemento) de XMLSecurityValidator.iterparse_safely
+
+    Returns:
+        Dict com 'chave', 'campos' (texto bruto), 'secoes' (seção -> tem filhos),
+        'itens' e 'total_det', ou None se a estrutura não for de uma NF-e
+    """
+    raiz_verificada = False
+    prefixo = None            # Namespace do infNFe ('' quando o XML não usa namespace)
+    inf_nfe = None
+    inf_nfe_fechado = False
+    abertas = {}              # Seção -> elemento aberto
+    dados = {'chave': '', 'campos': {}, 'secoes': {}, 'itens': [], 'total_det': 0}
+    det_atual = prod_atual = item = None
+
+    for evento, elem in eventos:
+        tag = elem.tag
+
+        if not raiz_verificada:
+            raiz_verificada = True
+            tag_raiz = elem.getroottree().getroot().tag
+            if tag_raiz.rpartition('}')[2] not in ('nfeProc', 'NFe'):
+                logger.warning(f"XML rejeitado: não é uma estrutura de NF-e válida (tag: {tag_raiz})")
+                return None
+
+        # Fora do (primeiro) infNFe: só procurar o início dele
+        if inf_nfe is None or inf_nfe_fechado:
+            if evento == 'start':
+                if inf_nfe is None and tag in (_NFE_NS + 'infNFe', 'infNFe'):
+                    inf_nfe = elem
+                    prefixo = _NFE_NS if tag.startswith('{') else ''
+                    dados['chave'] = elem.get('Id', '')
+            else:
+                elem.clear()
+            continue
+
+        # Nome local, só para tags no mesmo namespace do infNFe
+        local = tag[len(prefixo):] if tag.startswith(prefixo) and '}' not in tag[len(prefixo):] else None
+
+        if evento == 'start':
+            if local in _CAMPOS_SECOES_NFE:
+                if local in dados['secoes'] or local in abertas:
+                    continue
+                if local == 'ICMSTot' and 'total' not in abertas:
+                    continue
+                abertas[local] = elem
+            elif local == 'det':
+                dados['total_det'] += 1
+                if det_atual is None and dados['total_det'] <= SecurityConfig.MAX_ITEMS_PER_NF:
+                    det_atual, item = elem, None
+            elif local == 'prod' and det_atual is not None and item is None:
+                prod_atual, item = elem, {}
+            continue
+
+        # evento == 'end'
+        if elem is inf_nfe:
+            inf_nfe_fechado = True
+        elif local is not None:
+            for secao in abertas:
+                campo = _CAMPOS_SECOES_NFE[secao].get(local)
+                if campo and campo not in dados['campos']:
+                    dados['campos'][campo] = elem.text or ""
+            if prod_atual is not None and local in _CAMPOS_PROD_NFE:
+                item.setdefault(_CAMPOS_PROD_NFE[local], elem.text or "")
+
+            if abertas.get(local) is elem:
+                dados['secoes'][local] = len(elem) > 0
+                del abertas[local]
+            elif elem is prod_atual:
+                prod_atual = None
+            elif elem is det_atual:
+                if item is not None:
+                    dados['itens'].append(item)
+                det_atual = item = None
+        elem.clear()
+
+    if inf_nfe is None:
+        logger.warning("XML rejeitado: elemento infNFe não encontrado")
+        return None
+    return dados
+
 class XMLExtractor:
     """Extrator seguro de dados XML com validação e sanitização"""
-    
+
     @staticmethod
     def extrair_dados_xml(xml_content: bytes, filename: str = "unknown") -> Optional['NotaFiscal']:
         """
-        Extrai dados de XML de forma segura usando defusedxml
-        
+        Extrai dados de XML de forma segura (lxml.iterparse, uma única passada)
+
         Args:
             xml_content: Conteúdo do arquivo XML em bytes
             filename: Nome do arquivo para auditoria
-            
+
         Returns:
             NotaFiscal ou None se houver erro
         """
@@ -122,25 +330,30 @@ class XMLExtractor:
             SecurityAuditor.log_file_processing(
                 filename, len(xml_content), "XML", False
             )
-            
-            # Parse seguro do XML
-            root = XMLSecurityValidator.parse_xml_safely(xml_content)
-            if root is None:
+
+            # Leitura segura do XML
+            eventos = XMLSecurityValidator.iterparse_safely(xml_content, _TAGS_NFE)
+            try:
+                dados = _ler_nfe(eventos) if eventos is not None else None
+            except (etree.XMLSyntaxError, ValueError) as e:
+                logger.error(f"Erro de parsing XML: {e}")
+                dados = None
+            if dados is None:
                 logger.error(f"Falha na validação de segurança do XML: {filename}")
                 return None
-            
+
             # Extrair dados com sanitização
-            nota_fiscal = XMLExtractor._extrair_dados_seguros(root, xml_content)
-            
+            nota_fiscal = XMLExtractor._extrair_dados_seguros(dados, xml_content)
+
             if nota_fiscal:
                 # Log de sucesso
                 SecurityAuditor.log_file_processing(
                     filename, len(xml_content), "XML", True
                 )
                 logger.info(f"XML processado com sucesso: {filename}")
-            
+
             return nota_fiscal
-            
+
         except Exception as e:
             logger.error(f"Erro crítico ao processar XML {filename}: {e}")
             SecurityAuditor.log_security_event(
@@ -149,72 +362,60 @@ class XMLExtractor:
                 "ERROR"
             )
             return None
-    
+
     @staticmethod
-    def _extrair_dados_seguros(root, xml_content: bytes) -> Optional['NotaFiscal']:
-        """Extrai dados do XML com sanitização completa"""
+    def _extrair_dados_seguros(dados: Dict[str, Any], xml_content: bytes) -> Optional['NotaFiscal']:
+        """Monta a NotaFiscal a partir dos campos lidos, com sanitização completa"""
         try:
-            # Definir namespaces
-            ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-            
-            # Buscar elemento principal
-            inf_nfe = root.find('.//nfe:infNFe', ns)
-            if inf_nfe is None:
-                inf_nfe = root.find('.//infNFe')
-                ns = {}
-            
-            if inf_nfe is None:
-                logger.warning("Elemento infNFe não encontrado no XML")
-                return None
-            
-            # Extrair elementos principais
-            ide = inf_nfe.find('.//ide' if not ns else './/nfe:ide', ns)
-            emit = inf_nfe.find('.//emit' if not ns else './/nfe:emit', ns)
-            dest = inf_nfe.find('.//dest' if not ns else './/nfe:dest', ns)
-            total = inf_nfe.find('.//total' if not ns else './/nfe:total', ns)
-            
-            if not all([ide, emit, total]):
+            secoes = dados['secoes']
+            campos = dados['campos']
+
+            # Seções obrigatórias presentes e com conteúdo
+            if not all(secoes.get(secao) for secao in ('ide', 'emit', 'total')):
                 logger.warning("Elementos obrigatórios não encontrados no XML")
                 return None
-            
-            icms_tot = total.find('.//ICMSTot' if not ns else './/nfe:ICMSTot', ns)
-            if icms_tot is None:
+
+            if 'ICMSTot' not in secoes:
                 logger.warning("Elemento ICMSTot não encontrado")
                 return None
-            
+
+            tem_dest = 'dest' in secoes
+
             # Extrair e sanitizar dados
-            numero = DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(ide, 'nNF', ns))
-            serie = DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(ide, 'serie', ns))
-            data_emissao = XMLExtractor._parse_date_safe(XMLExtractor._get_text_safe(ide, 'dhEmi', ns))
-            
+            numero = DataSanitizer.sanitize_string(campos.get('numero', ''))
+            serie = DataSanitizer.sanitize_string(campos.get('serie', ''))
+            data_emissao = XMLExtractor._parse_date_safe(campos.get('data_emissao', ''))
+
             # CNPJ com validação específica
-            cnpj_emitente = DataSanitizer.sanitize_cnpj(XMLExtractor._get_text_safe(emit, 'CNPJ', ns))
-            cnpj_destinatario = DataSanitizer.sanitize_cnpj(XMLExtractor._get_text_safe(dest, 'CNPJ', ns)) if dest is not None else None
-            
+            cnpj_emitente = DataSanitizer.sanitize_cnpj(campos.get('cnpj_emitente', ''))
+            cnpj_destinatario = DataSanitizer.sanitize_cnpj(campos.get('cnpj_destinatario', '')) if tem_dest else None
+
             # Nomes sanitizados
-            nome_emitente = DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(emit, 'xNome', ns))
-            nome_destinatario = DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(dest, 'xNome', ns)) if dest is not None else None
-            
+            nome_emitente = DataSanitizer.sanitize_string(campos.get('nome_emitente', ''))
+            nome_destinatario = DataSanitizer.sanitize_string(campos.get('nome_destinatario', '')) if tem_dest else None
+
             # Valores numéricos sanitizados
-            valor_total = DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(icms_tot, 'vNF', ns))
-            valor_icms = DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(icms_tot, 'vICMS', ns))
-            valor_ipi = DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(icms_tot, 'vIPI', ns))
-            valor_pis = DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(icms_tot, 'vPIS', ns))
-            valor_cofins = DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(icms_tot, 'vCOFINS', ns))
-            
+            valor_total = DataSanitizer.sanitize_numeric_value(campos.get('valor_total', ''))
+            valor_icms = DataSanitizer.sanitize_numeric_value(campos.get('valor_icms', ''))
+            valor_ipi = DataSanitizer.sanitize_numeric_value(campos.get('valor_ipi', ''))
+            valor_pis = DataSanitizer.sanitize_numeric_value(campos.get('valor_pis', ''))
+            valor_cofins = DataSanitizer.sanitize_numeric_value(campos.get('valor_cofins', ''))
+
             # Chave de acesso com validação
-            chave_acesso_raw = inf_nfe.get('Id', '').replace('NFe', '')
+            chave_acesso_raw = dados['chave'].replace('NFe', '')
             chave_acesso = DataSanitizer.sanitize_chave_acesso(chave_acesso_raw)
-            
+
             # Natureza da operação
-            natureza_operacao = DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(ide, 'natOp', ns))
-            
-            # Extrair itens com limite de segurança
-            itens = XMLExtractor._extrair_itens_seguros(inf_nfe, ns)
-            
-            # XML original sanitizado (apenas para auditoria, limitado)
-            xml_string = xml_content.decode('utf-8', errors='replace')[:10000]  # Limitar tamanho
-            
+            natureza_operacao = DataSanitizer.sanitize_string(campos.get('natureza_operacao', ''))
+
+            # Itens (já limitados a MAX_ITEMS_PER_NF durante a leitura)
+            if dados['total_det'] > SecurityConfig.MAX_ITEMS_PER_NF:
+                logger.warning(f"NF com muitos itens ({dados['total_det']}), limitando a {SecurityConfig.MAX_ITEMS_PER_NF}")
+            itens = XMLExtractor._sanitizar_itens(dados['itens'])
+
+            # XML original em bytes (coluna BYTEA, apenas para auditoria, limitado)
+            xml_bruto = xml_content[:10000]  # Limitar tamanho
+
             return NotaFiscal(
                 numero=numero,
                 serie=serie,
@@ -231,25 +432,13 @@ class XMLExtractor:
                 chave_acesso=chave_acesso,
                 natureza_operacao=natureza_operacao,
                 itens=itens,
-                xml_original=xml_string
+                xml_original=xml_bruto
             )
-            
+
         except Exception as e:
             logger.error(f"Erro na extração segura de dados: {e}")
             return None
-    
-    @staticmethod
-    def _get_text_safe(element, tag: str, ns: dict) -> str:
-        """Extrai texto de elemento XML de forma segura"""
-        if element is None:
-            return ""
-        
-        try:
-            node = element.find(f".//nfe:{tag}", ns) if ns else element.find(f".//{tag}")
-            return node.text if node is not None and node.text else ""
-        except Exception:
-            return ""
-    
+
     @staticmethod
     def _parse_date_safe(date_str: str) -> Optional[datetime]:
         """Parse seguro de data"""
@@ -259,43 +448,39 @@ class XMLExtractor:
         try:
             # Sanitizar string de data
             date_clean = DataSanitizer.sanitize_string(date_str)
+            # Caso comum (AAAA-MM-DD ou AAAA-MM-DDThh:mm...): sem split nem fromisoformat
+            m = _RE_DATA_ISO_XML.match(date_clean)
+            if m:
+                return datetime(int(m[1]), int(m[2]), int(m[3]))
             return datetime.fromisoformat(date_clean.split('T')[0])
         except Exception:
             logger.warning(f"Data inválida: {date_str}")
             return None
-    
+
     @staticmethod
-    def _extrair_itens_seguros(inf_nfe, ns: dict) -> List[Dict[str, Any]]:
-        """Extrai itens da NF com limite de segurança"""
-        itens = []
-        
+    def _sanitizar_itens(itens_brutos: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Sanitiza os itens lidos do XML"""
         try:
-            det_elements = inf_nfe.findall('.//nfe:det', ns) if ns else inf_nfe.findall('.//det')
-            
-            # Limitar número de itens por segurança
-            if len(det_elements) > SecurityConfig.MAX_ITEMS_PER_NF:
-                logger.warning(f"NF com muitos itens ({len(det_elements)}), limitando a {SecurityConfig.MAX_ITEMS_PER_NF}")
-                det_elements = det_elements[:SecurityConfig.MAX_ITEMS_PER_NF]
-            
-            for det in det_elements:
-                prod = det.find('.//nfe:prod', ns) if ns else det.find('.//prod')
-                if prod is not None:
-                    item = {
-                        'codigo': DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(prod, 'cProd', ns)),
-                        'descricao': DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(prod, 'xProd', ns)),
-                        'ncm': DataSanitizer.sanitize_string(XMLExtractor._get_text_safe(prod, 'NCM', ns)),
-                        'quantidade': DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(prod, 'qCom', ns)),
-                        'valor_unitario': DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(prod, 'vUnCom', ns)),
-                        'valor_total': DataSanitizer.sanitize_numeric_value(XMLExtractor._get_text_safe(prod, 'vProd', ns))
-                    }
-                    itens.append(item)
-            
-            return itens
-            
+            return [
+                {
+                    'codigo': DataSanitizer.sanitize_string(item.get('codigo', '')),
+                    'descricao': DataSanitizer.sanitize_string(item.get('descricao', '')),
+                    'ncm': DataSanitizer.sanitize_string(item.get('ncm', '')),
+                    'quantidade': DataSanitizer.sanitize_numeric_value(item.get('quantidade', '')),
+                    'valor_unitario': DataSanitizer.sanitize_numeric_value(item.get('valor_unitario', '')),
+                    'valor_total': DataSanitizer.sanitize_numeric_value(item.get('valor_total', ''))
+                }
+                for item in itens_brutos
+            ]
+
         except Exception as e:
             logger.error(f"Erro ao extrair itens: {e}")
             return []
 
+# Pesos dos dígitos verificadores do CNPJ (módulo 11)
+_CNPJ_PESOS_1 = (5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_CNPJ_PESOS_2 = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+
 class ValidadorNF:
     """Validador seguro de Notas Fiscais com verificações rigorosas"""
     
@@ -391,7 +576,7 @@ class ValidadorNF:
             return False
         
         # Remover formatação
-        cnpj_numeros = re.sub(r'[^\d]', '', cnpj)
+        cnpj_numeros = somente_digitos(cnpj)
         
         # Verificar tamanho
         if len(cnpj_numeros) != 14:
@@ -408,34 +593,20 @@ class ValidadorNF:
     def _calcular_digito_cnpj(cnpj: str) -> bool:
         """Calcula e valida dígitos verificadores do CNPJ"""
         try:
+            digitos = list(map(int, cnpj))
+            
             # Primeiro dígito
-            soma = 0
-            peso = 5
-            for i in range(12):
-                soma += int(cnpj[i]) * peso
-                peso -= 1
-                if peso < 2:
-                    peso = 9
-            
-            resto = soma % 11
+            resto = sum(map(int.__mul__, digitos, _CNPJ_PESOS_1)) % 11
             digito1 = 0 if resto < 2 else 11 - resto
             
-            if int(cnpj[12]) != digito1:
+            if digitos[12] != digito1:
                 return False
             
             # Segundo dígito
-            soma = 0
-            peso = 6
-            for i in range(13):
-                soma += int(cnpj[i]) * peso
-                peso -= 1
-                if peso < 2:
-                    peso = 9
-            
-            resto = soma % 11
+            resto = sum(map(int.__mul__, digitos, _CNPJ_PESOS_2)) % 11
             digito2 = 0 if resto < 2 else 11 - resto
             
-            return int(cnpj[13]) == digito2
+            return digitos[13] == digito2
             
         except (ValueError, IndexError):
             return False
@@ -447,7 +618,7 @@ class ValidadorNF:
             return False
         
         # Remover prefixos e caracteres não numéricos
-        chave_limpa = re.sub(r'[^\d]', '', chave.replace('NFe', ''))
+        chave_limpa = somente_digitos(chave.replace('NFe', ''))
         
         # Verificar tamanho
         if len(chave_limpa) != 44:
@@ -556,7 +727,8 @@ class ValidadorNF:
 # Configuração movida para secure_config.py para melhor segurança
 from secure_config import get_secure_config, SecureConfigError
 
-@dataclass
+# slots=True: sem __dict__ por instância (menos memória em lotes grandes, acesso direto aos campos)
+@dataclass(slots=True)
 class NotaFiscal:
     numero: str
     serie: str
@@ -575,8 +747,9 @@ class NotaFiscal:
     valor_pis: float = 0.0
     valor_cofins: float = 0.0
     itens: List[Dict[str, Any]] = None
-    xml_original: Optional[str] = None
+    xml_original: Optional[bytes] = None
     processado_em: datetime = None
+    origem: str = 'upload'  # 'email' ou 'upload'
 
     def __post_init__(self):
         if self.processado_em is None:
@@ -584,9 +757,412 @@ class NotaFiscal:
         if self.itens is None:
             self.itens = []
 
+# --- EXTRAÇÃO EM PARALELO (PDF/XML) ---
+
+def _extrair_arquivo(payload: Tuple[str, bytes]) -> Optional[Dict[str, Any]]:
+    """
+    Extrai uma nota de um arquivo PDF/XML (executado em processo separado)
+
+    Returns:
+        asdict(NotaFiscal) ou None se a extração falhar
+    """
+    nome, conteudo = payload
+    try:
+        if nome.lower().endswith('.pdf'):
+            nota = PDFExtractor.extrair_dados_pdf(conteudo)
+        else:
+            nota = XMLExtractor.extrair_dados_xml(conteudo, nome)
+    except Exception as e:
+        logger.error(f"Erro ao extrair {nome}: {e}")
+        return None
+    return asdict(nota) if nota else None
+
+def extrair_arquivos_paralelo(arquivos: Iterable[Tuple[str, bytes]]) -> Iterator[Tuple[str, Optional['NotaFiscal']]]:
+    """
+    Extrai várias notas PDF/XML distribuindo os arquivos entre processos
+
+    A extração é CPU-bound (pdfplumber/parse do XML em Python); a gravação
+    no banco continua no processo principal. Os arquivos são consumidos em
+    janelas de tamanho fixo, então só uma janela de conteúdos fica em memória
+    por vez (o iterável pode ler as entradas de um ZIP sob demanda).
+
+    Args:
+        arquivos: Iterável de (nome do arquivo, conteúdo em bytes)
+
+    Returns:
+        Iterador de (nome do arquivo, NotaFiscal ou None), na mesma ordem de 'arquivos'
+    """
+    max_workers = os.cpu_count() or 1
+    tamanho_janela = max_workers * 16
+    pendentes = iter(arquivos)
+    executor = None
+    em_serie = False
+    try:
+        while True:
+            janela = list(islice(pendentes, tamanho_janela))
+            if not janela:
+                break
+            
+            dados = None
+            if not em_serie and (executor is not None or len(janela) > 1):
+                try:
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=min(max_workers, len(janela)))
+                    dados = list(executor.map(_extrair_arquivo, janela, chunksize=8))
+                except Exception as e:
+                    # Pool indisponível (ambiente sem fork, processo filho abortado...): extrair em série
+                    logger.warning(f"Extração paralela indisponível ({e}); processando em série")
+                    if executor is not None:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        executor = None
+                    em_serie = True
+            if dados is None:
+                dados = [_extrair_arquivo(arquivo) for arquivo in janela]
+            
+            for (nome, _), dado in zip(janela, dados):
+                yield nome, NotaFiscal(**dado) if dado else None
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+# --- LEITURA DE CSV ---
+
+# Delimitadores aceitos, em ordem de preferência
+_DELIMITADORES_CSV = (';', ',', '\t', '|')
+
+def ler_csv(conteudo) -> Optional[pd.DataFrame]:
+    """
+    Lê um CSV enviado pelo usuário com uma única passada do parser
+
+    O delimitador é o primeiro de _DELIMITADORES_CSV presente na linha de cabeçalho
+    (mesma preferência das tentativas com cada delimitador feitas antes); a decodificação
+    fica com o próprio pandas, em UTF-8 e com latin-1 como alternativa.
+
+    Args:
+        conteudo: Bytes do arquivo ou arquivo binário com seek (ex.: entrada aberta de um ZIP),
+            lido direto pelo pandas sem cópia intermediária em bytes
+
+    Returns:
+        DataFrame ou None se o arquivo não puder ser lido
+    """
+    if isinstance(conteudo, (bytes, bytearray)):
+        conteudo = io.BytesIO(conteudo)
+    inicio = conteudo.read(65536)
+    amostra = inicio.decode('utf-8', errors='replace')
+    cabecalho = amostra.splitlines()[0] if amostra else ''
+    delimitador = next((d for d in _DELIMITADORES_CSV if d in cabecalho), _DELIMITADORES_CSV[0])
+    
+    for codificacao in ('utf-8', 'latin-1'):
+        try:
+            conteudo.seek(0)
+            return pd.read_csv(conteudo, sep=delimitador, encoding=codificacao, on_bad_lines='skip')
+        except UnicodeDecodeError:
+            continue
+        except Exception as e:
+            logger.warning(f"Erro ao ler CSV com delimitador '{delimitador}': {e}")
+            return None
+    return None
+
+# Palavras no nome do arquivo que identificam os CSVs de cabeçalho e de itens
+_PALAVRAS_CABECALHO = ('cabecalho', 'header')
+_PALAVRAS_ITENS = ('itens', 'items')
+
+def ordenar_arquivos_zip(nomes: Iterable[str]) -> Tuple[List[str], str]:
+    """
+    Classifica as entradas de um ZIP e define a ordem de processamento
+
+    Cabeçalhos primeiro, depois os demais arquivos e por último os itens (que
+    dependem das notas já gravadas). Diretórios são ignorados.
+
+    Returns:
+        (nomes na ordem de processamento, resumo em markdown para uma única mensagem)
+    """
+    cabecalhos, itens, outros = [], [], []
+    for nome in nomes:
+        if nome.endswith('/'):
+            continue
+        nome_lower = nome.lower()
+        if any(palavra in nome_lower for palavra in _PALAVRAS_CABECALHO):
+            cabecalhos.append(nome)
+        elif any(palavra in nome_lower for palavra in _PALAVRAS_ITENS):
+            itens.append(nome)
+        else:
+            outros.append(nome)
+    
+    linhas = ["🔍 **ANÁLISE DOS ARQUIVOS NO ZIP:**"]
+    linhas += [f"- 📋 CABEÇALHO identificado: {nome}" for nome in cabecalhos]
+    linhas += [f"- 📦 ITENS identificado: {nome}" for nome in itens]
+    linhas += [f"- 📄 OUTRO arquivo: {nome}" for nome in outros]
+    linhas += [
+        "",
+        "✅ **ORDEM DE PROCESSAMENTO DEFINIDA:**",
+        f"1º → {len(cabecalhos)} arquivo(s) de cabeçalho  ",
+        f"2º → {len(outros)} outro(s) arquivo(s)  ",
+        f"3º → {len(itens)} arquivo(s) de itens",
+    ]
+    return cabecalhos + outros + itens, "\n".join(linhas)
+
+# Colunas do CSV de cabeçalho: campo -> nomes aceitos (comparação exata, em ordem de preferência)
+_COLUNAS_CSV_CABECALHO = {
+    'numero': ['numero', 'NÚMERO', 'nf_numero', 'numero_nf', 'num_nf', 'NF_NUMERO'],
+    'serie': ['serie', 'SÉRIE', 'serie_nf', 'nf_serie', 'SERIE_NF'],
+    'cnpj_emitente': ['cnpj_emitente', 'CNPJ_EMITENTE', 'cnpj_emit', 'emitente_cnpj', 'CPF/CNPJ Emitente'],
+    'nome_emitente': ['nome_emitente', 'NOME_EMITENTE', 'razao_emitente', 'emitente_nome', 'NOME EMITENTE', 'RAZÃO SOCIAL EMITENTE'],
+    'data_emissao': ['data_emissao', 'DATA_EMISSAO', 'dt_emissao', 'data_emiss', 'DATA EMISSÃO'],
+    'valor_total': ['valor_total', 'VALOR_TOTAL', 'vl_total', 'total_nf', 'VALOR NOTA FISCAL'],
+    'chave_acesso': ['chave_acesso', 'CHAVE_ACESSO', 'chave_nfe', 'chave', 'CHAVE DE ACESSO'],
+    'natureza_operacao': ['natureza_operacao', 'NATUREZA_OPERACAO', 'nat_operacao', 'cfop', 'NATUREZA DA OPERAÇÃO']
+}
+
+# Colunas do CSV de itens: campo -> sinônimos já normalizados (ver normalizar_nome_coluna)
+_SINONIMOS_CSV_ITENS = {
+    'numero_nf': [
+        'numero_nf', 'numero', 'nf_numero', 'numero_nota_fiscal', 'num_nf', 'numero_da_nota_fiscal'
+    ],
+    'codigo_produto': [
+        'codigo_produto', 'codigo', 'cod_produto', 'cprod', 'numero_produto', 'num_produto',
+        'codigo_item', 'codigo_do_produto', 'numero_do_produto'
+    ],
+    'descricao': [
+        'descricao', 'descricao_produto', 'xprod', 'produto', 'descricao_do_produto',
+        'descricao_do_item', 'descricao_item', 'item_descricao', 'descricao_prod',
+        'descricao_do_produto_servico', 'descricao_produto_servico', 'produto_servico'
+    ],
+    'ncm': [
+        'ncm', 'codigo_ncm', 'codigo_ncm_sh', 'codigo_ncmsh', 'ncm_sh', 'ncmsh', 'codigo_ncm_sh'
+    ],
+    'quantidade': [
+        'quantidade', 'qtd', 'qtde', 'qcom', 'quantidade_item'
+    ],
+    'valor_unitario': [
+        'valor_unitario', 'vl_unitario', 'preco_unitario', 'vuncom', 'valor_unitario_item', 'preco_unitario_item'
+    ],
+    'valor_total': [
+        'valor_total', 'vl_total', 'total_item', 'vprod', 'valor_total_item'
+    ]
+}
+
+def _indice_colunas(mapeamento: Dict[str, List[str]]) -> Dict[str, Tuple[str, int]]:
+    """Inverte um mapeamento campo -> nomes em nome -> (campo, posição de preferência)"""
+    indice = {}
+    for campo, nomes in mapeamento.items():
+        for posicao, nome in enumerate(nomes):
+            indice.setdefault(nome, (campo, posicao))  # Nome repetido: vale a primeira ocorrência
+    return indice
+
+_INDICE_CSV_CABECALHO = _indice_colunas(_COLUNAS_CSV_CABECALHO)
+_INDICE_CSV_ITENS = _indice_colunas(_SINONIMOS_CSV_ITENS)
+
+@functools.lru_cache(maxsize=4096)
+def normalizar_nome_coluna(nome) -> str:
+    """Normaliza o nome de uma coluna (sem acentos, minúsculo, separadores viram '_')"""
+    try:
+        if not isinstance(nome, str):
+            nome = str(nome)
+        # Remover acentos (nomes só com ASCII, o caso comum, não têm o que remover)
+        if nome.isascii():
+            nome_sem_acentos = nome
+        else:
+            nome_sem_acentos = ''.join(
+                c for c in unicodedata.normalize('NFKD', nome)
+                if not unicodedata.combining(c)
+            )
+        # Lowercase e substituir separadores por underscore
+        nome_sem_acentos = nome_sem_acentos.lower()
+        nome_sem_acentos = nome_sem_acentos.replace('/', ' ').replace('-', ' ').replace('.', ' ').replace(':', ' ')
+        nome_sem_acentos = _RE_WHITESPACE.sub(' ', nome_sem_acentos).strip()
+        nome_sem_acentos = nome_sem_acentos.replace(' ', '_')
+        return nome_sem_acentos
+    except Exception:
+        return str(nome).lower()
+
+def _mapear_colunas(colunas: Iterable, indice: Dict[str, Tuple[str, int]], normalizar=None) -> Dict[str, str]:
+    """
+    Associa cada campo à coluna do CSV com o nome preferido, em uma passada pelas colunas
+
+    Args:
+        colunas: Nomes das colunas do DataFrame
+        indice: Tabela nome -> (campo, posição) de _indice_colunas
+        normalizar: Função aplicada ao nome da coluna antes da busca (None = nome exato)
+
+    Returns:
+        Dict campo -> nome original da coluna
+    """
+    preferencia = {}
+    encontradas = {}
+    for coluna in colunas:
+        entrada = indice.get(normalizar(coluna) if normalizar else coluna)
+        if entrada is None:
+            continue
+        campo, posicao = entrada
+        # Na mesma posição vale a última coluna, como no mapa {normalizado: coluna} usado antes
+        if campo not in preferencia or posicao <= preferencia[campo]:
+            preferencia[campo] = posicao
+            encontradas[campo] = coluna
+    return encontradas
+
+def mapear_colunas_cabecalho(colunas: Iterable) -> Dict[str, str]:
+    """Campos do CSV de cabeçalho -> colunas (nomes exatos de _COLUNAS_CSV_CABECALHO)"""
+    return _mapear_colunas(colunas, _INDICE_CSV_CABECALHO)
+
+def mapear_colunas_itens(colunas: Iterable) -> Dict[str, str]:
+    """Campos do CSV de itens -> colunas (nomes normalizados de _SINONIMOS_CSV_ITENS)"""
+    return _mapear_colunas(colunas, _INDICE_CSV_ITENS, normalizar_nome_coluna)
+
+def datas_csv(serie: pd.Series, padrao: datetime) -> List[datetime]:
+    """
+    Converte uma coluna de datas de CSV de uma vez (dd/mm/aaaa se houver '/', senão aaaa-mm-dd se houver '-')
+
+    Mesmas regras de converter_data_br/converter_data_iso aplicadas linha a linha;
+    datas inválidas ou em outro formato viram o padrão.
+    """
+    datas_str = serie.astype(str)
+    formato_br = datas_str.str.contains('/', regex=False)
+    formato_iso = ~formato_br & datas_str.str.contains('-', regex=False)
+    datas = pd.Series(pd.NaT, index=serie.index, dtype='datetime64[ns]')
+    datas.loc[formato_br] = pd.to_datetime(datas_str[formato_br], format='%d/%m/%Y', errors='coerce')
+    datas.loc[formato_iso] = pd.to_datetime(datas_str[formato_iso], format='%Y-%m-%d', errors='coerce')
+    invalidas = int(((formato_br | formato_iso) & datas.isna()).sum())
+    if invalidas:
+        logger.warning("%d data(s) de emissão em formato inválido no CSV", invalidas)
+    return [padrao if data is pd.NaT else data.to_pydatetime() for data in datas]
+
+def notas_de_csv_cabecalho(df: pd.DataFrame, colunas: Dict[str, str]) -> List['NotaFiscal']:
+    """
+    Converte as linhas de um CSV de cabeçalho em NotaFiscal (conversões por coluna, sem iterrows)
+
+    Datas em dd/mm/aaaa ou aaaa-mm-dd (inválidas ou ausentes viram a data atual);
+    valores com vírgula ou ponto decimal (inválidos viram 0).
+
+    Args:
+        df: DataFrame lido do CSV
+        colunas: Campo da NotaFiscal -> nome da coluna correspondente no CSV
+
+    Returns:
+        Lista de NotaFiscal, na ordem das linhas
+    """
+    agora = datetime.now()
+    
+    def texto(campo: str, padrao: str) -> List[str]:
+        if campo in colunas:
+            return df[colunas[campo]].astype(str).tolist()
+        return [padrao] * len(df)
+    
+    datas_emissao = [agora] * len(df)
+    if 'data_emissao' in colunas:
+        datas_emissao = datas_csv(df[colunas['data_emissao']], agora)
+    
+    valores = [0.0] * len(df)
+    if 'valor_total' in colunas:
+        valores = pd.to_numeric(
+            df[colunas['valor_total']].astype(str).str.replace(',', '.', regex=False), errors='coerce'
+        ).fillna(0.0).astype('float64').tolist()
+    
+    return [
+        NotaFiscal(
+            numero=numero,
+            serie=serie,
+            cnpj_emitente=cnpj_emitente,
+            nome_emitente=nome_emitente,
+            data_emissao=data_emissao,
+            valor_total=valor_total,
+            chave_acesso=chave_acesso,
+            natureza_operacao=natureza_operacao
+        )
+        for numero, serie, cnpj_emitente, nome_emitente, data_emissao, valor_total, chave_acesso, natureza_operacao
+        in zip(
+            texto('numero', ''), texto('serie', '1'), texto('cnpj_emitente', ''), texto('nome_emitente', ''),
+            datas_emissao, valores, texto('chave_acesso', ''), texto('natureza_operacao', '')
+        )
+    ]
+
+def valores_numericos_csv(serie: pd.Series) -> pd.Series:
+    """
+    Converte uma coluna de valores de CSV em float64, de uma vez
+
+    Remove o que não for dígito, vírgula, ponto ou sinal; com vírgula e ponto, o ponto
+    é milhar e a vírgula decimal. Vazios e valores inválidos viram 0.
+    """
+    texto = serie.astype(str).str.strip()
+    limpo = texto.str.replace(_RE_NAO_NUMERICO_CSV, '', regex=True)
+    com_milhar = limpo.str.contains(',', regex=False) & limpo.str.contains('.', regex=False)
+    limpo = limpo.mask(com_milhar, limpo.str.replace('.', '', regex=False))
+    valores = pd.to_numeric(limpo.str.replace(',', '.', regex=False), errors='coerce')
+    
+    vazios = serie.isna() | (texto == '')
+    invalidos = int((valores.isna() & ~vazios).sum())
+    if invalidos:
+        logger.warning("%d valor(es) numérico(s) inválido(s) na coluna '%s' do CSV; usando 0", invalidos, serie.name)
+    return valores.fillna(0.0)
+
 # --- MÓDULO DE BANCO DE DADOS ---
 
-class DatabaseManager:
+class _LeitorCsv:
+    """
+    Arquivo somente leitura que gera linhas CSV sob demanda (entrada de COPY ... FROM STDIN)
+
+    Só o trecho pedido por read() é montado de cada vez, então a memória não cresce
+    com a quantidade de linhas. None sai como \\N (o NULL do COPY, ver _COPY_ITENS).
+    """
+
+    def __init__(self, linhas: Iterable[Tuple]):
+        self._linhas = iter(linhas)
+        self._buffer = io.StringIO()
+        self._escritor = csv.writer(self._buffer, lineterminator='\n')
+
+    def read(self, tamanho: int = -1) -> str:
+        while tamanho < 0 or self._buffer.tell() < tamanho:
+            linha = next(self._linhas, None)
+            if linha is None:
+                break
+            self._escritor.writerow(['\\N' if valor is None else valor for valor in linha])
+        dados = self._buffer.getvalue()
+        if tamanho >= 0 and len(dados) > tamanho:
+            dados, resto = dados[:tamanho], dados[tamanho:]
+        else:
+            resto = ''
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(resto)
+        return dados
+
+class ConsultasNotasFiscais:
+    """
+    Consultas de notas fiscais comuns aos DatabaseManager deste módulo e de nf_processor_with_auth
+
+    Requer o atributo engine na classe que a herda.
+    """
+
+    def existe_nota_fiscal(self) -> bool:
+        """Indica se há ao menos uma nota fiscal (EXISTS para na primeira linha, ao contrário de COUNT(*))"""
+        with self.engine.connect() as connection:
+            return bool(connection.execute(text("SELECT EXISTS (SELECT 1 FROM notas_fiscais)")).scalar())
+
+    _SELECT_IDS_POR_NUMERO = text(
+        "SELECT numero, MIN(id) FROM notas_fiscais WHERE numero IN :numeros GROUP BY numero"
+    ).bindparams(bindparam('numeros', expanding=True))
+    # Números por consulta no IN (mantém a quantidade de parâmetros limitada)
+    LOTE_NUMEROS_NF = 1000
+
+    def ids_notas_por_numero(self, numeros: Iterable[str]) -> Dict[str, int]:
+        """
+        Busca de uma vez os IDs das notas fiscais com os números informados
+
+        Substitui uma chamada de buscar_nota_fiscal_por_numero por linha. Para números
+        repetidos no banco vale o menor ID. Números sem nota ficam fora do dict.
+        """
+        numeros = list(dict.fromkeys(numeros))
+        ids = {}
+        try:
+            with self.engine.connect() as connection:
+                for i in range(0, len(numeros), self.LOTE_NUMEROS_NF):
+                    lote = numeros[i:i + self.LOTE_NUMEROS_NF]
+                    ids.update(connection.execute(self._SELECT_IDS_POR_NUMERO, {'numeros': lote}).all())
+        except Exception as e:
+            logger.error(f"Erro ao buscar notas fiscais por número: {e}")
+        return ids
+
+class DatabaseManager(ConsultasNotasFiscais):
     def __init__(self, secure_config=None):
         try:
             if secure_config is None:
@@ -596,6 +1172,8 @@ class DatabaseManager:
                 raise ValueError("A URL do banco de dados (DATABASE_URL) não foi configurada.")
             
             # Configurar parâmetros de conexão baseado no tipo de banco
+            # (json_serializer só atua em colunas sqlalchemy.JSON; as gravações aqui usam text()
+            # com parâmetros simples, então trocar o serializador não altera o custo de gravação)
             if secure_config.DATABASE_URL.startswith('sqlite'):
                 # SQLite não suporta connect_timeout, usar check_same_thread=False
                 connect_args = {'check_same_thread': False}
@@ -607,6 +1185,11 @@ class DatabaseManager:
             else:
                 # PostgreSQL e outros bancos suportam connect_timeout
                 connect_args = {'connect_timeout': 10}
+                opcoes_engine = {}
+                if make_url(secure_config.DATABASE_URL).get_driver_name() == 'psycopg2':
+                    # executemany de text() (ex.: cabeçalhos em lote) via execute_batch, não um comando por linha
+                    opcoes_engine['executemany_mode'] = 'values_plus_batch'
+                    opcoes_engine['executemany_batch_page_size'] = 500
                 self.engine = create_engine(
                     secure_config.DATABASE_URL,
                     connect_args=connect_args,
@@ -614,7 +1197,9 @@ class DatabaseManager:
                     pool_pre_ping=True,  # Verifica conexões antes de usar
                     pool_recycle=3600,   # Recicla conexões a cada hora
                     max_overflow=0,      # Limita conexões extras
-                    pool_size=5          # Pool de conexões limitado
+                    pool_size=5,         # Pool de conexões limitado
+                    insertmanyvalues_page_size=1000,  # Linhas por INSERT ... VALUES em lote
+                    **opcoes_engine
                 )
             
             # Teste de conexão seguro
@@ -655,10 +1240,87 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Falha GRAVE ao registrar log no banco de dados: {e}")
 
-    def salvar_nota_fiscal(self, nota: NotaFiscal) -> bool:
-        logger.info(f"🔍 INICIANDO SALVAMENTO DA NOTA: {nota.numero}")
-        logger.info(f"📋 DADOS RECEBIDOS: numero={nota.numero}, serie={getattr(nota, 'serie', 'N/A')}, cnpj_emitente={nota.cnpj_emitente}, chave_acesso={getattr(nota, 'chave_acesso', 'N/A')}")
-        
+    # Instruções montadas uma única vez e reutilizadas em todas as gravações
+    # (sem reprocessar o SQL a cada nota; a forma compilada fica no cache da engine)
+    _INSERT_NF_SQL = """
+        INSERT INTO notas_fiscais (
+            numero, serie, data_emissao, cnpj_emitente, nome_emitente, 
+            valor_total, chave_acesso, natureza_operacao, situacao, 
+            data_vencimento, cnpj_destinatario, nome_destinatario, 
+            valor_icms, valor_ipi, valor_pis, valor_cofins, 
+            xml_original, processado_em, origem
+        ) VALUES (
+            :numero, :serie, :data_emissao, :cnpj_emitente, :nome_emitente,
+            :valor_total, :chave_acesso, :natureza_operacao, :situacao,
+            :data_vencimento, :cnpj_destinatario, :nome_destinatario,
+            :valor_icms, :valor_ipi, :valor_pis, :valor_cofins,
+            :xml_original, :processado_em, :origem
+        )
+    """
+    _INSERT_NF = text(_INSERT_NF_SQL)
+    _INSERT_NF_RETURNING = text(_INSERT_NF_SQL + " RETURNING id")
+    # Com índice único em chave_acesso: duplicidade resolvida pelo próprio INSERT (sem SELECT prévio)
+    _INSERT_NF_SEM_DUPLICAR = text(_INSERT_NF_SQL + " ON CONFLICT (chave_acesso) DO NOTHING RETURNING id")
+
+    # INSERT do Core (não text()): com lista de parâmetros o SQLAlchemy agrupa as linhas
+    # em INSERT ... VALUES (...), (...) ("insertmanyvalues"), em vez de um comando por item
+    _INSERT_ITEM = insert(
+        table(
+            'itens_nota_fiscal',
+            column('nota_fiscal_id'), column('codigo'), column('descricao'), column('ncm'),
+            column('quantidade'), column('valor_unitario'), column('valor_total')
+        )
+    ).values(
+        nota_fiscal_id=bindparam('nota_id'),
+        codigo=bindparam('codigo'),
+        descricao=bindparam('descricao'),
+        ncm=bindparam('ncm'),
+        quantidade=bindparam('quantidade'),
+        valor_unitario=bindparam('valor_unitario'),
+        valor_total=bindparam('valor_total')
+    )
+
+    _SELECT_ID_POR_CHAVE = text("SELECT id FROM notas_fiscais WHERE chave_acesso = :chave")
+    _SELECT_CHAVES = text(
+        "SELECT chave_acesso FROM notas_fiscais WHERE chave_acesso IN :chaves"
+    ).bindparams(bindparam('chaves', expanding=True))
+    _SELECT_IDS_POR_CHAVES = text(
+        "SELECT id, chave_acesso FROM notas_fiscais WHERE chave_acesso IN :chaves"
+    ).bindparams(bindparam('chaves', expanding=True))
+
+    # Preenchido nas gravações (ver _chave_acesso_unica)
+    _chave_unica: Optional[bool] = None
+    _chave_unica_verificada_em = 0.0
+    # Sem o índice, nova verificação a cada 5 minutos: a migração 0003 pode criá-lo com o app no ar
+    INTERVALO_VERIFICACAO_CHAVE = 300
+
+    def _chave_acesso_unica(self) -> bool:
+        """
+        Indica se notas_fiscais.chave_acesso tem índice/constraint único
+
+        Uma vez encontrado, o resultado fica fixo; enquanto não existir, é consultado
+        de novo a cada INTERVALO_VERIFICACAO_CHAVE segundos (sem reiniciar o processo).
+        """
+        if not self._chave_unica and time.monotonic() - self._chave_unica_verificada_em >= self.INTERVALO_VERIFICACAO_CHAVE:
+            self._chave_unica_verificada_em = time.monotonic()
+            try:
+                inspetor = inspect(self.engine)
+                unicos = [c['column_names'] for c in inspetor.get_unique_constraints('notas_fiscais')]
+                unicos += [i['column_names'] for i in inspetor.get_indexes('notas_fiscais') if i.get('unique')]
+                self._chave_unica = ['chave_acesso'] in unicos
+            except (exc.SQLAlchemyError, NotImplementedError) as e:
+                logger.warning("Não foi possível verificar o índice único de chave_acesso: %s", e)
+                self._chave_unica = False
+        return self._chave_unica
+
+    @staticmethod
+    def _preparar_nota(nota: NotaFiscal):
+        """
+        Normaliza uma nota para inserção
+
+        Returns:
+            Tupla (dados da nota, lista de itens sem 'nota_id')
+        """
         # Garantir que campos obrigatórios tenham valores válidos
         numero = nota.numero or f"NF-{datetime.now().strftime('%Y%m%d%H%M%S')}"
         serie = getattr(nota, 'serie', None) or '1'
@@ -669,18 +1331,6 @@ class DatabaseManager:
         if len(chave_acesso) > 60:
             chave_acesso = chave_acesso[:60]
         
-        logger.info(f"✅ CAMPOS VALIDADOS: numero={numero}, serie={serie}, cnpj_emitente={cnpj_emitente}, chave_acesso={chave_acesso}")
-        
-        check_query = text("SELECT id FROM notas_fiscais WHERE chave_acesso = :chave")
-        try:
-            with self.engine.connect() as connection:
-                if connection.execute(check_query, {"chave": chave_acesso}).fetchone():
-                    logger.warning(f"Nota fiscal {numero} (Chave: {chave_acesso}) já existe. Pulando.")
-                    return False
-        except Exception as e:
-             logger.error(f"Erro ao verificar duplicidade da NF {numero}: {e}")
-             return False
-
         # Preparar dados da nota fiscal com valores padrão para campos opcionais
         # CORREÇÃO: Converter Decimal para float para compatibilidade com SQLite
         nf_data = {
@@ -705,92 +1355,197 @@ class DatabaseManager:
             'origem': getattr(nota, 'origem', 'upload')
         }
         
-        logger.info(f"📊 DADOS PREPARADOS PARA INSERÇÃO: {nf_data}")
-        
         # Obter itens se existirem
-        itens = getattr(nota, 'itens', []) or []
-
-        insert_nf_query = text("""
-            INSERT INTO notas_fiscais (
-                numero, serie, data_emissao, cnpj_emitente, nome_emitente, 
-                valor_total, chave_acesso, natureza_operacao, situacao, 
-                data_vencimento, cnpj_destinatario, nome_destinatario, 
-                valor_icms, valor_ipi, valor_pis, valor_cofins, 
-                xml_original, processado_em, origem
-            ) VALUES (
-                :numero, :serie, :data_emissao, :cnpj_emitente, :nome_emitente,
-                :valor_total, :chave_acesso, :natureza_operacao, :situacao,
-                :data_vencimento, :cnpj_destinatario, :nome_destinatario,
-                :valor_icms, :valor_ipi, :valor_pis, :valor_cofins,
-                :xml_original, :processado_em, :origem
-            ) RETURNING id
-        """)
+        itens = [
+            {
+                'codigo': item.get('codigo', ''),
+                'descricao': item.get('descricao', ''),
+                'ncm': item.get('ncm', ''),
+                'quantidade': _para_decimal(item.get('quantidade', 0)),
+                'valor_unitario': _para_decimal(item.get('valor_unitario', 0)),
+                'valor_total': _para_decimal(item.get('valor_total', 0))
+            }
+            for item in (getattr(nota, 'itens', []) or [])
+        ]
+        return nf_data, itens
+
+    def salvar_nota_fiscal(self, nota: NotaFiscal) -> bool:
+        # Mensagens de rotina em DEBUG e com formatação preguiçosa (%s): sem custo com o nível desligado
+        logger.debug(
+            "Salvando NF: numero=%s, serie=%s, cnpj_emitente=%s, chave_acesso=%s",
+            nota.numero, getattr(nota, 'serie', 'N/A'), nota.cnpj_emitente, getattr(nota, 'chave_acesso', 'N/A')
+        )
         
-        insert_item_query = text("""
-            INSERT INTO itens_nota_fiscal (
-                nota_fiscal_id, codigo, descricao, ncm, 
-                quantidade, valor_unitario, valor_total
-            ) VALUES (
-                :nota_id, :codigo, :descricao, :ncm, 
-                :quantidade, :valor_unitario, :valor_total
-            )
-        """)
+        try:
+            nf_data, itens = self._preparar_nota(nota)
+        except (InvalidOperation, TypeError, ValueError) as e:
+            logger.error("❌ ERRO AO PREPARAR NF %s: %s", nota.numero, e)
+            self.log_processamento("Salvar NF", f"NF {nota.numero}", "Erro de Gravação", str(e))
+            return False
+        
+        numero, chave_acesso = nf_data['numero'], nf_data['chave_acesso']
+        
+        logger.debug("Dados preparados para inserção: %s", nf_data)
 
+        chave_unica = self._chave_acesso_unica()
         try:
+            # Verificação de duplicidade e gravação na mesma conexão (um único checkout/pre-ping)
             with self.engine.begin() as connection:
-                # Inserir nota fiscal
-                result = connection.execute(insert_nf_query, nf_data)
-                nf_id = result.fetchone()[0]
+                if chave_unica:
+                    # Uma ida ao banco: sem linha retornada = chave já existente
+                    linha = connection.execute(self._INSERT_NF_SEM_DUPLICAR, nf_data).fetchone()
+                else:
+                    linha = None
+                    if not connection.execute(self._SELECT_ID_POR_CHAVE, {"chave": chave_acesso}).fetchone():
+                        linha = connection.execute(self._INSERT_NF_RETURNING, nf_data).fetchone()
                 
-                # Inserir itens se existirem
+                if linha is None:
+                    logger.warning("Nota fiscal %s (Chave: %s) já existe. Pulando.", numero, chave_acesso)
+                    return False
+                nf_id = linha[0]
+                
+                # Inserir itens se existirem (executemany)
                 if itens and nf_id:
-                    for item in itens:
-                        item_data = {
-                            'nota_id': nf_id,
-                            'codigo': item.get('codigo', ''),
-                            'descricao': item.get('descricao', ''),
-                            'ncm': item.get('ncm', ''),
-                            'quantidade': Decimal(str(item.get('quantidade', 0))),
-                            'valor_unitario': Decimal(str(item.get('valor_unitario', 0))),
-                            'valor_total': Decimal(str(item.get('valor_total', 0)))
-                        }
-                        connection.execute(insert_item_query, item_data)
+                    connection.execute(
+                        self._INSERT_ITEM,
+                        [{**item, 'nota_id': nf_id} for item in itens]
+                    )
                 
-            logger.info(f"✅ SUCESSO! Nota fiscal {nota.numero} salva no banco de dados com ID {nf_id}.")
+            logger.info("Nota fiscal %s salva no banco de dados com ID %s", nota.numero, nf_id)
             return True
             
         except (exc.SQLAlchemyError, InvalidOperation, TypeError) as e:
-            logger.error(f"❌ ERRO AO SALVAR NF {nota.numero}: {e}")
-            logger.error(f"📋 DADOS DA NF: {nf_data}")
+            logger.error("❌ ERRO AO SALVAR NF %s: %s", nota.numero, e)
+            logger.error("Dados da NF: %s", nf_data)
             self.log_processamento("Salvar NF", f"NF {nota.numero}", "Erro de Gravação", str(e))
             return False
 
-    def buscar_dados(self, table_name: str, filtros: Dict = None) -> List[Dict]:
-        base_query = f"SELECT * FROM {table_name}"
+    def salvar_notas_fiscais_batch(self, notas: List[NotaFiscal]) -> List[bool]:
+        """
+        Salva várias notas fiscais em uma única transação
+
+        Uma consulta de duplicidade, um INSERT em lote (executemany) para as notas,
+        uma consulta dos IDs gerados e um INSERT em lote para os itens, qualquer que seja
+        a quantidade de notas. Se o banco rejeitar alguma nota (IntegrityError/DataError),
+        o lote é desfeito e as notas são gravadas uma a uma, salvando as válidas.
+
+        Returns:
+            Lista com o resultado de cada nota, na mesma ordem (True = salva)
+        """
+        resultados = [False] * len(notas)
+        preparadas = []
+        for posicao, nota in enumerate(notas):
+            try:
+                nf_data, itens = self._preparar_nota(nota)
+                preparadas.append((posicao, nf_data, itens))
+            except (InvalidOperation, TypeError, ValueError) as e:
+                logger.error("❌ ERRO AO PREPARAR NF %s: %s", nota.numero, e)
+        
+        if not preparadas:
+            return resultados
+        
+        chaves = [nf_data['chave_acesso'] for _, nf_data, _ in preparadas]
+        
+        try:
+            # Uma única conexão para o lote inteiro (um checkout/pre-ping, não um por nota)
+            with self.engine.begin() as connection:
+                existentes = {row[0] for row in connection.execute(self._SELECT_CHAVES, {"chaves": chaves})}
+                
+                # Descartar duplicadas no banco e repetidas dentro do próprio lote
+                novas = []
+                for posicao, nf_data, itens in preparadas:
+                    chave = nf_data['chave_acesso']
+                    if chave in existentes:
+                        logger.warning("Nota fiscal %s (Chave: %s) já existe. Pulando.", nf_data['numero'], chave)
+                        continue
+                    existentes.add(chave)
+                    novas.append((posicao, nf_data, itens))
+                
+                if not novas:
+                    return resultados
+                
+                connection.execute(self._INSERT_NF, [nf_data for _, nf_data, _ in novas])
+                
+                ids = dict(
+                    (row[1], row[0]) for row in connection.execute(
+                        self._SELECT_IDS_POR_CHAVES, {"chaves": [nf_data['chave_acesso'] for _, nf_data, _ in novas]}
+                    )
+                )
+                itens_lote = [
+                    {**item, 'nota_id': ids[nf_data['chave_acesso']]}
+                    for _, nf_data, itens in novas
+                    for item in itens
+                ]
+                if itens_lote:
+                    connection.execute(self._INSERT_ITEM, itens_lote)
+            
+            for posicao, _, _ in novas:
+                resultados[posicao] = True
+            logger.info("%d nota(s) fiscal(is) salva(s) em lote", len(novas))
+            return resultados
+            
+        except (exc.IntegrityError, exc.DataError) as e:
+            # Uma nota rejeitada (número repetido, texto longo demais, estouro numérico) desfaz o
+            # lote inteiro: regravar nota a nota, cada uma na sua transação, para salvar as demais
+            logger.warning("Lote de %d NF(s) rejeitado, gravando nota a nota: %s", len(preparadas), e.orig)
+            for posicao, _, _ in preparadas:
+                resultados[posicao] = self.salvar_nota_fiscal(notas[posicao])
+            return resultados
+            
+        except (exc.SQLAlchemyError, InvalidOperation, TypeError, KeyError) as e:
+            logger.error("❌ ERRO AO SALVAR LOTE DE %d NF(s): %s", len(preparadas), e)
+            self.log_processamento("Salvar NF", f"Lote de {len(preparadas)} NF(s)", "Erro de Gravação", str(e))
+            return [False] * len(notas)
+
+    # Colunas numéricas/datas de notas_fiscais, tipadas já na leitura do DataFrame
+    _COLUNAS_VALOR_NF = ('valor_total', 'valor_icms', 'valor_ipi', 'valor_pis', 'valor_cofins')
+    _COLUNAS_DATA_NF = ['data_emissao', 'data_vencimento', 'processado_em']
+
+    # Colunas de data/hora comparadas pelo dia nos filtros de intervalo
+    _COLUNAS_DATA_FILTRO = frozenset(_COLUNAS_DATA_NF) | {'timestamp'}
+
+    @staticmethod
+    def _separar_filtro(chave: str) -> Tuple[str, str]:
+        """Separa a chave do filtro em (coluna, operador): sufixo _inicio => '>=', _fim => '<=', senão '='"""
+        if chave.endswith('_inicio'):
+            return chave[:-7], '>='
+        if chave.endswith('_fim'):
+            return chave[:-4], '<='
+        return chave, '='
+
+    @classmethod
+    def _montar_filtros(cls, filtros: Dict = None) -> Tuple[str, Dict]:
+        """Monta a cláusula WHERE dos filtros (sufixos _inicio/_fim = intervalo) e seus parâmetros"""
         where_clauses, params = [], {}
-        if filtros:
-            for col, val in filtros.items():
-                if col.endswith('_inicio'): 
-                    # Para filtros de data, usar DATE() para comparar apenas a parte da data
-                    col_name = col.replace('_inicio', '')
-                    if 'data' in col_name.lower():
-                        where_clauses.append(f"DATE({col_name}) >= :{col}")
-                    else:
-                        where_clauses.append(f"{col_name} >= :{col}")
-                    params[col] = val
-                elif col.endswith('_fim'): 
-                    # Para filtros de data, usar DATE() para comparar apenas a parte da data
-                    col_name = col.replace('_fim', '')
-                    if 'data' in col_name.lower():
-                        where_clauses.append(f"DATE({col_name}) <= :{col}")
-                    else:
-                        where_clauses.append(f"{col_name} <= :{col}")
-                    params[col] = val
-                else: 
-                    where_clauses.append(f"{col} = :{col}")
-                    params[col] = val
-        if where_clauses: base_query += " WHERE " + " AND ".join(where_clauses)
-        base_query += " ORDER BY id DESC"
+        for chave, val in (filtros or {}).items():
+            col_name, op = cls._separar_filtro(chave)
+            if col_name in cls._COLUNAS_DATA_FILTRO and op != '=':
+                # Datas pelo dia, sem DATE() na coluna (usa o índice): início às 00:00 e
+                # fim como intervalo semiaberto até o dia seguinte (inclui o dia final inteiro)
+                if op == '>=':
+                    val = str(val)[:10]
+                else:
+                    op, val = '<', dia_seguinte(val)
+            where_clauses.append(f"{col_name} {op} :{chave}")
+            params[chave] = val
+        where = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+        return where, params
+
+    @classmethod
+    def _montar_consulta(cls, table_name: str, filtros: Dict = None,
+                         limite: Optional[int] = None, deslocamento: int = 0) -> Tuple[str, Dict]:
+        """Monta o SELECT com os filtros e, se houver limite, a página pedida (LIMIT/OFFSET)"""
+        where, params = cls._montar_filtros(filtros)
+        # id DESC como ordem total: as páginas ficam estáveis entre consultas
+        base_query = f"SELECT * FROM {table_name}{where} ORDER BY id DESC"
+        if limite is not None:
+            base_query += " LIMIT :limite OFFSET :deslocamento"
+            params.update(limite=int(limite), deslocamento=max(int(deslocamento), 0))
+        return base_query, params
+
+    def buscar_dados(self, table_name: str, filtros: Dict = None,
+                     limite: Optional[int] = None, deslocamento: int = 0) -> List[Dict]:
+        base_query, params = self._montar_consulta(table_name, filtros, limite, deslocamento)
         try:
             with self.engine.connect() as connection:
                 # LINHA CORRIGIDA ABAIXO
@@ -800,6 +1555,112 @@ class DatabaseManager:
             st.error(f"Erro de Banco de Dados: Não foi possível buscar os dados da tabela '{table_name}'.")
             return []
 
+    def contar_registros(self, table_name: str, filtros: Dict = None) -> int:
+        """Total de linhas que atendem aos filtros (usado pela paginação)"""
+        where, params = self._montar_filtros(filtros)
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(text(f"SELECT COUNT(*) FROM {table_name}{where}"), params).scalar() or 0
+        except Exception as e:
+            logger.error(f"Erro ao contar registros da tabela {table_name}: {e}")
+            return 0
+
+    def buscar_dataframe(self, table_name: str, filtros: Dict = None,
+                         limite: Optional[int] = None, deslocamento: int = 0) -> pd.DataFrame:
+        """
+        Busca os dados direto em um DataFrame (pd.read_sql_query), com colunas já tipadas
+
+        Evita a lista de dicts intermediária de buscar_dados: valores vêm como float64
+        e datas como datetime64, sem conversões posteriores.
+        """
+        base_query, params = self._montar_consulta(table_name, filtros, limite, deslocamento)
+        try:
+            with self.engine.connect() as connection:
+                df = pd.read_sql_query(text(base_query), connection, params=params)
+        except Exception as e:
+            logger.error(f"Erro ao buscar dados da tabela {table_name}: {e}")
+            st.error(f"Erro de Banco de Dados: Não foi possível buscar os dados da tabela '{table_name}'.")
+            return pd.DataFrame()
+        
+        if table_name == 'notas_fiscais' and not df.empty:
+            df = df.astype({col: 'float64' for col in self._COLUNAS_VALOR_NF if col in df.columns})
+            for col in self._COLUNAS_DATA_NF:
+                if col in df.columns:
+                    df[col] = pd.to_datetime(df[col], errors='coerce')
+        return df
+
+    def buscar_notas_df(self, data_inicio: str, data_fim: str) -> pd.DataFrame:
+        """Notas fiscais do período (dias inteiros) em um DataFrame, via buscar_dataframe"""
+        return self.buscar_dataframe(
+            'notas_fiscais', {'data_emissao_inicio': data_inicio, 'data_emissao_fim': data_fim}
+        )
+
+    # Agregações da visão geral calculadas no banco (poucas linhas trafegam, qualquer que seja o período)
+    # Intervalo semiaberto [inicio, dia seguinte ao fim): usa o índice de data_emissao
+    _FILTRO_PERIODO = "data_emissao >= :inicio AND data_emissao < :ate"
+    _SELECT_METRICAS_PERIODO = text(f"""
+        SELECT COUNT(*), COALESCE(SUM(valor_total), 0), COALESCE(AVG(valor_total), 0),
+               COUNT(DISTINCT cnpj_emitente)
+        FROM notas_fiscais WHERE {_FILTRO_PERIODO}
+    """)
+    _SELECT_TOP_FORNECEDORES = text(f"""
+        SELECT nome_emitente, SUM(valor_total) AS valor_total
+        FROM notas_fiscais WHERE {_FILTRO_PERIODO}
+        GROUP BY nome_emitente ORDER BY valor_total DESC LIMIT :n
+    """)
+    _SELECT_SERIE_DIARIA = text(f"""
+        SELECT DATE(data_emissao) AS dia, SUM(valor_total) AS valor_total
+        FROM notas_fiscais WHERE {_FILTRO_PERIODO}
+        GROUP BY DATE(data_emissao) ORDER BY dia
+    """)
+
+    def metricas_periodo(self, inicio, fim) -> Dict[str, Any]:
+        """Total de notas, valor total, ticket médio e fornecedores únicos do período (uma consulta)"""
+        try:
+            with self.engine.connect() as connection:
+                total, soma, media, fornecedores = connection.execute(
+                    self._SELECT_METRICAS_PERIODO, {"inicio": inicio, "ate": dia_seguinte(fim)}
+                ).one()
+            return {
+                'total_notas': total,
+                'valor_total': float(soma),
+                'ticket_medio': float(media),
+                'fornecedores_unicos': fornecedores
+            }
+        except exc.SQLAlchemyError as e:
+            logger.error(f"Erro ao calcular métricas do período: {e}")
+            return {'total_notas': 0, 'valor_total': 0.0, 'ticket_medio': 0.0, 'fornecedores_unicos': 0}
+
+    def top_fornecedores(self, inicio, fim, n: int = 10) -> pd.Series:
+        """Valor total por fornecedor (os n maiores) no período"""
+        try:
+            with self.engine.connect() as connection:
+                linhas = connection.execute(
+                    self._SELECT_TOP_FORNECEDORES, {"inicio": inicio, "ate": dia_seguinte(fim), "n": n}
+                ).all()
+        except exc.SQLAlchemyError as e:
+            logger.error(f"Erro ao buscar maiores fornecedores: {e}")
+            linhas = []
+        return pd.Series(
+            [float(valor or 0) for _, valor in linhas],
+            index=pd.Index([nome for nome, _ in linhas], name='nome_emitente'),
+            name='valor_total', dtype='float64'
+        )
+
+    def serie_diaria(self, inicio, fim) -> pd.Series:
+        """Valor total por dia de emissão no período"""
+        try:
+            with self.engine.connect() as connection:
+                linhas = connection.execute(self._SELECT_SERIE_DIARIA, {"inicio": inicio, "ate": dia_seguinte(fim)}).all()
+        except exc.SQLAlchemyError as e:
+            logger.error(f"Erro ao buscar evolução diária: {e}")
+            linhas = []
+        return pd.Series(
+            [float(valor or 0) for _, valor in linhas],
+            index=pd.Index([dia for dia, _ in linhas], name='data_emissao'),
+            name='valor_total', dtype='float64'
+        )
+
     def buscar_nota_fiscal_por_numero(self, numero):
         """Busca uma nota fiscal pelo número e retorna seu ID"""
         try:
@@ -811,63 +1672,215 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar nota fiscal por número {numero}: {e}")
             return None
 
+    _COLUNAS_ITEM = ('nota_fiscal_id', 'codigo', 'descricao', 'ncm', 'quantidade', 'valor_unitario', 'valor_total')
+    # NULL '\N': campo vazio sem aspas continua sendo texto vazio (no padrão do CSV viraria NULL)
+    _COPY_ITENS = f"COPY itens_nota_fiscal ({', '.join(_COLUNAS_ITEM)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    # A partir de quantos itens o COPY compensa em relação ao INSERT em lote
+    LIMITE_COPY_ITENS = 500
+
+    def salvar_itens_nota_fiscal(self, itens: List[Dict[str, Any]]) -> int:
+        """
+        Grava vários itens (chaves de _COLUNAS_ITEM) em uma única transação
+
+        No PostgreSQL (psycopg2), lotes acima de LIMITE_COPY_ITENS usam COPY FROM STDIN
+        com o CSV gerado sob demanda; os demais usam o INSERT em lote (_INSERT_ITEM).
+        Erros são propagados ao chamador (nenhum item é gravado).
+
+        Returns:
+            Quantidade de itens gravados
+        """
+        if not itens:
+            return 0
+        
+        if len(itens) > self.LIMITE_COPY_ITENS and self.engine.dialect.driver == 'psycopg2':
+            linhas = (tuple(item.get(coluna) for coluna in self._COLUNAS_ITEM) for item in itens)
+            conexao = self.engine.raw_connection()
+            try:
+                with conexao.cursor() as cursor:
+                    cursor.copy_expert(self._COPY_ITENS, _LeitorCsv(linhas))
+                conexao.commit()
+            except Exception:
+                conexao.rollback()
+                raise
+            finally:
+                conexao.close()
+        else:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    self._INSERT_ITEM,
+                    [
+                        {'nota_id': item['nota_fiscal_id'], **{coluna: item.get(coluna) for coluna in self._COLUNAS_ITEM[1:]}}
+                        for item in itens
+                    ]
+                )
+        
+        logger.info("%d item(ns) de nota fiscal gravado(s) em lote", len(itens))
+        return len(itens)
+
     def salvar_item_nota_fiscal(self, item_data):
-        """Salva um item de nota fiscal no banco de dados"""
+        """Salva um item de nota fiscal no banco de dados (lote de um item de salvar_itens_nota_fiscal)"""
         try:
-            with self.engine.begin() as connection:
-                query = text("""
-                    INSERT INTO itens_nota_fiscal 
-                    (nota_fiscal_id, codigo, descricao, ncm, quantidade, valor_unitario, valor_total)
-                    VALUES (:nota_fiscal_id, :codigo, :descricao, :ncm, :quantidade, :valor_unitario, :valor_total)
-                """)
-                connection.execute(query, item_data)
-                return True
+            return self.salvar_itens_nota_fiscal([item_data]) == 1
         except Exception as e:
             logger.error(f"Erro ao salvar item da nota fiscal: {e}")
             return False
 
 # --- MÓDULOS DE IA E DASHBOARD ---
 
+def resumo_notas_para_ia(df_notas: pd.DataFrame, top_n: int = 20) -> str:
+    """
+    Resume as notas fiscais em JSON para o prompt do Gemini
+
+    Totais, estatísticas, maiores fornecedores e valor por dia cobrem o período
+    inteiro com poucos tokens, em vez de um recorte das primeiras linhas em CSV.
+    """
+    if 'valor_total' in df_notas:
+        valores = pd.to_numeric(df_notas['valor_total'], errors='coerce')
+    else:
+        valores = pd.Series(0.0, index=df_notas.index)
+    resumo: Dict[str, Any] = {
+        'total_notas': int(len(df_notas)),
+        'valor_total': round(float(valores.sum()), 2),
+        'ticket_medio': round(float(valores.mean()), 2) if valores.notna().any() else 0.0,
+        'menor_valor': round(float(valores.min()), 2) if valores.notna().any() else 0.0,
+        'maior_valor': round(float(valores.max()), 2) if valores.notna().any() else 0.0,
+    }
+    
+    for coluna in ('valor_icms', 'valor_ipi', 'valor_pis', 'valor_cofins'):
+        if coluna in df_notas:
+            resumo[f'total_{coluna}'] = round(float(pd.to_numeric(df_notas[coluna], errors='coerce').sum()), 2)
+    
+    if 'cnpj_emitente' in df_notas:
+        resumo['fornecedores_unicos'] = int(df_notas['cnpj_emitente'].nunique())
+    if 'nome_emitente' in df_notas:
+        por_fornecedor = valores.groupby(df_notas['nome_emitente']).agg(['sum', 'count']).nlargest(top_n, 'sum')
+        resumo['maiores_fornecedores'] = [
+            {'fornecedor': nome, 'valor_total': round(float(soma), 2), 'notas': int(quantidade)}
+            for nome, soma, quantidade in por_fornecedor.itertuples(name=None)
+        ]
+    if 'natureza_operacao' in df_notas:
+        resumo['naturezas_operacao'] = df_notas['natureza_operacao'].value_counts().head(10).to_dict()
+    if 'data_emissao' in df_notas:
+        datas = pd.to_datetime(df_notas['data_emissao'], errors='coerce')
+        if datas.notna().any():
+            resumo['periodo'] = {'inicio': datas.min().date().isoformat(), 'fim': datas.max().date().isoformat()}
+            por_dia = valores.groupby(datas.dt.date).sum()
+            resumo['valor_por_dia'] = {dia.isoformat(): round(float(valor), 2) for dia, valor in por_dia.items()}
+    
+    return json.dumps(resumo, ensure_ascii=False, default=str)
+
+@st.cache_resource
+def _modelo_gemini(api_key: str, nome_modelo: str = 'gemini-1.5-flash'):
+    """Retorna o modelo do Gemini compartilhado (configurado uma vez por chave e modelo)"""
+    # Import tardio: o SDK do Gemini só é carregado quando o chat é usado
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(nome_modelo)
+
+# Respostas factuais sobre os dados: pouca variação entre gerações
+CONFIG_GERACAO_GEMINI = {'temperature': 0.1}
+
 class GeminiChat:
     def __init__(self, config):
         if not config.GEMINI_API_KEY or "AIza" not in config.GEMINI_API_KEY:
             raise ValueError("A chave da API do Gemini não foi configurada.")
-        genai.configure(api_key=config.GEMINI_API_KEY)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.model = _modelo_gemini(config.GEMINI_API_KEY)
+    @staticmethod
+    def _montar_prompt(pergunta: str, df_notas: pd.DataFrame) -> str:
+        resumo = resumo_notas_para_ia(df_notas)
+        return f"Você é um assistente fiscal. Responda à pergunta do usuário com base no resumo das notas fiscais do período (JSON) abaixo.\n\nResumo:\n{resumo}\n\nPergunta:\n{pergunta}"
     def responder_pergunta(self, pergunta: str, df_notas: pd.DataFrame):
+        return "".join(self.responder_pergunta_stream(pergunta, df_notas))
+    def responder_pergunta_stream(self, pergunta: str, df_notas: pd.DataFrame) -> Iterator[str]:
+        """Gera a resposta em partes, à medida que o Gemini as devolve"""
         if df_notas.empty:
-            return "Não há dados de notas fiscais para analisar. Por favor, ajuste os filtros."
+            yield "Não há dados de notas fiscais para analisar. Por favor, ajuste os filtros."
+            return
         try:
-            dados_para_analise = df_notas.head(100).to_csv(index=False, sep=';')
-            prompt = f"Você é um assistente fiscal. Responda à pergunta do usuário com base nos dados em CSV abaixo.\n\nDados:\n{dados_para_analise}\n\nPergunta:\n{pergunta}"
-            response = self.model.generate_content(prompt)
-            return response.text
+            response = self.model.generate_content(
+                self._montar_prompt(pergunta, df_notas), generation_config=CONFIG_GERACAO_GEMINI, stream=True
+            )
+            gerou_texto = False
+            for parte in response:
+                # Partes sem texto (bloqueadas ou só com o motivo de término): .text levanta ValueError
+                try:
+                    texto = parte.text
+                except ValueError:
+                    continue
+                if texto:
+                    gerou_texto = True
+                    yield texto
+            if not gerou_texto:
+                yield "Não foi possível gerar uma resposta. Tente reformular sua pergunta."
         except Exception as e:
             logger.error(f"Erro ao chamar a API do Gemini: {e}")
-            return f"Ocorreu um erro ao processar sua pergunta: {e}"
+            yield f"Ocorreu um erro ao processar sua pergunta: {e}"
+
+@st.cache_resource
+def obter_config_segura():
+    """Configuração segura carregada uma única vez por processo (as variáveis de ambiente não mudam entre reruns)"""
+    return get_secure_config()
+
+@st.cache_resource
+def garantir_admin() -> bool:
+    """Cria o usuário administrador, se necessário, apenas na primeira execução do processo"""
+    auth.create_admin_if_needed()
+    return True
+
+# st.fragment (Streamlit >= 1.37) ou st.experimental_fragment (1.33+); em versões anteriores, função comum
+_fragmento = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda funcao: funcao)
+
+@_fragmento
+def formulario_reset_senha(user_id):
+    """Formulário de reset de senha de um usuário; o envio reexecuta só este fragmento"""
+    with st.form(f"reset_password_{user_id}"):
+        new_password = st.text_input("Nova Senha", type="password")
+        new_password_confirm = st.text_input("Confirmar Nova Senha", type="password")
+        
+        reset_btn = st.form_submit_button("🔑 Resetar Senha")
+        
+        if reset_btn:
+            if not new_password or not new_password_confirm:
+                st.error("❌ Preencha ambos os campos de senha")
+            elif not hmac.compare_digest(new_password.encode('utf-8'), new_password_confirm.encode('utf-8')):
+                st.error("❌ As senhas não coincidem")
+            else:
+                success, message = auth.user_manager.update_user_password(user_id, new_password)
+                # Resultado em um aviso flutuante (não adiciona elementos ao painel)
+                st.toast(message, icon="✅" if success else "❌")
+
+@st.cache_resource
+def _database_manager(database_url: str, _config, _classe: Optional[type] = None, modulo: str = __name__):
+    """
+    Retorna o DatabaseManager compartilhado por URL (engine e pool criados uma única vez)
+
+    _classe permite a nf_processor_with_auth usar o próprio DatabaseManager; modulo
+    entra na chave do cache para as duas classes não se misturarem.
+    """
+    return (_classe or DatabaseManager)(_config)
+
+@st.cache_data(ttl=300, max_entries=64)
+def _notas_periodo(database_url: str, data_inicio: str, data_fim: str, _db_manager, modulo: str = __name__) -> pd.DataFrame:
+    """Notas fiscais do período (buscar_notas_df), reaproveitadas entre reruns e sessões por até 5 minutos"""
+    return _db_manager.buscar_notas_df(data_inicio, data_fim)
+
+@st.cache_data(ttl=60)
+def _total_registros(database_url: str, table_name: str, filtros: Optional[Dict], _db_manager: DatabaseManager) -> int:
+    """Total de registros para o paginador, reaproveitado entre reruns por até 1 minuto"""
+    return _db_manager.contar_registros(table_name, filtros)
 
 class Dashboard:
+    # Linhas exibidas por página nas tabelas paginadas
+    TAMANHO_PAGINA = 100
+
     def __init__(self):
         try:
-            # Configurar página antes de qualquer coisa
-            st.set_page_config(
-                page_title="Gestor Fiscal AI", 
-                layout="wide", 
-                initial_sidebar_state="expanded",
-                page_icon="🤖"
-            )
+            # Criar usuário admin se necessário (uma vez por processo)
+            garantir_admin()
             
-            # Criar usuário admin se necessário
-            auth.create_admin_if_needed()
-            
-            # Verificar autenticação
-            if not auth.is_authenticated():
-                auth.show_login_page()
-                st.stop()
-            
-            # Inicializar configurações após autenticação
-            self.config = get_secure_config()
-            self.db_manager = DatabaseManager(self.config)
+            # Inicializar configurações (a autenticação é verificada a cada execução, em run)
+            self.config = obter_config_segura()
+            self.db_manager = _database_manager(self.config.DATABASE_URL, self.config)
             
         except SecureConfigError as e:
             st.error(f"Erro de configuração: {e}")
@@ -877,6 +1890,11 @@ class Dashboard:
             st.stop()
 
     def run(self):
+        # Verificar autenticação (a instância é reaproveitada na sessão, inclusive após logout)
+        if not auth.is_authenticated():
+            auth.show_login_page()
+            st.stop()
+        
         st_autorefresh(interval=600000, key="datarefresher") # Atualiza a cada 10 minutos
         
         # Sidebar com informações do usuário
@@ -918,44 +1936,73 @@ class Dashboard:
         with tab4: self.render_logs()
         with tab5: self.render_upload_notas()
 
-    def carregar_dados(self):
-        filtros = {'data_emissao_inicio': self.data_inicio.isoformat(), 'data_emissao_fim': self.data_fim.isoformat()}
-        notas_data = self.db_manager.buscar_dados('notas_fiscais', filtros)
-        self.df_notas = pd.DataFrame(notas_data) if notas_data else pd.DataFrame()
+    def carregar_dados(self, recarregar: bool = False):
+        # As notas do período só são buscadas quando alguma aba usa o DataFrame (ver df_notas)
+        if recarregar:
+            _notas_periodo.clear()
+            _total_registros.clear()
+        self._df_notas = None
+
+    @property
+    def df_notas(self) -> pd.DataFrame:
+        """Notas do período (carregadas no primeiro acesso)"""
+        if getattr(self, '_df_notas', None) is None:
+            self._df_notas = _notas_periodo(
+                self.config.DATABASE_URL, self.data_inicio.isoformat(), self.data_fim.isoformat(), self.db_manager
+            )
+        return self._df_notas
 
     def render_visao_geral(self):
+        # Import tardio: o plotly só é carregado quando os gráficos são exibidos
+        import plotly.express as px
+        
         st.header("Visão Geral do Período")
-        if self.df_notas.empty: st.warning("Nenhuma nota fiscal encontrada para o período selecionado."); return
-        self.df_notas['valor_total'] = pd.to_numeric(self.df_notas['valor_total'], errors='coerce').fillna(0)
+        inicio, fim = self.data_inicio.isoformat(), self.data_fim.isoformat()
+        metricas = self.db_manager.metricas_periodo(inicio, fim)
+        if not metricas['total_notas']: st.warning("Nenhuma nota fiscal encontrada para o período selecionado."); return
         col1, col2, col3, col4 = st.columns(4)
-        col1.metric("Total de Notas", f"{self.df_notas.shape[0]:,}")
-        col2.metric("Valor Total", f"R$ {self.df_notas['valor_total'].sum():,.2f}")
-        col3.metric("Ticket Médio", f"R$ {self.df_notas['valor_total'].mean():,.2f}")
-        col4.metric("Fornecedores Únicos", f"{self.df_notas['cnpj_emitente'].nunique():,}")
+        col1.metric("Total de Notas", f"{metricas['total_notas']:,}")
+        col2.metric("Valor Total", f"R$ {metricas['valor_total']:,.2f}")
+        col3.metric("Ticket Médio", f"R$ {metricas['ticket_medio']:,.2f}")
+        col4.metric("Fornecedores Únicos", f"{metricas['fornecedores_unicos']:,}")
         st.markdown("---")
         col1, col2 = st.columns([1, 1])
         with col1:
             st.subheader("Valor por Fornecedor (Top 10)")
-            valor_por_fornecedor = self.df_notas.groupby('nome_emitente')['valor_total'].sum().nlargest(10).sort_values()
+            valor_por_fornecedor = self.db_manager.top_fornecedores(inicio, fim, 10).sort_values()
             fig = px.bar(valor_por_fornecedor, x='valor_total', y=valor_por_fornecedor.index, orientation='h', text_auto='.2s')
             st.plotly_chart(fig, use_container_width=True)
         with col2:
             st.subheader("Evolução Diária de Notas")
-            self.df_notas['data_emissao_dt'] = pd.to_datetime(self.df_notas['data_emissao'])
-            notas_por_dia = self.df_notas.groupby(self.df_notas['data_emissao_dt'].dt.date)['valor_total'].sum()
+            notas_por_dia = self.db_manager.serie_diaria(inicio, fim)
             fig = px.line(notas_por_dia, x=notas_por_dia.index, y='valor_total', markers=True)
             st.plotly_chart(fig, use_container_width=True)
 
+    def _pagina(self, table_name: str, filtros: Optional[Dict], chave: str) -> Tuple[int, int]:
+        """Exibe o seletor de página e retorna (total de registros, deslocamento da página escolhida)"""
+        total = _total_registros(self.config.DATABASE_URL, table_name, filtros, self.db_manager)
+        if total <= self.TAMANHO_PAGINA:
+            return total, 0
+        paginas = -(-total // self.TAMANHO_PAGINA)
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, step=1, key=chave)
+        return total, (int(pagina) - 1) * self.TAMANHO_PAGINA
+
     def render_analise_detalhada(self):
         st.header("Análise Detalhada das Notas Fiscais")
-        if self.df_notas.empty: st.warning("Nenhuma nota fiscal para exibir."); return
-        st.dataframe(self.df_notas, use_container_width=True, hide_index=True)
+        filtros = {'data_emissao_inicio': self.data_inicio.isoformat(), 'data_emissao_fim': self.data_fim.isoformat()}
+        total, deslocamento = self._pagina('notas_fiscais', filtros, 'pagina_notas')
+        if not total: st.warning("Nenhuma nota fiscal para exibir."); return
+        # Só a página exibida é buscada; a exportação continua usando todas as notas do período
+        df_pagina = self.db_manager.buscar_dataframe('notas_fiscais', filtros, self.TAMANHO_PAGINA, deslocamento)
+        st.dataframe(df_pagina, use_container_width=True, hide_index=True)
+        st.caption(f"Exibindo {deslocamento + 1}–{deslocamento + len(df_pagina)} de {total:,} notas")
         st.subheader("Exportar Dados")
         col1, col2 = st.columns(2)
         if col1.button("Exportar para Excel"):
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-                self.df_notas.to_excel(tmp.name, index=False)
-                st.download_button("Clique para baixar o Excel", data=Path(tmp.name).read_bytes(), file_name="notas_fiscais.xlsx")
+            # Planilha gerada em memória (sem arquivo temporário em disco)
+            buffer = io.BytesIO()
+            self.df_notas.to_excel(buffer, index=False)
+            st.download_button("Clique para baixar o Excel", data=buffer.getvalue(), file_name="notas_fiscais.xlsx")
         if col2.button("Exportar para CSV"):
              st.download_button("Clique para baixar o CSV", data=self.df_notas.to_csv(index=False, sep=';').encode('utf-8'), file_name="notas_fiscais.csv", mime='text/csv')
 
@@ -972,17 +2019,23 @@ class Dashboard:
             st.session_state.messages.append({"role": "user", "content": prompt})
             with st.chat_message("user"): st.markdown(prompt)
             with st.chat_message("assistant"):
+                # Resposta exibida à medida que chega (streaming), sem esperar o texto completo
+                placeholder = st.empty()
+                response = ""
                 with st.spinner("Analisando..."):
-                    response = gemini_chat.responder_pergunta(prompt, self.df_notas)
-                    st.markdown(response)
+                    for parte in gemini_chat.responder_pergunta_stream(prompt, self.df_notas):
+                        response += parte
+                        placeholder.markdown(response)
             st.session_state.messages.append({"role": "assistant", "content": response})
 
     def render_logs(self):
         st.header("Logs de Processamento")
-        logs_data = self.db_manager.buscar_dados('logs_processamento')
-        if not logs_data: st.info("Nenhum log de processamento encontrado."); return
+        total, deslocamento = self._pagina('logs_processamento', None, 'pagina_logs')
+        if not total: st.info("Nenhum log de processamento encontrado."); return
+        logs_data = self.db_manager.buscar_dados('logs_processamento', limite=self.TAMANHO_PAGINA, deslocamento=deslocamento)
         df_logs = pd.DataFrame(logs_data)
         st.dataframe(df_logs, use_container_width=True, hide_index=True)
+        st.caption(f"Exibindo {deslocamento + 1}–{deslocamento + len(df_logs)} de {total:,} registros")
 
     def render_upload_notas(self):
         st.header("📤 Upload de Notas Fiscais")
@@ -1071,6 +2124,37 @@ class Dashboard:
         }
         
         total_files = len(uploaded_files)
+        # PDF/XML consecutivos são gravados juntos, em lote, antes do próximo CSV/ZIP e no final:
+        # um CSV de itens enviado junto com as notas precisa delas já no banco
+        pendentes = []
+        
+        def gravar_pendentes():
+            if not pendentes:
+                return
+            status_text.text(f"Salvando {len(pendentes)} nota(s) no banco...")
+            salvas = self.salvar_notas_fiscais([nota for _, nota in pendentes])
+            for (nome, _), salva in zip(pendentes, salvas):
+                if salva:
+                    resultados['processados'] += 1
+                    resultados['detalhes'].append(f"✅ {nome}: Processado com sucesso")
+                else:
+                    resultados['erros'] += 1
+                    resultados['detalhes'].append(f"❌ {nome}: Erro ao salvar no banco")
+            pendentes.clear()
+        
+        # Extração dos PDF/XML em paralelo (processos), antes do laço; a gravação segue serial e em lote
+        arquivos_nf = [
+            (i, uploaded_file) for i, uploaded_file in enumerate(uploaded_files)
+            if uploaded_file.name.lower().endswith(('.pdf', '.xml'))
+        ]
+        notas_extraidas = {}
+        if arquivos_nf:
+            status_text.text(f"Extraindo dados de {len(arquivos_nf)} arquivo(s) PDF/XML...")
+            extraidas = extrair_arquivos_paralelo(
+                (uploaded_file.name, uploaded_file.getvalue()) for _, uploaded_file in arquivos_nf
+            )
+            for (i, _), (_, nota) in zip(arquivos_nf, extraidas):
+                notas_extraidas[i] = nota
         
         for i, uploaded_file in enumerate(uploaded_files):
             try:
@@ -1079,42 +2163,34 @@ class Dashboard:
                 progress_bar.progress(progress)
                 status_text.text(f"Processando: {uploaded_file.name} ({i+1}/{total_files})")
                 
-                # Ler conteúdo do arquivo
-                file_content = uploaded_file.read()
                 file_extension = uploaded_file.name.lower().split('.')[-1]
                 
+                # ZIP: aberto direto do arquivo enviado (entradas lidas sob demanda, sem cópia em bytes)
+                if file_extension == 'zip':
+                    gravar_pendentes()
+                    resultado_zip = self.processar_zip_upload(uploaded_file, uploaded_file.name)
+                    resultados['processados'] += resultado_zip['processados']
+                    resultados['erros'] += resultado_zip['erros']
+                    resultados['detalhes'].extend(resultado_zip['detalhes'])
+                    continue
+                
                 nota_fiscal = None
                 
-                # Processar baseado no tipo de arquivo
-                if file_extension == 'pdf':
-                    nota_fiscal = self.processar_pdf_upload(file_content, uploaded_file.name)
-                elif file_extension == 'xml':
-                    nota_fiscal = self.processar_xml_upload(file_content, uploaded_file.name)
+                # Processar baseado no tipo de arquivo (PDF/XML já extraídos acima)
+                if file_extension in ('pdf', 'xml'):
+                    nota_fiscal = notas_extraidas.get(i)
                 elif file_extension == 'csv':
-                    notas_csv = self.processar_csv_upload(file_content, uploaded_file.name)
+                    gravar_pendentes()
+                    notas_csv = self.processar_csv_upload(uploaded_file, uploaded_file.name)
                     if notas_csv:
-                        for nota in notas_csv:
-                            if self.salvar_nota_fiscal(nota):
-                                resultados['processados'] += 1
-                            else:
-                                resultados['erros'] += 1
+                        salvas = sum(self.salvar_notas_fiscais(notas_csv))
+                        resultados['processados'] += salvas
+                        resultados['erros'] += len(notas_csv) - salvas
                         continue
-                elif file_extension == 'zip':
-                    # Processar arquivo ZIP
-                    resultado_zip = self.processar_zip_upload(file_content, uploaded_file.name)
-                    resultados['processados'] += resultado_zip['processados']
-                    resultados['erros'] += resultado_zip['erros']
-                    resultados['detalhes'].extend(resultado_zip['detalhes'])
-                    continue
                 
-                # Salvar nota fiscal individual (PDF/XML)
+                # Nota fiscal individual (PDF/XML): gravada no próximo lote
                 if nota_fiscal:
-                    if self.salvar_nota_fiscal(nota_fiscal):
-                        resultados['processados'] += 1
-                        resultados['detalhes'].append(f"✅ {uploaded_file.name}: Processado com sucesso")
-                    else:
-                        resultados['erros'] += 1
-                        resultados['detalhes'].append(f"❌ {uploaded_file.name}: Erro ao salvar no banco")
+                    pendentes.append((uploaded_file.name, nota_fiscal))
                 else:
                     resultados['erros'] += 1
                     resultados['detalhes'].append(f"❌ {uploaded_file.name}: Erro no processamento")
@@ -1124,6 +2200,9 @@ class Dashboard:
                 resultados['detalhes'].append(f"❌ {uploaded_file.name}: {str(e)}")
                 logger.error(f"Erro ao processar {uploaded_file.name}: {e}")
         
+        # Gravar as notas de PDF/XML restantes
+        gravar_pendentes()
+        
         # Finalizar progresso
         progress_bar.progress(1.0)
         status_text.text("Processamento concluído!")
@@ -1131,8 +2210,8 @@ class Dashboard:
         # Mostrar resultados
         self.mostrar_resultados_processamento(resultados)
         
-        # Recarregar dados
-        self.carregar_dados()
+        # Recarregar dados (descartando o cache das notas do período)
+        self.carregar_dados(recarregar=True)
 
     def processar_pdf_upload(self, file_content, filename):
         """Processa arquivo PDF usando a classe PDFExtractor existente"""
@@ -1151,30 +2230,10 @@ class Dashboard:
             return None
 
     def processar_csv_upload(self, file_content, filename):
-        """Processa arquivo CSV e retorna lista de notas fiscais"""
+        """Processa arquivo CSV (bytes ou arquivo binário) e retorna lista de notas fiscais"""
         try:
-            # Decodificar conteúdo
-            try:
-                csv_text = file_content.decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    csv_text = file_content.decode('latin-1')
-                except UnicodeDecodeError:
-                    csv_text = file_content.decode('cp1252')
-            
-            # Tentar diferentes delimitadores
-            delimitadores = [';', ',', '\t', '|']
-            df = None
-            
-            for delim in delimitadores:
-                try:
-                    df = pd.read_csv(io.StringIO(csv_text), sep=delim, on_bad_lines='skip', encoding_errors='ignore')
-                    # Verificar se temos pelo menos algumas colunas
-                    if len(df.columns) > 1:
-                        break
-                except Exception as e:
-                    logger.warning(f"Erro ao tentar delimitador '{delim}': {e}")
-                    continue
+            # Delimitador e codificação detectados sem reprocessar o arquivo inteiro
+            df = ler_csv(file_content)
             
             if df is None or df.empty:
                 st.error(f"Não foi possível processar o arquivo CSV: {filename}")
@@ -1183,29 +2242,24 @@ class Dashboard:
             # Verificar se é um arquivo de cabeçalho ou itens baseado no nome
             filename_lower = filename.lower()
             
-            if 'cabecalho' in filename_lower or 'header' in filename_lower:
+            if any(palavra in filename_lower for palavra in _PALAVRAS_CABECALHO):
                 st.info(f"📋 Processando arquivo de CABEÇALHO: {filename}")
                 return self._processar_csv_cabecalho(df, filename)
-            elif 'itens' in filename_lower or 'items' in filename_lower:
+            elif any(palavra in filename_lower for palavra in _PALAVRAS_ITENS):
                 # VERIFICAÇÃO CRÍTICA: Bloquear processamento de itens se não há notas fiscais
                 try:
-                    with self.db_manager.engine.connect() as connection:
-                        count_query = text("SELECT COUNT(*) FROM notas_fiscais")
-                        total_notas = connection.execute(count_query).fetchone()[0]
-                        
-                        if total_notas == 0:
-                            st.error(f"🚫 BLOQUEADO: Arquivo de itens '{filename}' não pode ser processado!")
-                            st.error("📋 MOTIVO: Nenhuma nota fiscal encontrada no banco de dados.")
-                            st.error("✅ SOLUÇÃO: Processe primeiro o arquivo de cabeçalho.")
-                            return []
-                        else:
-                            st.success(f"✅ Pré-validação OK: {total_notas} notas fiscais encontradas no banco")
-                            st.info(f"📦 Processando arquivo de ITENS: {filename}")
+                    if not self._ha_notas_no_banco():
+                        st.error(f"🚫 BLOQUEADO: Arquivo de itens '{filename}' não pode ser processado!")
+                        st.error("📋 MOTIVO: Nenhuma nota fiscal encontrada no banco de dados.")
+                        st.error("✅ SOLUÇÃO: Processe primeiro o arquivo de cabeçalho.")
+                        return []
+                    st.success("✅ Pré-validação OK: há notas fiscais no banco")
+                    st.info(f"📦 Processando arquivo de ITENS: {filename}")
                 except Exception as e:
                     st.error(f"Erro ao verificar banco de dados: {e}")
                     return []
                 
-                return self._processar_csv_itens(df, filename)
+                return self._processar_csv_itens(df, filename, pre_validado=True)
             else:
                 # Processar como CSV tradicional (todas as informações em uma linha)
                 st.info(f"📄 Processando arquivo CSV tradicional: {filename}")
@@ -1223,26 +2277,8 @@ class Dashboard:
             logger.info(f"Colunas disponíveis no CSV: {list(df.columns)}")
             logger.info(f"Número de linhas no CSV: {len(df)}")
             
-            # Mapear colunas comuns para cabeçalho (incluindo variações com acentos)
-            mapeamento_colunas = {
-                'numero': ['numero', 'NÚMERO', 'nf_numero', 'numero_nf', 'num_nf', 'NF_NUMERO'],
-                'serie': ['serie', 'SÉRIE', 'serie_nf', 'nf_serie', 'SERIE_NF'],
-                'cnpj_emitente': ['cnpj_emitente', 'CNPJ_EMITENTE', 'cnpj_emit', 'emitente_cnpj', 'CPF/CNPJ Emitente'],
-                'nome_emitente': ['nome_emitente', 'NOME_EMITENTE', 'razao_emitente', 'emitente_nome', 'NOME EMITENTE', 'RAZÃO SOCIAL EMITENTE'],
-                'data_emissao': ['data_emissao', 'DATA_EMISSAO', 'dt_emissao', 'data_emiss', 'DATA EMISSÃO'],
-                'valor_total': ['valor_total', 'VALOR_TOTAL', 'vl_total', 'total_nf', 'VALOR NOTA FISCAL'],
-                'chave_acesso': ['chave_acesso', 'CHAVE_ACESSO', 'chave_nfe', 'chave', 'CHAVE DE ACESSO'],
-                'natureza_operacao': ['natureza_operacao', 'NATUREZA_OPERACAO', 'nat_operacao', 'cfop', 'NATUREZA DA OPERAÇÃO']
-            }
-            
-            # Encontrar colunas correspondentes
-            colunas_encontradas = {}
-            for campo, possiveis_nomes in mapeamento_colunas.items():
-                for nome in possiveis_nomes:
-                    if nome in df.columns:
-                        colunas_encontradas[campo] = nome
-                        logger.info(f"Campo '{campo}' mapeado para coluna '{nome}'")
-                        break
+            # Encontrar colunas correspondentes (uma passada pelas colunas do CSV)
+            colunas_encontradas = mapear_colunas_cabecalho(df.columns)
             
             logger.info(f"Colunas encontradas: {colunas_encontradas}")
             
@@ -1256,46 +2292,8 @@ class Dashboard:
                 st.info(f"Colunas disponíveis: {', '.join(df.columns.tolist())}")
                 return []
             
-            # Converter para lista de NotaFiscal
-            notas = []
-            for _, row in df.iterrows():
-                try:
-                    # Processar data_emissao
-                    data_emissao = datetime.now()
-                    if 'data_emissao' in colunas_encontradas:
-                        data_emissao_str = str(row.get(colunas_encontradas['data_emissao'], ''))
-                        try:
-                            if '/' in data_emissao_str:
-                                data_emissao = datetime.strptime(data_emissao_str, '%d/%m/%Y')
-                            elif '-' in data_emissao_str:
-                                data_emissao = datetime.strptime(data_emissao_str, '%Y-%m-%d')
-                        except ValueError:
-                            logger.warning(f"Formato de data inválido: {data_emissao_str}")
-                    
-                    # Processar valor total
-                    valor_total = 0.0
-                    if 'valor_total' in colunas_encontradas:
-                        try:
-                            valor_str = str(row.get(colunas_encontradas['valor_total'], '0')).replace(',', '.')
-                            valor_total = float(valor_str)
-                        except (ValueError, TypeError):
-                            valor_total = 0.0
-                    
-                    nota = NotaFiscal(
-                        numero=str(row.get(colunas_encontradas['numero'], '')),
-                        serie=str(row.get(colunas_encontradas.get('serie', 'serie'), '1')),
-                        cnpj_emitente=str(row.get(colunas_encontradas['cnpj_emitente'], '')),
-                        nome_emitente=str(row.get(colunas_encontradas['nome_emitente'], '')),
-                        data_emissao=data_emissao,
-                        valor_total=valor_total,
-                        chave_acesso=str(row.get(colunas_encontradas.get('chave_acesso', 'chave_acesso'), '')),
-                        natureza_operacao=str(row.get(colunas_encontradas.get('natureza_operacao', 'natureza_operacao'), ''))
-                    )
-                    notas.append(nota)
-                    logger.info(f"Nota fiscal processada: {nota.numero}")
-                except Exception as e:
-                    logger.warning(f"Erro ao processar linha do CSV de cabeçalho: {e}")
-                    continue
+            # Converter para lista de NotaFiscal (por coluna, não linha a linha)
+            notas = notas_de_csv_cabecalho(df, colunas_encontradas)
             
             logger.info(f"Processamento concluído. Total de notas processadas: {len(notas)}")
             return notas
@@ -1306,72 +2304,26 @@ class Dashboard:
             logger.error(f"Traceback completo: {traceback.format_exc()}")
             return []
 
-    def _processar_csv_itens(self, df, filename):
+    def _ha_notas_no_banco(self) -> bool:
+        """
+        Indica se já há notas fiscais no banco (pré-requisito dos CSVs de itens)
+
+        Só o resultado positivo é guardado: notas não são apagadas durante o upload,
+        mas um CSV de cabeçalho do mesmo upload pode criar as primeiras.
+        """
+        if not getattr(self, '_notas_no_banco', False):
+            self._notas_no_banco = self.db_manager.existe_nota_fiscal()
+        return self._notas_no_banco
+
+    def _processar_csv_itens(self, df, filename, pre_validado: bool = False):
         """Processa arquivo CSV de itens de notas fiscais com validação robusta e mapeamento tolerante a acentos/espaços"""
         try:
             logger.info(f"Iniciando processamento de CSV de itens: {filename}")
             logger.info(f"Colunas disponíveis no CSV de itens: {list(df.columns)}")
             logger.info(f"Número de linhas no CSV de itens: {len(df)}")
             
-            # Função para normalizar nomes de colunas (remove acentos, espaços e pontuação)
-            def normalizar_nome_coluna(nome: str) -> str:
-                try:
-                    if not isinstance(nome, str):
-                        nome = str(nome)
-                    # Remover acentos
-                    nome_sem_acentos = ''.join(
-                        c for c in unicodedata.normalize('NFKD', nome)
-                        if not unicodedata.combining(c)
-                    )
-                    # Lowercase e substituir separadores por underscore
-                    nome_sem_acentos = nome_sem_acentos.lower()
-                    nome_sem_acentos = nome_sem_acentos.replace('/', ' ').replace('-', ' ').replace('.', ' ').replace(':', ' ')
-                    nome_sem_acentos = re.sub(r'\s+', ' ', nome_sem_acentos).strip()
-                    nome_sem_acentos = nome_sem_acentos.replace(' ', '_')
-                    return nome_sem_acentos
-                except Exception:
-                    return str(nome).lower()
-
-            # Criar mapa normalizado das colunas do DataFrame
-            mapa_colunas_normalizadas = {normalizar_nome_coluna(c): c for c in df.columns}
-            logger.debug(f"Mapa de colunas normalizadas: {mapa_colunas_normalizadas}")
-
-            # Definir sinônimos normalizados para os campos necessários
-            sinonimos = {
-                'numero_nf': [
-                    'numero_nf', 'numero', 'nf_numero', 'numero_nota_fiscal', 'num_nf', 'numero_da_nota_fiscal'
-                ],
-                'codigo_produto': [
-                    'codigo_produto', 'codigo', 'cod_produto', 'cprod', 'numero_produto', 'num_produto',
-                    'codigo_item', 'codigo_do_produto', 'numero_do_produto'
-                ],
-                'descricao': [
-                    'descricao', 'descricao_produto', 'xprod', 'produto', 'descricao_do_produto',
-                    'descricao_do_item', 'descricao_item', 'item_descricao', 'descricao_prod',
-                    'descricao_do_produto_servico', 'descricao_produto_servico', 'produto_servico'
-                ],
-                'ncm': [
-                    'ncm', 'codigo_ncm', 'codigo_ncm_sh', 'codigo_ncmsh', 'ncm_sh', 'ncmsh', 'codigo_ncm_sh'
-                ],
-                'quantidade': [
-                    'quantidade', 'qtd', 'qtde', 'qcom', 'quantidade_item'
-                ],
-                'valor_unitario': [
-                    'valor_unitario', 'vl_unitario', 'preco_unitario', 'vuncom', 'valor_unitario_item', 'preco_unitario_item'
-                ],
-                'valor_total': [
-                    'valor_total', 'vl_total', 'total_item', 'vprod', 'valor_total_item'
-                ]
-            }
-
-            # Encontrar colunas correspondentes usando normalização
-            colunas_encontradas = {}
-            for campo, aliases in sinonimos.items():
-                for alias in aliases:
-                    if alias in mapa_colunas_normalizadas:
-                        colunas_encontradas[campo] = mapa_colunas_normalizadas[alias]
-                        logger.info(f"Campo '{campo}' mapeado para coluna '{mapa_colunas_normalizadas[alias]}' (alias: {alias})")
-                        break
+            # Encontrar colunas correspondentes pelo nome normalizado (acentos, espaços e pontuação ignorados)
+            colunas_encontradas = mapear_colunas_itens(df.columns)
             
             logger.info(f"Colunas encontradas para itens: {colunas_encontradas}")
             
@@ -1385,131 +2337,115 @@ class Dashboard:
                 st.info(f"Colunas disponíveis: {', '.join(df.columns.tolist())}")
                 return []
             
-            # Verificar quantas notas fiscais existem no banco
-            try:
-                with self.db_manager.engine.connect() as connection:
-                    count_query = text("SELECT COUNT(*) FROM notas_fiscais")
-                    total_notas = connection.execute(count_query).fetchone()[0]
-                    logger.info(f"Total de notas fiscais no banco: {total_notas}")
-                    st.info(f"🔍 Verificação: {total_notas} notas fiscais encontradas no banco de dados")
-                    
-                    if total_notas == 0:
+            # Verificar se existem notas fiscais no banco (já feito na pré-validação do upload)
+            if not pre_validado:
+                try:
+                    if not self._ha_notas_no_banco():
                         st.error("❌ ERRO: Nenhuma nota fiscal encontrada no banco de dados!")
                         st.error("📋 SOLUÇÃO: O arquivo de cabeçalho deve ser processado ANTES do arquivo de itens.")
                         st.info("💡 Dica: Verifique se o arquivo de cabeçalho foi incluído no ZIP e se foi processado com sucesso.")
                         return []
-            except Exception as e:
-                logger.error(f"Erro ao contar notas fiscais: {e}")
+                except Exception as e:
+                    logger.error(f"Erro ao verificar notas fiscais: {e}")
             
             # Processar itens e associar às notas fiscais
             itens_processados = 0
             erros_processamento = 0
+            itens_lote = []
+            
+            # Conversão numérica vetorizada: uma operação por coluna, não por célula
+            def coluna_numerica(campo):
+                if campo in colunas_encontradas:
+                    return valores_numericos_csv(df[colunas_encontradas[campo]]).tolist()
+                return [0.0] * len(df)
+            
+            quantidades = coluna_numerica('quantidade')
+            valores_unitarios = coluna_numerica('valor_unitario')
+            valores_totais = coluna_numerica('valor_total')
+            
+            # Colunas de texto como listas de valores nativos, percorridas junto com as numéricas
+            # (evita montar uma pd.Series ou um dict por linha); código, descrição e NCM já
+            # convertidos, sem espaços nas pontas e limitados ao tamanho das colunas
+            numeros_nf = df[colunas_encontradas['numero_nf']].tolist()
+            codigos = df[colunas_encontradas['codigo_produto']].astype(str).str.strip().str.slice(0, 100).tolist()
+            descricoes = df[colunas_encontradas['descricao']].astype(str).str.strip().str.slice(0, 1000).tolist()
+            if 'ncm' in colunas_encontradas:
+                ncms = df[colunas_encontradas['ncm']].astype(str).str.slice(0, 20).tolist()
+            else:
+                ncms = [''] * len(df)
+            
+            # IDs das notas citadas no arquivo, buscados de uma vez (não uma consulta por linha)
+            ids_por_numero = self.db_manager.ids_notas_por_numero(
+                numero for numero in (str(valor).strip() for valor in numeros_nf if valor is not None and valor == valor) if numero
+            )
             
-            for index, row in df.iterrows():
+            # Itens da mesma nota costumam vir em linhas seguidas: reaproveitar a última conversão/busca
+            ultimo_numero_raw = ultimo_numero_nf = ultimo_nota_id = None
+            
+            linhas = zip(numeros_nf, codigos, descricoes, ncms, quantidades, valores_unitarios, valores_totais)
+            for linha, (numero_nf_raw, codigo_produto, descricao, ncm, quantidade, valor_unitario, valor_total) in enumerate(linhas, 1):
                 try:
-                    # Validar número da NF
-                    numero_nf_raw = row.get(colunas_encontradas['numero_nf'], '')
-                    if pd.isna(numero_nf_raw) or numero_nf_raw == '':
-                        logger.debug(f"Linha {index + 1}: Número da NF vazio, pulando")
-                        continue
-                    
-                    numero_nf = str(numero_nf_raw).strip()
-                    if not numero_nf:
-                        logger.debug(f"Linha {index + 1}: Número da NF vazio após limpeza, pulando")
-                        continue
+                    if ultimo_numero_nf is not None and numero_nf_raw == ultimo_numero_raw:
+                        numero_nf, nota_fiscal_id = ultimo_numero_nf, ultimo_nota_id
+                    else:
+                        # Validar número da NF (valor != valor só para NaN, sem o custo de pd.isna)
+                        if numero_nf_raw is None or numero_nf_raw != numero_nf_raw or numero_nf_raw == '':
+                            logger.debug(f"Linha {linha}: Número da NF vazio, pulando")
+                            continue
+                        
+                        numero_nf = str(numero_nf_raw).strip()
+                        if not numero_nf:
+                            logger.debug(f"Linha {linha}: Número da NF vazio após limpeza, pulando")
+                            continue
+                        
+                        # Nota fiscal correspondente (IDs já carregados antes do laço)
+                        nota_fiscal_id = ids_por_numero.get(numero_nf)
+                        ultimo_numero_raw, ultimo_numero_nf, ultimo_nota_id = numero_nf_raw, numero_nf, nota_fiscal_id
                     
-                    # Buscar a nota fiscal correspondente no banco
-                    nota_fiscal_id = self.db_manager.buscar_nota_fiscal_por_numero(numero_nf)
                     if not nota_fiscal_id:
-                        logger.warning(f"Nota fiscal {numero_nf} não encontrada para o item na linha {index + 1}")
+                        logger.warning(f"Nota fiscal {numero_nf} não encontrada para o item na linha {linha}")
                         erros_processamento += 1
                         continue
                     
-                    # Função auxiliar para conversão segura de valores numéricos
-                    def converter_valor_numerico(valor, nome_campo, linha):
-                        """Converte valor para float de forma segura"""
-                        if pd.isna(valor) or valor == '' or valor is None:
-                            return 0.0
-                        
-                        try:
-                            # Converter para string e limpar
-                            valor_str = str(valor).strip()
-                            if not valor_str:
-                                return 0.0
-                            
-                            # Remover caracteres não numéricos exceto vírgula e ponto
-                            valor_limpo = re.sub(r'[^\d,.-]', '', valor_str)
-                            
-                            # Tratar vírgula como separador decimal
-                            if ',' in valor_limpo and '.' in valor_limpo:
-                                # Se tem ambos, assumir que vírgula é separador decimal
-                                valor_limpo = valor_limpo.replace('.', '').replace(',', '.')
-                            elif ',' in valor_limpo:
-                                valor_limpo = valor_limpo.replace(',', '.')
-                            
-                            return float(valor_limpo)
-                        except (ValueError, TypeError) as e:
-                            logger.warning(f"Erro ao converter {nome_campo} na linha {linha}: {valor} -> {e}")
-                            return 0.0
-                    
-                    # Extrair e validar dados do item
-                    quantidade = converter_valor_numerico(
-                        row.get(colunas_encontradas.get('quantidade', 'quantidade'), 0), 
-                        'quantidade', 
-                        index + 1
-                    )
-                    
-                    valor_unitario = converter_valor_numerico(
-                        row.get(colunas_encontradas.get('valor_unitario', 'valor_unitario'), 0), 
-                        'valor_unitario', 
-                        index + 1
-                    )
-                    
-                    valor_total = converter_valor_numerico(
-                        row.get(colunas_encontradas.get('valor_total', 'valor_total'), 0), 
-                        'valor_total', 
-                        index + 1
-                    )
-                    
-                    # Se valor_total não estiver preenchido, calcular
+                    # Valores numéricos já convertidos por coluna; se valor_total não estiver preenchido, calcular
                     if valor_total == 0 and quantidade > 0 and valor_unitario > 0:
                         valor_total = quantidade * valor_unitario
                     
                     # Validar dados essenciais
-                    codigo_produto = str(row.get(colunas_encontradas['codigo_produto'], '')).strip()
-                    descricao = str(row.get(colunas_encontradas['descricao'], '')).strip()
-                    
                     if not codigo_produto and not descricao:
-                        logger.warning(f"Linha {index + 1}: Código e descrição do produto vazios, pulando")
+                        logger.warning(f"Linha {linha}: Código e descrição do produto vazios, pulando")
                         erros_processamento += 1
                         continue
                     
                     # Preparar dados do item
                     item_data = {
                         'nota_fiscal_id': nota_fiscal_id,
-                        'codigo': codigo_produto[:100] if codigo_produto else '',  # Limitar tamanho
-                        'descricao': descricao[:1000] if descricao else '',  # Limitar tamanho
-                        'ncm': str(row.get(colunas_encontradas.get('ncm', 'ncm'), ''))[:20],  # Limitar tamanho
+                        'codigo': codigo_produto,
+                        'descricao': descricao,
+                        'ncm': ncm,
                         'quantidade': quantidade,
                         'valor_unitario': valor_unitario,
                         'valor_total': valor_total
                     }
                     
-                    # Salvar item no banco
-                    if self.db_manager.salvar_item_nota_fiscal(item_data):
-                        itens_processados += 1
-                        logger.debug(f"Item da linha {index + 1} processado com sucesso")
-                    else:
-                        erros_processamento += 1
-                        logger.warning(f"Falha ao salvar item da linha {index + 1}")
+                    # Item gravado junto com os demais do arquivo, após o laço
+                    itens_lote.append(item_data)
                     
                 except Exception as e:
                     erros_processamento += 1
-                    logger.warning(f"Erro ao processar item na linha {index + 1}: {e}")
+                    logger.warning(f"Erro ao processar item na linha {linha}: {e}")
                     import traceback
-                    logger.debug(f"Traceback do erro na linha {index + 1}: {traceback.format_exc()}")
+                    logger.debug(f"Traceback do erro na linha {linha}: {traceback.format_exc()}")
                     continue
             
+            # Gravar todos os itens do arquivo de uma vez (COPY no PostgreSQL para lotes grandes)
+            if itens_lote:
+                try:
+                    itens_processados = self.db_manager.salvar_itens_nota_fiscal(itens_lote)
+                except Exception as e:
+                    erros_processamento += len(itens_lote)
+                    logger.error(f"Falha ao salvar os {len(itens_lote)} itens de {filename}: {e}")
+            
             # Relatório final
             total_linhas = len(df)
             logger.info(f"Processamento de itens concluído. Total de linhas: {total_linhas}, Itens processados: {itens_processados}, Erros: {erros_processamento}")
@@ -1542,38 +2478,38 @@ class Dashboard:
                 st.info(f"Colunas disponíveis: {', '.join(df.columns.tolist())}")
                 return []
             
+            # Conversões por coluna (datas inválidas viram a data atual), não linha a linha
+            datas_emissao = datas_csv(df['data_emissao'], datetime.now())
+            valores = pd.to_numeric(df['valor_total'], errors='coerce')
+            invalidos = (valores.isna() & df['valor_total'].notna()).tolist()
+            if any(invalidos):
+                logger.warning(f"{sum(invalidos)} linha(s) do CSV com valor_total inválido ignorada(s)")
+            
+            def texto(coluna, padrao):
+                if coluna in df.columns:
+                    return df[coluna].astype(str).tolist()
+                return [padrao] * len(df)
+            
             # Converter para lista de NotaFiscal
-            notas = []
-            for _, row in df.iterrows():
-                try:
-                    # Processar data_emissao corretamente
-                    data_emissao_str = str(row.get('data_emissao', datetime.now().date()))
-                    try:
-                        # Tentar diferentes formatos de data
-                        if '/' in data_emissao_str:
-                            data_emissao = datetime.strptime(data_emissao_str, '%d/%m/%Y')
-                        elif '-' in data_emissao_str:
-                            data_emissao = datetime.strptime(data_emissao_str, '%Y-%m-%d')
-                        else:
-                            data_emissao = datetime.now()
-                    except ValueError:
-                        logger.warning(f"Formato de data inválido: {data_emissao_str}. Usando data atual.")
-                        data_emissao = datetime.now()
-                    
-                    nota = NotaFiscal(
-                        numero=str(row.get('numero', '')),
-                        serie=str(row.get('serie', '1')),
-                        cnpj_emitente=str(row.get('cnpj_emitente', '')),
-                        nome_emitente=str(row.get('nome_emitente', '')),
-                        data_emissao=data_emissao,
-                        valor_total=float(row.get('valor_total', 0)),
-                        chave_acesso=str(row.get('chave_acesso', '')),
-                        natureza_operacao=str(row.get('natureza_operacao', ''))
-                    )
-                    notas.append(nota)
-                except Exception as e:
-                    logger.warning(f"Erro ao processar linha do CSV: {e}")
-                    continue
+            notas = [
+                NotaFiscal(
+                    numero=numero,
+                    serie=serie,
+                    cnpj_emitente=cnpj_emitente,
+                    nome_emitente=nome_emitente,
+                    data_emissao=data_emissao,
+                    valor_total=valor_total,
+                    chave_acesso=chave_acesso,
+                    natureza_operacao=natureza_operacao
+                )
+                for numero, serie, cnpj_emitente, nome_emitente, data_emissao, valor_total, chave_acesso, natureza_operacao, invalido
+                in zip(
+                    texto('numero', ''), texto('serie', '1'), texto('cnpj_emitente', ''), texto('nome_emitente', ''),
+                    datas_emissao, valores.astype('float64').tolist(), texto('chave_acesso', ''),
+                    texto('natureza_operacao', ''), invalidos
+                )
+                if not invalido
+            ]
             
             return notas
             
@@ -1581,52 +2517,65 @@ class Dashboard:
             logger.error(f"Erro ao processar CSV tradicional {filename}: {e}")
             return []
 
-    def processar_zip_upload(self, file_content, filename):
-        """Processa arquivo ZIP e extrai todos os arquivos suportados"""
+    def processar_zip_upload(self, arquivo_zip, filename):
+        """
+        Processa arquivo ZIP e extrai todos os arquivos suportados
+
+        Args:
+            arquivo_zip: Arquivo enviado (objeto com read/seek) ou conteúdo em bytes
+            filename: Nome do ZIP, para as mensagens
+        """
         resultados = {
             'processados': 0,
             'erros': 0,
             'detalhes': []
         }
+        detalhes = resultados['detalhes']  # Referência local, usada a cada arquivo
         
         try:
-            # Criar um objeto BytesIO para o conteúdo do ZIP
-            zip_buffer = io.BytesIO(file_content)
+            # Arquivo enviado usado diretamente; bytes são embrulhados em BytesIO
+            zip_buffer = io.BytesIO(arquivo_zip) if isinstance(arquivo_zip, (bytes, bytearray)) else arquivo_zip
             
             with zipfile.ZipFile(zip_buffer, 'r') as zip_ref:
                 # Listar arquivos no ZIP
                 file_list = zip_ref.namelist()
-                st.info(f"📦 Arquivo ZIP '{filename}' contém {len(file_list)} arquivo(s)")
                 
-                # Separar arquivos por tipo e prioridade
-                arquivos_cabecalho = []
-                arquivos_itens = []
-                outros_arquivos = []
+                # Processar na ordem correta: cabeçalho primeiro, depois outros, depois itens
+                # (classificação resumida em uma única mensagem, não uma por arquivo)
+                arquivos_ordenados, resumo = ordenar_arquivos_zip(file_list)
+                st.info(f"📦 Arquivo ZIP '{filename}' contém {len(file_list)} arquivo(s)\n\n{resumo}")
                 
-                st.info("🔍 **ANÁLISE DOS ARQUIVOS NO ZIP:**")
+                # Extrair os PDF/XML em paralelo antes da gravação (que segue a ordem abaixo);
+                # as entradas são lidas do ZIP sob demanda, uma janela por vez
+                def ler_entradas_nf():
+                    for file_name in arquivos_ordenados:
+                        if not file_name.lower().endswith(('.pdf', '.xml')):
+                            continue
+                        try:
+                            with zip_ref.open(file_name) as extracted_file:
+                                conteudo = extracted_file.read()
+                        except Exception as e:
+                            logger.error(f"Erro ao ler {file_name} do ZIP: {e}")
+                            continue
+                        yield file_name, conteudo
                 
-                for file_name in file_list:
-                    if file_name.endswith('/'):
-                        continue
-                    
-                    file_lower = file_name.lower()
-                    if any(keyword in file_lower for keyword in ['cabecalho', 'header']):
-                        arquivos_cabecalho.append(file_name)
-                        st.success(f"📋 CABEÇALHO identificado: {file_name}")
-                    elif any(keyword in file_lower for keyword in ['itens', 'items']):
-                        arquivos_itens.append(file_name)
-                        st.info(f"📦 ITENS identificado: {file_name}")
-                    else:
-                        outros_arquivos.append(file_name)
-                        st.info(f"📄 OUTRO arquivo: {file_name}")
+                notas_extraidas = dict(extrair_arquivos_paralelo(ler_entradas_nf()))
                 
-                # Processar na ordem correta: cabeçalho primeiro, depois outros, depois itens
-                arquivos_ordenados = arquivos_cabecalho + outros_arquivos + arquivos_itens
+                # PDF/XML consecutivos são gravados juntos, em lote, antes do próximo CSV e no final
+                pendentes = []
                 
-                st.success(f"✅ **ORDEM DE PROCESSAMENTO DEFINIDA:**")
-                st.success(f"1º → {len(arquivos_cabecalho)} arquivo(s) de cabeçalho")
-                st.success(f"2º → {len(outros_arquivos)} outro(s) arquivo(s)")
-                st.success(f"3º → {len(arquivos_itens)} arquivo(s) de itens")
+                def gravar_pendentes():
+                    if not pendentes:
+                        return
+                    salvas = self.salvar_notas_fiscais([nota for _, nota in pendentes])
+                    for (nome, _), salva in zip(pendentes, salvas):
+                        if salva:
+                            resultados['processados'] += 1
+                            detalhes.append(f"✅ {nome}: Processado com sucesso")
+                        else:
+                            resultados['erros'] += 1
+                            detalhes.append(f"❌ {nome}: Erro ao salvar no banco")
+                    pendentes.clear()
                 
                 # Processar cada arquivo na ordem correta
                 for file_name in arquivos_ordenados:
@@ -1640,70 +2589,64 @@ class Dashboard:
                         
                         # Verificar se é um tipo de arquivo suportado
                         if file_extension not in ['pdf', 'xml', 'csv']:
-                            resultados['detalhes'].append(f"⚠️ {file_name}: Tipo de arquivo não suportado")
+                            detalhes.append(f"⚠️ {file_name}: Tipo de arquivo não suportado")
                             continue
                         
-                        # Ler conteúdo do arquivo
-                        with zip_ref.open(file_name) as extracted_file:
-                            extracted_content = extracted_file.read()
-                        
-                        # Processar baseado no tipo
+                        # Processar baseado no tipo (PDF/XML já extraídos acima)
                         nota_fiscal = None
-                        if file_extension == 'pdf':
-                            nota_fiscal = self.processar_pdf_upload(extracted_content, file_name)
-                        elif file_extension == 'xml':
-                            nota_fiscal = self.processar_xml_upload(extracted_content, file_name)
+                        if file_extension in ('pdf', 'xml'):
+                            nota_fiscal = notas_extraidas.get(file_name)
                         elif file_extension == 'csv':
-                            notas_csv = self.processar_csv_upload(extracted_content, file_name)
+                            # Notas de PDF/XML anteriores gravadas antes (itens podem depender delas)
+                            gravar_pendentes()
+                            
+                            # Entrada lida direto do ZIP pelo pandas (sem copiar o conteúdo para bytes)
+                            with zip_ref.open(file_name) as extracted_file:
+                                notas_csv = self.processar_csv_upload(extracted_file, file_name)
                             
                             # Verificar se é um arquivo de itens (retorna lista vazia por design)
                             filename_lower = file_name.lower()
-                            is_items_file = 'itens' in filename_lower or 'items' in filename_lower
+                            is_items_file = any(palavra in filename_lower for palavra in _PALAVRAS_ITENS)
                             
                             if notas_csv is not None:  # Processamento bem-sucedido
                                 if notas_csv:  # Arquivo de cabeçalho com notas
-                                    for nota in notas_csv:
-                                        if self.salvar_nota_fiscal(nota):
-                                            resultados['processados'] += 1
-                                        else:
-                                            resultados['erros'] += 1
-                                    resultados['detalhes'].append(f"✅ {file_name}: {len(notas_csv)} nota(s) processada(s)")
+                                    salvas = sum(self.salvar_notas_fiscais(notas_csv))
+                                    resultados['processados'] += salvas
+                                    resultados['erros'] += len(notas_csv) - salvas
+                                    detalhes.append(f"✅ {file_name}: {len(notas_csv)} nota(s) processada(s)")
                                 elif is_items_file:  # Arquivo de itens (lista vazia é esperada)
                                     resultados['processados'] += 1
-                                    resultados['detalhes'].append(f"✅ {file_name}: Itens processados com sucesso")
+                                    detalhes.append(f"✅ {file_name}: Itens processados com sucesso")
                                 else:  # Arquivo CSV vazio ou sem dados válidos
                                     resultados['erros'] += 1
-                                    resultados['detalhes'].append(f"❌ {file_name}: Nenhum dado válido encontrado")
+                                    detalhes.append(f"❌ {file_name}: Nenhum dado válido encontrado")
                                 continue
                             else:  # Erro no processamento (retornou None)
                                 resultados['erros'] += 1
-                                resultados['detalhes'].append(f"❌ {file_name}: Erro no processamento")
+                                detalhes.append(f"❌ {file_name}: Erro no processamento")
                                 continue
                         
-                        # Salvar nota fiscal individual (PDF/XML)
+                        # Nota fiscal individual (PDF/XML): gravada no próximo lote
                         if nota_fiscal:
-                            if self.salvar_nota_fiscal(nota_fiscal):
-                                resultados['processados'] += 1
-                                resultados['detalhes'].append(f"✅ {file_name}: Processado com sucesso")
-                            else:
-                                resultados['erros'] += 1
-                                resultados['detalhes'].append(f"❌ {file_name}: Erro ao salvar no banco")
+                            pendentes.append((file_name, nota_fiscal))
                         else:
                             resultados['erros'] += 1
-                            resultados['detalhes'].append(f"❌ {file_name}: Erro no processamento")
+                            detalhes.append(f"❌ {file_name}: Erro no processamento")
                             
                     except Exception as e:
                         resultados['erros'] += 1
-                        resultados['detalhes'].append(f"❌ {file_name}: {str(e)}")
+                        detalhes.append(f"❌ {file_name}: {str(e)}")
                         logger.error(f"Erro ao processar arquivo {file_name} do ZIP: {e}")
+                
+                gravar_pendentes()
                         
         except zipfile.BadZipFile:
             resultados['erros'] += 1
-            resultados['detalhes'].append(f"❌ {filename}: Arquivo ZIP corrompido ou inválido")
+            detalhes.append(f"❌ {filename}: Arquivo ZIP corrompido ou inválido")
             st.error(f"Arquivo ZIP '{filename}' está corrompido ou não é um arquivo ZIP válido")
         except Exception as e:
             resultados['erros'] += 1
-            resultados['detalhes'].append(f"❌ {filename}: {str(e)}")
+            detalhes.append(f"❌ {filename}: {str(e)}")
             logger.error(f"Erro ao processar ZIP {filename}: {e}")
             st.error(f"Erro ao processar ZIP: {e}")
         
@@ -1717,6 +2660,14 @@ class Dashboard:
             logger.error(f"Erro ao salvar nota fiscal: {e}")
             return False
 
+    def salvar_notas_fiscais(self, notas):
+        """Salva várias notas fiscais no banco de dados em uma única transação"""
+        try:
+            return self.db_manager.salvar_notas_fiscais_batch(notas)
+        except Exception as e:
+            logger.error(f"Erro ao salvar notas fiscais em lote: {e}")
+            return [False] * len(notas)
+
     def mostrar_resultados_processamento(self, resultados):
         """Mostra os resultados do processamento"""
         st.markdown("---")
@@ -1732,11 +2683,13 @@ class Dashboard:
         
         if resultados['detalhes']:
             st.subheader("📋 Detalhes")
-            for detalhe in resultados['detalhes']:
-                if "✅" in detalhe:
-                    st.success(detalhe)
-                else:
-                    st.error(detalhe)
+            # Um bloco por tipo (não um elemento por arquivo): ZIPs grandes geram centenas de detalhes
+            sucessos = [detalhe for detalhe in resultados['detalhes'] if "✅" in detalhe]
+            falhas = [detalhe for detalhe in resultados['detalhes'] if "✅" not in detalhe]
+            if sucessos:
+                st.success("  \n".join(sucessos))
+            if falhas:
+                st.error("  \n".join(falhas))
     
     def render_gerenciar_usuarios(self):
         """Renderiza interface de gerenciamento de usuários (apenas para admins)"""
@@ -1890,34 +2843,25 @@ class Dashboard:
                         if is_self:
                             st.info("ℹ️ Você não pode desativar sua própria conta")
                         
-                        # Resetar senha
+                        # Resetar senha (fragmento: o envio não reexecuta a página inteira)
                         with st.expander("🔑 Resetar Senha"):
-                            with st.form(f"reset_password_{selected_user_id}"):
-                                new_password = st.text_input("Nova Senha", type="password")
-                                new_password_confirm = st.text_input("Confirmar Nova Senha", type="password")
-                                
-                                reset_btn = st.form_submit_button("🔑 Resetar Senha")
-                                
-                                if reset_btn:
-                                    if not new_password or not new_password_confirm:
-                                        st.error("❌ Preencha ambos os campos de senha")
-                                    elif new_password != new_password_confirm:
-                                        st.error("❌ As senhas não coincidem")
-                                    else:
-                                        success, message = auth.user_manager.update_user_password(
-                                            selected_user_id, new_password
-                                        )
-                                        if success:
-                                            st.success(f"✅ {message}")
-                                        else:
-                                            st.error(f"❌ {message}")
+                            formulario_reset_senha(selected_user_id)
             else:
                 st.info("Nenhum usuário encontrado para gerenciar.")
 
 if __name__ == "__main__":
+    # Configurar página antes de qualquer outro comando do Streamlit
+    st.set_page_config(
+        page_title="Gestor Fiscal AI", 
+        layout="wide", 
+        initial_sidebar_state="expanded",
+        page_icon="🤖"
+    )
     try:
-        dashboard = Dashboard()
-        dashboard.run()
+        # Dashboard criado uma vez por sessão; cada rerun do Streamlit só executa run()
+        if 'dashboard' not in st.session_state:
+            st.session_state.dashboard = Dashboard()
+        st.session_state.dashboard.run()
     except Exception as e:
-        logger.critical(f"A aplicação principal falhou: {e}")
+        logger.critical("A aplicação principal falhou: %s", e, exc_info=True)
         st.error(f"Ocorreu um erro crítico na aplicação. Verifique os logs.")
\ No newline at end of file
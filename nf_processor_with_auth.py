@@ -8,9 +8,10 @@ import os
 import json
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-from dataclasses import dataclass, asdict
-from sqlalchemy import create_engine, text, exc
+from typing import Dict, List, Optional, Any, Iterator
+from dataclasses import dataclass, asdict, is_dataclass
+from sqlalchemy import create_engine, text, exc, inspect
+from sqlalchemy.engine import make_url
 import pandas as pd
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
@@ -20,7 +21,6 @@ from plotly.subplots import make_subplots
 from pathlib import Path
 import tempfile
 from dotenv import load_dotenv
-import google.generativeai as genai
 from decimal import Decimal, InvalidOperation
 import re
 import unicodedata
@@ -32,14 +32,20 @@ from auth_streamlit import auth
 from security_utils import SecurityConfig, DataSanitizer, SecurityAuditor
 from secure_config import get_secure_config, SecureConfigError
 from user_manager import UserManager
-from nf_processor import XMLExtractor, PDFExtractor
+from nf_processor import (
+    XMLExtractor, PDFExtractor, extrair_arquivos_paralelo,
+    notas_de_csv_cabecalho, ler_csv, mapear_colunas_cabecalho, mapear_colunas_itens, dia_seguinte,
+    resumo_notas_para_ia, CONFIG_GERACAO_GEMINI, valores_numericos_csv, obter_config_segura, garantir_admin,
+    ordenar_arquivos_zip, datas_csv, formulario_reset_senha,
+    ConsultasNotasFiscais, _modelo_gemini, _database_manager, _notas_periodo
+)
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@dataclass
+@dataclass(slots=True)
 class NotaFiscal:
     numero: str
     serie: str
@@ -50,7 +56,7 @@ class NotaFiscal:
     chave_acesso: str
     natureza_operacao: str
     itens: List[Dict[str, Any]] = None
-    xml_content: Optional[str] = None
+    xml_content: Optional[bytes] = None
     origem: str = 'upload'  # 'email' ou 'upload'
     
     def __post_init__(self):
@@ -72,8 +78,10 @@ class NotaFiscal:
             'origem': self.origem
         }
 
-class DatabaseManager:
+class DatabaseManager(ConsultasNotasFiscais):
     def __init__(self, secure_config=None):
+        # INSERTs de salvar_dados já montados, por (tabela, colunas)
+        self._insert_stmts = {}
         try:
             if secure_config is None:
                 secure_config = get_secure_config()
@@ -93,6 +101,11 @@ class DatabaseManager:
             else:
                 # PostgreSQL e outros bancos suportam connect_timeout
                 connect_args = {'connect_timeout': 10}
+                opcoes_engine = {}
+                if make_url(secure_config.DATABASE_URL).get_driver_name() == 'psycopg2':
+                    # executemany de text() via execute_batch, não um comando por linha
+                    opcoes_engine['executemany_mode'] = 'values_plus_batch'
+                    opcoes_engine['executemany_batch_page_size'] = 500
                 self.engine = create_engine(
                     secure_config.DATABASE_URL,
                     connect_args=connect_args,
@@ -100,7 +113,9 @@ class DatabaseManager:
                     pool_pre_ping=True,  # Verifica conexões antes de usar
                     pool_recycle=3600,   # Recicla conexões a cada hora
                     max_overflow=0,      # Limita conexões extras
-                    pool_size=5          # Pool de conexões limitado
+                    pool_size=5,         # Pool de conexões limitado
+                    insertmanyvalues_page_size=1000,  # Linhas por INSERT ... VALUES em lote
+                    **opcoes_engine
                 )
             
             # Teste de conexão seguro
@@ -151,7 +166,7 @@ class DatabaseManager:
                             cnpj_emitente VARCHAR(18) NOT NULL,
                             nome_emitente VARCHAR(255) NOT NULL,
                             valor_total DECIMAL(15,2) NOT NULL,
-                            xml_content TEXT,
+                            xml_content BYTEA,
                             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                         )
                     """)
@@ -164,7 +179,7 @@ class DatabaseManager:
                             cnpj_emitente VARCHAR(18) NOT NULL,
                             nome_emitente VARCHAR(255) NOT NULL,
                             valor_total DECIMAL(15,2) NOT NULL,
-                            xml_content TEXT,
+                            xml_content BLOB,
                             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                         )
                     """)
@@ -205,6 +220,14 @@ class DatabaseManager:
                 
                 connection.execute(create_itens_nota_fiscal)
                 
+                # Índices do filtro por período e da busca de itens por nota
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_nf_data_emissao ON notas_fiscais (data_emissao DESC)"
+                ))
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_itens_nota_fiscal_id ON itens_nota_fiscal (nota_fiscal_id)"
+                ))
+                
                 logger.info("Tabelas criadas com sucesso (se não existiam)")
                 
         except Exception as e:
@@ -219,12 +242,13 @@ class DatabaseManager:
             if filtros:
                 conditions = []
                 for key, value in filtros.items():
+                    # Intervalo semiaberto sem DATE() na coluna (usa o índice de data_emissao)
                     if key == 'data_emissao_inicio':
-                        conditions.append("DATE(data_emissao) >= :data_inicio")
-                        params['data_inicio'] = value
+                        conditions.append("data_emissao >= :data_inicio")
+                        params['data_inicio'] = str(value)[:10]
                     elif key == 'data_emissao_fim':
-                        conditions.append("DATE(data_emissao) <= :data_fim")
-                        params['data_fim'] = value
+                        conditions.append("data_emissao < :data_fim")
+                        params['data_fim'] = dia_seguinte(value)
                     else:
                         conditions.append(f"{key} = :{key}")
                         params[key] = value
@@ -240,6 +264,65 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar dados: {e}")
             return []
 
+    # Colunas usadas pelo dashboard (sem xml_content, que domina o tamanho de cada linha)
+    COLUNAS_NOTAS_DF = ('id', 'numero', 'data_emissao', 'cnpj_emitente', 'nome_emitente', 'valor_total', 'origem')
+
+    # Colunas de notas_fiscais, lidas do catálogo na primeira busca (ver _colunas_notas_existentes)
+    _colunas_notas = None
+
+    def _colunas_notas_existentes(self, colunas):
+        """Mantém só as colunas pedidas que existem em notas_fiscais (origem vem da migração 0001)"""
+        if self._colunas_notas is None:
+            try:
+                self._colunas_notas = {coluna['name'] for coluna in inspect(self.engine).get_columns('notas_fiscais')}
+            except exc.SQLAlchemyError as e:
+                logger.warning(f"Não foi possível listar as colunas de notas_fiscais: {e}")
+                return list(colunas)
+        return [coluna for coluna in colunas if coluna in self._colunas_notas]
+
+    def buscar_notas_df(self, data_inicio, data_fim, colunas=COLUNAS_NOTAS_DF) -> pd.DataFrame:
+        """
+        Notas do período direto em um DataFrame (pd.read_sql_query), só com as colunas pedidas
+
+        Evita o dict por linha de buscar_dados: valor_total já vem como float64 e
+        data_emissao como datetime64.
+        """
+        colunas = self._colunas_notas_existentes(colunas)
+        query = text(
+            f"SELECT {', '.join(colunas)} FROM notas_fiscais "
+            "WHERE data_emissao >= :data_inicio AND data_emissao < :data_fim"
+        )
+        params = {'data_inicio': str(data_inicio)[:10], 'data_fim': dia_seguinte(data_fim)}
+        try:
+            with self.engine.connect() as conn:
+                df = pd.read_sql_query(
+                    query, conn, params=params,
+                    parse_dates=['data_emissao'] if 'data_emissao' in colunas else None
+                )
+        except Exception as e:
+            logger.error(f"Erro ao buscar notas fiscais: {e}")
+            return pd.DataFrame()
+        
+        if 'valor_total' in df.columns:
+            df['valor_total'] = df['valor_total'].astype('float64')
+        return df
+
+    def resumo_notas_banco(self):
+        """Total de notas e soma de valor_total no banco inteiro, agregados no próprio banco"""
+        with self.engine.connect() as connection:
+            total, valor = connection.execute(
+                text("SELECT COUNT(*), COALESCE(SUM(valor_total), 0) FROM notas_fiscais")
+            ).one()
+        return {'total_notas': int(total), 'valor_total': float(valor)}
+
+    def primeiras_notas(self, limite=10):
+        """Primeiras notas gravadas (amostra), sem carregar a tabela inteira"""
+        with self.engine.connect() as connection:
+            result = connection.execute(
+                text("SELECT * FROM notas_fiscais ORDER BY id LIMIT :limite"), {'limite': int(limite)}
+            )
+            return [dict(row._mapping) for row in result]
+
     def buscar_nota_fiscal_por_numero(self, numero):
         """Busca uma nota fiscal pelo número e retorna seu ID"""
         try:
@@ -251,35 +334,54 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar nota fiscal por número {numero}: {e}")
             return None
 
+    _INSERT_ITEM = text("""
+        INSERT INTO itens_nota_fiscal 
+        (nota_fiscal_id, codigo, descricao, ncm, quantidade, valor_unitario, valor_total)
+        VALUES (:nota_fiscal_id, :codigo, :descricao, :ncm, :quantidade, :valor_unitario, :valor_total)
+    """)
+
     def salvar_item_nota_fiscal(self, item_data):
-        """Salva um item de nota fiscal no banco de dados"""
+        """Salva um item de nota fiscal no banco de dados (lote de um item de salvar_itens_nota_fiscal)"""
+        return self.salvar_itens_nota_fiscal([item_data]) == 1
+
+    def salvar_itens_nota_fiscal(self, itens):
+        """Salva vários itens em uma única transação (executemany); retorna quantos foram gravados"""
+        if not itens:
+            return 0
         try:
             with self.engine.begin() as connection:
-                query = text("""
-                    INSERT INTO itens_nota_fiscal 
-                    (nota_fiscal_id, codigo, descricao, ncm, quantidade, valor_unitario, valor_total)
-                    VALUES (:nota_fiscal_id, :codigo, :descricao, :ncm, :quantidade, :valor_unitario, :valor_total)
-                """)
-                connection.execute(query, item_data)
-                return True
+                connection.execute(self._INSERT_ITEM, itens)
+            logger.info(f"{len(itens)} item(ns) de nota fiscal gravado(s) em lote")
+            return len(itens)
         except Exception as e:
-            logger.error(f"Erro ao salvar item da nota fiscal: {e}")
-            return False
+            logger.error(f"Erro ao salvar {len(itens)} itens da nota fiscal: {e}")
+            return 0
 
-    def salvar_dados(self, tabela, dados):
-        """Salva dados em uma tabela específica"""
-        try:
-            # Construir query de inserção dinamicamente
-            colunas = list(dados.keys())
-            placeholders = [f":{col}" for col in colunas]
-            
-            query = text(f"""
+    def _get_insert(self, tabela, colunas):
+        """INSERT parametrizado para (tabela, colunas), montado uma vez e reaproveitado"""
+        stmt = self._insert_stmts.get((tabela, colunas))
+        if stmt is None:
+            stmt = text(f"""
                 INSERT INTO {tabela} ({', '.join(colunas)})
-                VALUES ({', '.join(placeholders)})
+                VALUES ({', '.join(f":{col}" for col in colunas)})
             """)
-            
+            self._insert_stmts[(tabela, colunas)] = stmt
+        return stmt
+
+    def salvar_dados(self, tabela, dados):
+        """
+        Salva dados em uma tabela específica
+
+        Aceita um dict ou uma lista de dicts com as mesmas chaves; a lista é
+        gravada em uma única transação (executemany).
+        """
+        lote = dados if isinstance(dados, list) else [dados]
+        if not lote:
+            return True
+        try:
+            query = self._get_insert(tabela, tuple(lote[0].keys()))
             with self.engine.begin() as connection:
-                connection.execute(query, dados)
+                connection.execute(query, lote)
                 return True
         except Exception as e:
             logger.error(f"Erro ao salvar dados na tabela {tabela}: {e}")
@@ -295,27 +397,18 @@ class GeminiChat:
         if not hasattr(config, 'GEMINI_API_KEY') or not config.GEMINI_API_KEY or "AIza" not in config.GEMINI_API_KEY:
             raise ValueError("A chave da API do Gemini não foi configurada corretamente.")
         
-        genai.configure(api_key=config.GEMINI_API_KEY)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.model = _modelo_gemini(config.GEMINI_API_KEY, 'gemini-2.5-flash')
         
-    def responder_pergunta(self, pergunta: str, df_notas: pd.DataFrame) -> str:
-        """Responde perguntas sobre as notas fiscais usando IA"""
-        if df_notas.empty:
-            return "❌ Não há dados de notas fiscais para analisar. Por favor, faça upload de arquivos ou ajuste os filtros de período."
+    @staticmethod
+    def _montar_prompt(pergunta: str, df_notas: pd.DataFrame) -> str:
+        """Prompt com o resumo estatístico do período inteiro (poucos tokens) em vez das primeiras linhas em CSV"""
+        dados_resumo = resumo_notas_para_ia(df_notas)
         
-        try:
-            # Preparar dados para análise (limitando a 100 registros para performance)
-            df_analise = df_notas.head(100).copy()
-            
-            # Converter para CSV para enviar ao Gemini
-            dados_csv = df_analise.to_csv(index=False, sep=';')
-            
-            # Criar prompt estruturado
-            prompt = f"""
-Você é um assistente especializado em análise fiscal e contábil. Analise os dados das notas fiscais fornecidos em formato CSV e responda à pergunta do usuário de forma clara e objetiva.
+        return f"""
+Você é um assistente especializado em análise fiscal e contábil. Analise o resumo das notas fiscais fornecido em formato JSON e responda à pergunta do usuário de forma clara e objetiva.
 
-DADOS DAS NOTAS FISCAIS (CSV):
-{dados_csv}
+RESUMO DAS NOTAS FISCAIS (JSON):
+{dados_resumo}
 
 PERGUNTA DO USUÁRIO:
 {pergunta}
@@ -330,18 +423,65 @@ INSTRUÇÕES:
 
 RESPOSTA:
 """
-            
-            # Chamar a API do Gemini
-            response = self.model.generate_content(prompt)
-            
-            if response and response.text:
-                return response.text
-            else:
-                return "❌ Não foi possível gerar uma resposta. Tente reformular sua pergunta."
+
+    def responder_pergunta(self, pergunta: str, df_notas: pd.DataFrame) -> str:
+        """Responde perguntas sobre as notas fiscais usando IA"""
+        return "".join(self.responder_pergunta_stream(pergunta, df_notas))
+
+    def responder_pergunta_stream(self, pergunta: str, df_notas: pd.DataFrame) -> Iterator[str]:
+        """Gera a resposta em partes, à medida que o Gemini as devolve"""
+        if df_notas.empty:
+            yield "❌ Não há dados de notas fiscais para analisar. Por favor, faça upload de arquivos ou ajuste os filtros de período."
+            return
+        
+        try:
+            response = self.model.generate_content(
+                self._montar_prompt(pergunta, df_notas), generation_config=CONFIG_GERACAO_GEMINI, stream=True
+            )
+            gerou_texto = False
+            for parte in response:
+                # Partes sem texto (bloqueadas ou só com o motivo de término): .text levanta ValueError
+                try:
+                    texto = parte.text
+                except ValueError:
+                    continue
+                if texto:
+                    gerou_texto = True
+                    yield texto
+            if not gerou_texto:
+                yield "❌ Não foi possível gerar uma resposta. Tente reformular sua pergunta."
                 
         except Exception as e:
             logger.error(f"Erro ao chamar a API do Gemini: {e}")
-            return f"❌ Ocorreu um erro ao processar sua pergunta: {str(e)}"
+            yield f"❌ Ocorreu um erro ao processar sua pergunta: {str(e)}"
+
+@st.cache_data(ttl=900)
+def _resumo_notas_banco(database_url: str, _db_manager: DatabaseManager) -> dict:
+    """Total e valor de todas as notas do banco (COUNT/SUM), reaproveitados por até 15 minutos"""
+    return _db_manager.resumo_notas_banco()
+
+@st.cache_data(ttl=300, max_entries=64)
+def _agregados_visao_geral(database_url: str, data_inicio: str, data_fim: str, _db_manager: DatabaseManager) -> dict:
+    """
+    Métricas e séries dos gráficos da visão geral, por período
+
+    Chaveado pelos mesmos filtros de _notas_periodo: reruns sem mudança de
+    período (troca de aba, autorefresh) reaproveitam os groupby já calculados.
+    """
+    df_notas = _notas_periodo(database_url, data_inicio, data_fim, _db_manager, __name__)
+    valores = pd.to_numeric(df_notas['valor_total'], errors='coerce').fillna(0)
+    agregados = {
+        'total_notas': len(df_notas),
+        'valor_total': float(valores.sum()),
+        'ticket_medio': float(valores.mean()),
+        'fornecedores': int(df_notas['cnpj_emitente'].nunique()),
+        'top_fornecedores': valores.groupby(df_notas['nome_emitente']).sum().nlargest(10).sort_values(),
+        'valores_por_dia': valores.groupby(pd.to_datetime(df_notas['data_emissao'], errors='coerce').dt.date).sum(),
+    }
+    if 'origem' in df_notas.columns:
+        agregados['origem_count'] = df_notas['origem'].value_counts()
+        agregados['origem_valor'] = valores.groupby(df_notas['origem']).sum()
+    return agregados
 
 class Dashboard:
     def __init__(self):
@@ -349,25 +489,12 @@ class Dashboard:
         self._init_session_state()
         
         try:
-            # Configurar página antes de qualquer coisa
-            st.set_page_config(
-                page_title="Gestor Fiscal AI", 
-                layout="wide", 
-                initial_sidebar_state="expanded",
-                page_icon="🤖"
-            )
-            
-            # Criar usuário admin se necessário
-            auth.create_admin_if_needed()
-            
-            # Verificar autenticação
-            if not auth.is_authenticated():
-                auth.show_login_page()
-                st.stop()
+            # Criar usuário admin se necessário (uma vez por processo)
+            garantir_admin()
             
-            # Inicializar configurações após autenticação
-            self.config = get_secure_config()
-            self.db_manager = DatabaseManager(secure_config=self.config)
+            # Inicializar configurações (a autenticação é verificada a cada execução, em run)
+            self.config = obter_config_segura()
+            self.db_manager = _database_manager(self.config.DATABASE_URL, self.config, DatabaseManager, __name__)
             
         except SecureConfigError as e:
             st.error(f"Erro de configuração: {e}")
@@ -389,6 +516,11 @@ class Dashboard:
             st.session_state.load_error = None
 
     def run(self):
+        # Verificar autenticação (a instância é reaproveitada na sessão, inclusive após logout)
+        if not auth.is_authenticated():
+            auth.show_login_page()
+            st.stop()
+        
         # Auto-refresh a cada 10 minutos
         st_autorefresh(interval=600000, key="datarefresher")
         
@@ -402,6 +534,9 @@ class Dashboard:
         
         # Botão para recarregar dados
         if st.sidebar.button("🔄 Recarregar Dados"):
+            _notas_periodo.clear()
+            _agregados_visao_geral.clear()
+            _resumo_notas_banco.clear()
             st.session_state.data_loaded = False
             st.rerun()
         
@@ -451,8 +586,13 @@ class Dashboard:
         with tab6:
             self.render_gerenciar_usuarios()
 
-    def carregar_dados(self):
-        """Carrega dados do banco com cache inteligente"""
+    def carregar_dados(self, recarregar=False):
+        """Carrega dados do banco com cache inteligente (recarregar=True descarta os caches)"""
+        if recarregar:
+            _notas_periodo.clear()
+            _agregados_visao_geral.clear()
+            _resumo_notas_banco.clear()
+            st.session_state.data_loaded = False
         try:
             logger.info(f"🔍 DEBUG: Iniciando carregar_dados()")
             logger.info(f"🔍 DEBUG: self.data_inicio = {self.data_inicio}")
@@ -478,14 +618,11 @@ class Dashboard:
                 # Log de debug dos filtros
                 logger.info(f"🔍 DEBUG: Filtros aplicados - início: {filtros['data_emissao_inicio']}, fim: {filtros['data_emissao_fim']}")
                 
-                logger.info(f"🔍 DEBUG: Chamando self.db_manager.buscar_dados()")
-                notas_data = self.db_manager.buscar_dados('notas_fiscais', filtros)
-                logger.info(f"🔍 DEBUG: Dados retornados do banco: {len(notas_data) if notas_data else 0} registros")
-                
-                if notas_data:
-                    logger.info(f"🔍 DEBUG: Primeiro registro: {notas_data[0] if notas_data else 'None'}")
-                
-                df_notas = pd.DataFrame(notas_data) if notas_data else pd.DataFrame()
+                # Consulta compartilhada entre reruns/sessões com os mesmos filtros (st.cache_data)
+                df_notas = _notas_periodo(
+                    self.config.DATABASE_URL, filtros['data_emissao_inicio'], filtros['data_emissao_fim'],
+                    self.db_manager, __name__
+                )
                 
                 # Log de debug dos resultados
                 logger.info(f"🔍 DEBUG: DataFrame criado com {len(df_notas)} linhas")
@@ -504,11 +641,9 @@ class Dashboard:
                 
                 # Se não há dados no período, verificar se há dados no banco
                 if df_notas.empty:
-                    todas_notas = self.db_manager.buscar_dados('notas_fiscais', {})
-                    if todas_notas:
-                        st.session_state.total_notas_banco = len(todas_notas)
-                    else:
-                        st.session_state.total_notas_banco = 0
+                    # COUNT(*) no banco, sem carregar as notas
+                    resumo = _resumo_notas_banco(self.config.DATABASE_URL, self.db_manager)
+                    st.session_state.total_notas_banco = resumo['total_notas']
                 
         except Exception as e:
             error_msg = f"Erro ao carregar dados: {e}"
@@ -545,26 +680,26 @@ class Dashboard:
                 """)
             return
         
-        # Converter valores para numérico
-        df_notas['valor_total'] = pd.to_numeric(df_notas['valor_total'], errors='coerce').fillna(0)
+        # Agregações cacheadas pelo período carregado (mesmas chaves de carregar_dados)
+        data_inicio, data_fim = st.session_state.last_filters
+        agregados = _agregados_visao_geral(
+            self.config.DATABASE_URL, data_inicio.isoformat(), data_fim.isoformat(), self.db_manager
+        )
         
         # Métricas principais
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Total de Notas", f"{df_notas.shape[0]:,}")
+            st.metric("Total de Notas", f"{agregados['total_notas']:,}")
         
         with col2:
-            total_valor = df_notas['valor_total'].sum()
-            st.metric("Valor Total", f"R$ {total_valor:,.2f}")
+            st.metric("Valor Total", f"R$ {agregados['valor_total']:,.2f}")
         
         with col3:
-            ticket_medio = df_notas['valor_total'].mean()
-            st.metric("Ticket Médio", f"R$ {ticket_medio:,.2f}")
+            st.metric("Ticket Médio", f"R$ {agregados['ticket_medio']:,.2f}")
         
         with col4:
-            fornecedores = df_notas['cnpj_emitente'].nunique()
-            st.metric("Fornecedores Únicos", f"{fornecedores:,}")
+            st.metric("Fornecedores Únicos", f"{agregados['fornecedores']:,}")
         
         st.markdown("---")
         
@@ -573,49 +708,39 @@ class Dashboard:
         
         with col1:
             st.subheader("💰 Valor por Fornecedor (Top 10)")
-            if 'nome_emitente' in df_notas.columns:
-                valor_por_fornecedor = df_notas.groupby('nome_emitente')['valor_total'].sum().nlargest(10).sort_values()
-                if not valor_por_fornecedor.empty:
-                    fig = px.bar(
-                        valor_por_fornecedor, 
-                        x='valor_total', 
-                        y=valor_por_fornecedor.index, 
-                        orientation='h', 
-                        text_auto='.2s',
-                        title="Top 10 Fornecedores por Valor"
-                    )
-                    fig.update_layout(height=400)
-                    st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.info("Dados insuficientes para gráfico")
+            valor_por_fornecedor = agregados['top_fornecedores']
+            if not valor_por_fornecedor.empty:
+                fig = px.bar(
+                    valor_por_fornecedor, 
+                    x='valor_total', 
+                    y=valor_por_fornecedor.index, 
+                    orientation='h', 
+                    text_auto='.2s',
+                    title="Top 10 Fornecedores por Valor"
+                )
+                fig.update_layout(height=400)
+                st.plotly_chart(fig, use_container_width=True)
             else:
-                st.info("Coluna 'nome_emitente' não encontrada")
+                st.info("Dados insuficientes para gráfico")
         
         with col2:
             st.subheader("📈 Evolução Diária de Valores")
-            if 'data_emissao' in df_notas.columns:
-                try:
-                    df_notas['data_emissao_dt'] = pd.to_datetime(df_notas['data_emissao'])
-                    valores_por_dia = df_notas.groupby(df_notas['data_emissao_dt'].dt.date)['valor_total'].sum()
-                    if not valores_por_dia.empty:
-                        fig = px.line(
-                            valores_por_dia, 
-                            x=valores_por_dia.index, 
-                            y='valor_total', 
-                            markers=True,
-                            title="Evolução Diária dos Valores"
-                        )
-                        fig.update_layout(height=400)
-                        st.plotly_chart(fig, use_container_width=True)
-                    else:
-                        st.info("Dados insuficientes para gráfico")
-                except Exception as e:
-                    st.error(f"Erro ao processar datas: {e}")
+            valores_por_dia = agregados['valores_por_dia']
+            if not valores_por_dia.empty:
+                fig = px.line(
+                    valores_por_dia, 
+                    x=valores_por_dia.index, 
+                    y='valor_total', 
+                    markers=True,
+                    title="Evolução Diária dos Valores"
+                )
+                fig.update_layout(height=400)
+                st.plotly_chart(fig, use_container_width=True)
             else:
-                st.info("Coluna 'data_emissao' não encontrada")
+                st.info("Dados insuficientes para gráfico")
         
         # Nova seção: Distribuição por Origem
-        if 'origem' in df_notas.columns:
+        if 'origem_count' in agregados:
             st.markdown("---")
             st.subheader("📊 Distribuição por Origem")
             
@@ -623,7 +748,7 @@ class Dashboard:
             
             with col1:
                 # Gráfico de pizza - Quantidade por origem
-                origem_count = df_notas['origem'].value_counts()
+                origem_count = agregados['origem_count']
                 if not origem_count.empty:
                     fig = px.pie(
                         values=origem_count.values, 
@@ -637,7 +762,7 @@ class Dashboard:
             
             with col2:
                 # Gráfico de barras - Valor por origem
-                origem_valor = df_notas.groupby('origem')['valor_total'].sum()
+                origem_valor = agregados['origem_valor']
                 if not origem_valor.empty:
                     fig = px.bar(
                         x=origem_valor.index,
@@ -838,10 +963,14 @@ class Dashboard:
             
             # Gerar resposta da IA
             with st.chat_message("assistant"):
+                # Resposta exibida à medida que chega (streaming), sem esperar o texto completo
+                placeholder = st.empty()
                 with st.spinner("🤖 Analisando seus dados..."):
                     try:
-                        response = gemini_chat.responder_pergunta(prompt, st.session_state.df_notas)
-                        st.markdown(response)
+                        response = ""
+                        for parte in gemini_chat.responder_pergunta_stream(prompt, st.session_state.df_notas):
+                            response += parte
+                            placeholder.markdown(response)
                         
                         # Adicionar resposta ao histórico
                         st.session_state.chat_messages.append({"role": "assistant", "content": response})
@@ -944,27 +1073,23 @@ class Dashboard:
         st.subheader("📊 Informações do Banco de Dados")
         
         try:
-            todas_notas = self.db_manager.buscar_dados('notas_fiscais', {})
-            if todas_notas:
-                df_todas = pd.DataFrame(todas_notas)
-                
+            # Total e soma agregados no banco; só a amostra exibida é carregada
+            resumo = _resumo_notas_banco(self.config.DATABASE_URL, self.db_manager)
+            if resumo['total_notas']:
                 # Armazenar total de notas no session_state para uso em outras seções
-                st.session_state.total_notas_banco = len(df_todas)
+                st.session_state.total_notas_banco = resumo['total_notas']
                 
                 col1, col2 = st.columns(2)
                 
                 with col1:
-                    st.metric("Total de Notas no Banco", len(df_todas))
+                    st.metric("Total de Notas no Banco", resumo['total_notas'])
                     
                 with col2:
-                    if 'valor_total' in df_todas.columns:
-                        df_todas['valor_total'] = pd.to_numeric(df_todas['valor_total'], errors='coerce').fillna(0)
-                        total_geral = df_todas['valor_total'].sum()
-                        st.metric("Valor Total Geral", f"R$ {total_geral:,.2f}")
+                    st.metric("Valor Total Geral", f"R$ {resumo['valor_total']:,.2f}")
                 
                 # Mostrar amostra dos dados
                 st.subheader("📋 Amostra dos Dados (10 primeiras)")
-                st.dataframe(df_todas.head(10), use_container_width=True)
+                st.dataframe(pd.DataFrame(self.db_manager.primeiras_notas(10)), use_container_width=True)
                 
             else:
                 st.warning("Nenhuma nota encontrada no banco de dados.")
@@ -1131,27 +1256,9 @@ class Dashboard:
                         if is_self:
                             st.info("ℹ️ Você não pode desativar sua própria conta")
                         
-                        # Resetar senha
+                        # Resetar senha (fragmento: o envio não reexecuta a página inteira)
                         with st.expander("🔑 Resetar Senha"):
-                            with st.form(f"reset_password_{selected_user_id}"):
-                                new_password = st.text_input("Nova Senha", type="password")
-                                new_password_confirm = st.text_input("Confirmar Nova Senha", type="password")
-                                
-                                reset_btn = st.form_submit_button("🔑 Resetar Senha")
-                                
-                                if reset_btn:
-                                    if not new_password or not new_password_confirm:
-                                        st.error("❌ Preencha ambos os campos de senha")
-                                    elif new_password != new_password_confirm:
-                                        st.error("❌ As senhas não coincidem")
-                                    else:
-                                        success, message = auth.user_manager.update_user_password(
-                                            selected_user_id, new_password
-                                        )
-                                        if success:
-                                            st.success(f"✅ {message}")
-                                        else:
-                                            st.error(f"❌ {message}")
+                            formulario_reset_senha(selected_user_id)
             else:
                 st.info("Nenhum usuário encontrado para gerenciar.")
 
@@ -1175,9 +1282,18 @@ class Dashboard:
                 progress_bar.progress(progress)
                 status_text.text(f"Processando: {uploaded_file.name} ({i+1}/{total_files})")
                 
+                file_extension = uploaded_file.name.lower().split('.')[-1]
+                
+                # ZIP: aberto direto do arquivo enviado (entradas lidas sob demanda, sem cópia em bytes)
+                if file_extension == 'zip':
+                    resultado_zip = self.processar_zip_upload(uploaded_file, uploaded_file.name)
+                    resultados['processados'] += resultado_zip['processados']
+                    resultados['erros'] += resultado_zip['erros']
+                    resultados['detalhes'].extend(resultado_zip['detalhes'])
+                    continue
+                
                 # Ler conteúdo do arquivo
                 file_content = uploaded_file.read()
-                file_extension = uploaded_file.name.lower().split('.')[-1]
                 
                 nota_fiscal = None
                 
@@ -1195,13 +1311,6 @@ class Dashboard:
                             else:
                                 resultados['erros'] += 1
                         continue
-                elif file_extension == 'zip':
-                    # Processar arquivo ZIP
-                    resultado_zip = self.processar_zip_upload(file_content, uploaded_file.name)
-                    resultados['processados'] += resultado_zip['processados']
-                    resultados['erros'] += resultado_zip['erros']
-                    resultados['detalhes'].extend(resultado_zip['detalhes'])
-                    continue
                 
                 # Salvar nota fiscal individual (PDF/XML)
                 if nota_fiscal:
@@ -1227,8 +1336,8 @@ class Dashboard:
         # Mostrar resultados
         self.mostrar_resultados_processamento(resultados)
         
-        # Recarregar dados
-        self.carregar_dados()
+        # Recarregar dados (descartando os caches, que ainda não têm as notas enviadas)
+        self.carregar_dados(recarregar=True)
 
     def processar_pdf_upload(self, file_content, filename):
         """Processa arquivo PDF usando a classe PDFExtractor existente"""
@@ -1249,28 +1358,8 @@ class Dashboard:
     def processar_csv_upload(self, file_content, filename):
         """Processa arquivo CSV e retorna lista de notas fiscais"""
         try:
-            # Decodificar conteúdo
-            try:
-                csv_text = file_content.decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    csv_text = file_content.decode('latin-1')
-                except UnicodeDecodeError:
-                    csv_text = file_content.decode('cp1252')
-            
-            # Tentar diferentes delimitadores
-            delimitadores = [';', ',', '\t', '|']
-            df = None
-            
-            for delim in delimitadores:
-                try:
-                    df = pd.read_csv(io.StringIO(csv_text), sep=delim, on_bad_lines='skip', encoding_errors='ignore')
-                    # Verificar se temos pelo menos algumas colunas
-                    if len(df.columns) > 1:
-                        break
-                except Exception as e:
-                    logger.warning(f"Erro ao tentar delimitador '{delim}': {e}")
-                    continue
+            # Delimitador e codificação detectados sem reprocessar o arquivo inteiro
+            df = ler_csv(file_content)
             
             if df is None or df.empty:
                 st.error(f"Não foi possível processar o arquivo CSV: {filename}")
@@ -1285,23 +1374,18 @@ class Dashboard:
             elif 'itens' in filename_lower or 'items' in filename_lower:
                 # VERIFICAÇÃO CRÍTICA: Bloquear processamento de itens se não há notas fiscais
                 try:
-                    with self.db_manager.engine.connect() as connection:
-                        count_query = text("SELECT COUNT(*) FROM notas_fiscais")
-                        total_notas = connection.execute(count_query).fetchone()[0]
-                        
-                        if total_notas == 0:
-                            st.error(f"🚫 BLOQUEADO: Arquivo de itens '{filename}' não pode ser processado!")
-                            st.error("📋 MOTIVO: Nenhuma nota fiscal encontrada no banco de dados.")
-                            st.error("✅ SOLUÇÃO: Processe primeiro o arquivo de cabeçalho.")
-                            return []
-                        else:
-                            st.success(f"✅ Pré-validação OK: {total_notas} notas fiscais encontradas no banco")
-                            st.info(f"📦 Processando arquivo de ITENS: {filename}")
+                    if not self._ha_notas_no_banco():
+                        st.error(f"🚫 BLOQUEADO: Arquivo de itens '{filename}' não pode ser processado!")
+                        st.error("📋 MOTIVO: Nenhuma nota fiscal encontrada no banco de dados.")
+                        st.error("✅ SOLUÇÃO: Processe primeiro o arquivo de cabeçalho.")
+                        return []
+                    st.success("✅ Pré-validação OK: há notas fiscais no banco")
+                    st.info(f"📦 Processando arquivo de ITENS: {filename}")
                 except Exception as e:
                     st.error(f"Erro ao verificar banco de dados: {e}")
                     return []
                 
-                return self._processar_csv_itens(df, filename)
+                return self._processar_csv_itens(df, filename, pre_validado=True)
             else:
                 # Processar como CSV tradicional (todas as informações em uma linha)
                 st.info(f"📄 Processando arquivo CSV tradicional: {filename}")
@@ -1312,52 +1396,49 @@ class Dashboard:
             st.error(f"Erro ao processar CSV: {e}")
             return None
 
-    def processar_zip_upload(self, file_content, filename):
-        """Processa arquivo ZIP e extrai todos os arquivos suportados"""
+    def processar_zip_upload(self, arquivo_zip, filename):
+        """
+        Processa arquivo ZIP e extrai todos os arquivos suportados
+
+        Args:
+            arquivo_zip: Arquivo enviado (objeto com read/seek) ou conteúdo em bytes
+            filename: Nome do ZIP, para as mensagens
+        """
         resultados = {
             'processados': 0,
             'erros': 0,
             'detalhes': []
         }
+        detalhes = resultados['detalhes']  # Referência local, usada a cada arquivo
         
         try:
-            # Criar um objeto BytesIO para o conteúdo do ZIP
-            zip_buffer = io.BytesIO(file_content)
+            # Arquivo enviado usado diretamente; bytes são embrulhados em BytesIO
+            zip_buffer = io.BytesIO(arquivo_zip) if isinstance(arquivo_zip, (bytes, bytearray)) else arquivo_zip
             
             with zipfile.ZipFile(zip_buffer, 'r') as zip_ref:
                 # Listar arquivos no ZIP
                 file_list = zip_ref.namelist()
-                st.info(f"📦 Arquivo ZIP '{filename}' contém {len(file_list)} arquivo(s)")
-                
-                # Separar arquivos por tipo e prioridade
-                arquivos_cabecalho = []
-                arquivos_itens = []
-                outros_arquivos = []
-                
-                st.info("🔍 **ANÁLISE DOS ARQUIVOS NO ZIP:**")
-                
-                for file_name in file_list:
-                    if file_name.endswith('/'):
-                        continue
-                    
-                    file_lower = file_name.lower()
-                    if any(keyword in file_lower for keyword in ['cabecalho', 'header']):
-                        arquivos_cabecalho.append(file_name)
-                        st.success(f"📋 CABEÇALHO identificado: {file_name}")
-                    elif any(keyword in file_lower for keyword in ['itens', 'items']):
-                        arquivos_itens.append(file_name)
-                        st.info(f"📦 ITENS identificado: {file_name}")
-                    else:
-                        outros_arquivos.append(file_name)
-                        st.info(f"📄 OUTRO arquivo: {file_name}")
                 
                 # Processar na ordem correta: cabeçalho primeiro, depois outros, depois itens
-                arquivos_ordenados = arquivos_cabecalho + outros_arquivos + arquivos_itens
+                # (classificação resumida em uma única mensagem, não uma por arquivo)
+                arquivos_ordenados, resumo = ordenar_arquivos_zip(file_list)
+                st.info(f"📦 Arquivo ZIP '{filename}' contém {len(file_list)} arquivo(s)\n\n{resumo}")
                 
-                st.success(f"✅ **ORDEM DE PROCESSAMENTO DEFINIDA:**")
-                st.success(f"1º → {len(arquivos_cabecalho)} arquivo(s) de cabeçalho")
-                st.success(f"2º → {len(outros_arquivos)} outro(s) arquivo(s)")
-                st.success(f"3º → {len(arquivos_itens)} arquivo(s) de itens")
+                # Extrair os PDF/XML em paralelo antes da gravação (que segue a ordem abaixo);
+                # as entradas são lidas do ZIP sob demanda, uma janela por vez
+                def ler_entradas_nf():
+                    for file_name in arquivos_ordenados:
+                        if not file_name.lower().endswith(('.pdf', '.xml')):
+                            continue
+                        try:
+                            with zip_ref.open(file_name) as extracted_file:
+                                conteudo = extracted_file.read()
+                        except Exception as e:
+                            logger.error(f"Erro ao ler {file_name} do ZIP: {e}")
+                            continue
+                        yield file_name, conteudo
+                
+                notas_extraidas = dict(extrair_arquivos_paralelo(ler_entradas_nf()))
                 
                 # Processar cada arquivo na ordem correta
                 for file_name in arquivos_ordenados:
@@ -1371,21 +1452,17 @@ class Dashboard:
                         
                         # Verificar se é um tipo de arquivo suportado
                         if file_extension not in ['pdf', 'xml', 'csv']:
-                            resultados['detalhes'].append(f"⚠️ {file_name}: Tipo de arquivo não suportado")
+                            detalhes.append(f"⚠️ {file_name}: Tipo de arquivo não suportado")
                             continue
                         
-                        # Ler conteúdo do arquivo
-                        with zip_ref.open(file_name) as extracted_file:
-                            extracted_content = extracted_file.read()
-                        
-                        # Processar baseado no tipo
+                        # Processar baseado no tipo (PDF/XML já extraídos acima)
                         nota_fiscal = None
-                        if file_extension == 'pdf':
-                            nota_fiscal = self.processar_pdf_upload(extracted_content, file_name)
-                        elif file_extension == 'xml':
-                            nota_fiscal = self.processar_xml_upload(extracted_content, file_name)
+                        if file_extension in ('pdf', 'xml'):
+                            nota_fiscal = notas_extraidas.get(file_name)
                         elif file_extension == 'csv':
-                            notas_csv = self.processar_csv_upload(extracted_content, file_name)
+                            # Entrada lida direto do ZIP pelo pandas (sem copiar o conteúdo para bytes)
+                            with zip_ref.open(file_name) as extracted_file:
+                                notas_csv = self.processar_csv_upload(extracted_file, file_name)
                             
                             # Verificar se é um arquivo de itens (retorna lista vazia por design)
                             filename_lower = file_name.lower()
@@ -1398,42 +1475,42 @@ class Dashboard:
                                             resultados['processados'] += 1
                                         else:
                                             resultados['erros'] += 1
-                                    resultados['detalhes'].append(f"✅ {file_name}: {len(notas_csv)} nota(s) processada(s)")
+                                    detalhes.append(f"✅ {file_name}: {len(notas_csv)} nota(s) processada(s)")
                                 elif is_items_file:  # Arquivo de itens (lista vazia é esperada)
                                     resultados['processados'] += 1
-                                    resultados['detalhes'].append(f"✅ {file_name}: Itens processados com sucesso")
+                                    detalhes.append(f"✅ {file_name}: Itens processados com sucesso")
                                 else:  # Arquivo vazio ou sem dados válidos
                                     resultados['erros'] += 1
-                                    resultados['detalhes'].append(f"❌ {file_name}: Nenhum dado válido encontrado")
+                                    detalhes.append(f"❌ {file_name}: Nenhum dado válido encontrado")
                             else:  # Erro no processamento
                                 resultados['erros'] += 1
-                                resultados['detalhes'].append(f"❌ {file_name}: Erro no processamento CSV")
+                                detalhes.append(f"❌ {file_name}: Erro no processamento CSV")
                             continue
                         
                         # Salvar nota fiscal individual (PDF/XML)
                         if nota_fiscal:
                             if self.salvar_nota_fiscal(nota_fiscal):
                                 resultados['processados'] += 1
-                                resultados['detalhes'].append(f"✅ {file_name}: Processado com sucesso")
+                                detalhes.append(f"✅ {file_name}: Processado com sucesso")
                             else:
                                 resultados['erros'] += 1
-                                resultados['detalhes'].append(f"❌ {file_name}: Erro ao salvar no banco")
+                                detalhes.append(f"❌ {file_name}: Erro ao salvar no banco")
                         else:
                             resultados['erros'] += 1
-                            resultados['detalhes'].append(f"❌ {file_name}: Erro no processamento")
+                            detalhes.append(f"❌ {file_name}: Erro no processamento")
                             
                     except Exception as e:
                         resultados['erros'] += 1
-                        resultados['detalhes'].append(f"❌ {file_name}: {str(e)}")
+                        detalhes.append(f"❌ {file_name}: {str(e)}")
                         logger.error(f"Erro ao processar arquivo {file_name} do ZIP: {e}")
                         
         except zipfile.BadZipFile:
             resultados['erros'] += 1
-            resultados['detalhes'].append(f"❌ {filename}: Arquivo ZIP corrompido ou inválido")
+            detalhes.append(f"❌ {filename}: Arquivo ZIP corrompido ou inválido")
             st.error(f"Arquivo ZIP '{filename}' está corrompido ou não é um arquivo ZIP válido")
         except Exception as e:
             resultados['erros'] += 1
-            resultados['detalhes'].append(f"❌ {filename}: {str(e)}")
+            detalhes.append(f"❌ {filename}: {str(e)}")
             logger.error(f"Erro ao processar ZIP {filename}: {e}")
             st.error(f"Erro ao processar ZIP: {e}")
         
@@ -1443,7 +1520,7 @@ class Dashboard:
         """Salva uma nota fiscal no banco de dados"""
         try:
             # Converter NotaFiscal para dicionário
-            if hasattr(nota_fiscal, '__dict__'):
+            if is_dataclass(nota_fiscal):
                 dados = asdict(nota_fiscal)
             else:
                 dados = nota_fiscal
@@ -1482,13 +1559,21 @@ class Dashboard:
         # Mostrar detalhes
         if resultados['detalhes']:
             st.subheader("📋 Detalhes do Processamento")
+            # Um bloco por tipo (não um elemento por arquivo): ZIPs grandes geram centenas de detalhes
+            sucessos, falhas, avisos = [], [], []
             for detalhe in resultados['detalhes']:
                 if "✅" in detalhe:
-                    st.success(detalhe)
+                    sucessos.append(detalhe)
                 elif "❌" in detalhe:
-                    st.error(detalhe)
+                    falhas.append(detalhe)
                 else:
-                     st.info(detalhe)
+                    avisos.append(detalhe)
+            if sucessos:
+                st.success("  \n".join(sucessos))
+            if falhas:
+                st.error("  \n".join(falhas))
+            if avisos:
+                st.info("  \n".join(avisos))
 
     def _processar_csv_cabecalho(self, df, filename):
         """Processa arquivo CSV de cabeçalho de notas fiscais"""
@@ -1497,26 +1582,8 @@ class Dashboard:
             logger.info(f"Colunas disponíveis no CSV: {list(df.columns)}")
             logger.info(f"Número de linhas no CSV: {len(df)}")
             
-            # Mapear colunas comuns para cabeçalho (incluindo variações com acentos)
-            mapeamento_colunas = {
-                'numero': ['numero', 'NÚMERO', 'nf_numero', 'numero_nf', 'num_nf', 'NF_NUMERO'],
-                'serie': ['serie', 'SÉRIE', 'serie_nf', 'nf_serie', 'SERIE_NF'],
-                'cnpj_emitente': ['cnpj_emitente', 'CNPJ_EMITENTE', 'cnpj_emit', 'emitente_cnpj', 'CPF/CNPJ Emitente'],
-                'nome_emitente': ['nome_emitente', 'NOME_EMITENTE', 'razao_emitente', 'emitente_nome', 'NOME EMITENTE', 'RAZÃO SOCIAL EMITENTE'],
-                'data_emissao': ['data_emissao', 'DATA_EMISSAO', 'dt_emissao', 'data_emiss', 'DATA EMISSÃO'],
-                'valor_total': ['valor_total', 'VALOR_TOTAL', 'vl_total', 'total_nf', 'VALOR NOTA FISCAL'],
-                'chave_acesso': ['chave_acesso', 'CHAVE_ACESSO', 'chave_nfe', 'chave', 'CHAVE DE ACESSO'],
-                'natureza_operacao': ['natureza_operacao', 'NATUREZA_OPERACAO', 'nat_operacao', 'cfop', 'NATUREZA DA OPERAÇÃO']
-            }
-            
-            # Encontrar colunas correspondentes
-            colunas_encontradas = {}
-            for campo, possiveis_nomes in mapeamento_colunas.items():
-                for nome in possiveis_nomes:
-                    if nome in df.columns:
-                        colunas_encontradas[campo] = nome
-                        logger.info(f"Campo '{campo}' mapeado para coluna '{nome}'")
-                        break
+            # Encontrar colunas correspondentes (uma passada pelas colunas do CSV)
+            colunas_encontradas = mapear_colunas_cabecalho(df.columns)
             
             logger.info(f"Colunas encontradas: {colunas_encontradas}")
             
@@ -1530,46 +1597,8 @@ class Dashboard:
                 st.info(f"Colunas disponíveis: {', '.join(df.columns.tolist())}")
                 return []
             
-            # Converter para lista de NotaFiscal
-            notas = []
-            for _, row in df.iterrows():
-                try:
-                    # Processar data_emissao
-                    data_emissao = datetime.now()
-                    if 'data_emissao' in colunas_encontradas:
-                        data_emissao_str = str(row.get(colunas_encontradas['data_emissao'], ''))
-                        try:
-                            if '/' in data_emissao_str:
-                                data_emissao = datetime.strptime(data_emissao_str, '%d/%m/%Y')
-                            elif '-' in data_emissao_str:
-                                data_emissao = datetime.strptime(data_emissao_str, '%Y-%m-%d')
-                        except ValueError:
-                            logger.warning(f"Formato de data inválido: {data_emissao_str}")
-                    
-                    # Processar valor total
-                    valor_total = 0.0
-                    if 'valor_total' in colunas_encontradas:
-                        try:
-                            valor_str = str(row.get(colunas_encontradas['valor_total'], '0')).replace(',', '.')
-                            valor_total = float(valor_str)
-                        except (ValueError, TypeError):
-                            valor_total = 0.0
-                    
-                    nota = NotaFiscal(
-                        numero=str(row.get(colunas_encontradas['numero'], '')),
-                        serie=str(row.get(colunas_encontradas.get('serie', 'serie'), '1')),
-                        cnpj_emitente=str(row.get(colunas_encontradas['cnpj_emitente'], '')),
-                        nome_emitente=str(row.get(colunas_encontradas['nome_emitente'], '')),
-                        data_emissao=data_emissao,
-                        valor_total=valor_total,
-                        chave_acesso=str(row.get(colunas_encontradas.get('chave_acesso', 'chave_acesso'), '')),
-                        natureza_operacao=str(row.get(colunas_encontradas.get('natureza_operacao', 'natureza_operacao'), ''))
-                    )
-                    notas.append(nota)
-                    logger.info(f"Nota fiscal processada: {nota.numero}")
-                except Exception as e:
-                    logger.warning(f"Erro ao processar linha do CSV de cabeçalho: {e}")
-                    continue
+            # Converter para lista de NotaFiscal (por coluna, não linha a linha)
+            notas = notas_de_csv_cabecalho(df, colunas_encontradas)
             
             logger.info(f"Processamento concluído. Total de notas processadas: {len(notas)}")
             return notas
@@ -1580,72 +1609,26 @@ class Dashboard:
             logger.error(f"Traceback completo: {traceback.format_exc()}")
             return []
 
-    def _processar_csv_itens(self, df, filename):
+    def _ha_notas_no_banco(self) -> bool:
+        """
+        Indica se já há notas fiscais no banco (pré-requisito dos CSVs de itens)
+
+        Só o resultado positivo é guardado: notas não são apagadas durante o upload,
+        mas um CSV de cabeçalho do mesmo upload pode criar as primeiras.
+        """
+        if not getattr(self, '_notas_no_banco', False):
+            self._notas_no_banco = self.db_manager.existe_nota_fiscal()
+        return self._notas_no_banco
+
+    def _processar_csv_itens(self, df, filename, pre_validado: bool = False):
         """Processa arquivo CSV de itens de notas fiscais com validação robusta e mapeamento tolerante a acentos/espaços"""
         try:
             logger.info(f"Iniciando processamento de CSV de itens: {filename}")
             logger.info(f"Colunas disponíveis no CSV de itens: {list(df.columns)}")
             logger.info(f"Número de linhas no CSV de itens: {len(df)}")
             
-            # Função para normalizar nomes de colunas (remove acentos, espaços e pontuação)
-            def normalizar_nome_coluna(nome: str) -> str:
-                try:
-                    if not isinstance(nome, str):
-                        nome = str(nome)
-                    # Remover acentos
-                    nome_sem_acentos = ''.join(
-                        c for c in unicodedata.normalize('NFKD', nome)
-                        if not unicodedata.combining(c)
-                    )
-                    # Lowercase e substituir separadores por underscore
-                    nome_sem_acentos = nome_sem_acentos.lower()
-                    nome_sem_acentos = nome_sem_acentos.replace('/', ' ').replace('-', ' ').replace('.', ' ').replace(':', ' ')
-                    nome_sem_acentos = re.sub(r'\s+', ' ', nome_sem_acentos).strip()
-                    nome_sem_acentos = nome_sem_acentos.replace(' ', '_')
-                    return nome_sem_acentos
-                except Exception:
-                    return str(nome).lower()
-
-            # Criar mapa normalizado das colunas do DataFrame
-            mapa_colunas_normalizadas = {normalizar_nome_coluna(c): c for c in df.columns}
-            logger.debug(f"Mapa de colunas normalizadas: {mapa_colunas_normalizadas}")
-
-            # Definir sinônimos normalizados para os campos necessários
-            sinonimos = {
-                'numero_nf': [
-                    'numero_nf', 'numero', 'nf_numero', 'numero_nota_fiscal', 'num_nf', 'numero_da_nota_fiscal'
-                ],
-                'codigo_produto': [
-                    'codigo_produto', 'codigo', 'cod_produto', 'cprod', 'numero_produto', 'num_produto',
-                    'codigo_item', 'codigo_do_produto', 'numero_do_produto'
-                ],
-                'descricao': [
-                    'descricao', 'descricao_produto', 'xprod', 'produto', 'descricao_do_produto',
-                    'descricao_do_item', 'descricao_item', 'item_descricao', 'descricao_prod',
-                    'descricao_do_produto_servico', 'descricao_produto_servico', 'produto_servico'
-                ],
-                'ncm': [
-                    'ncm', 'codigo_ncm', 'codigo_ncm_sh', 'codigo_ncmsh', 'ncm_sh', 'ncmsh', 'codigo_ncm_sh'
-                ],
-                'quantidade': [
-                    'quantidade', 'qtd', 'qtde', 'qcom', 'quantidade_item'
-                ],
-                'valor_unitario': [
-                    'valor_unitario', 'vl_unitario', 'preco_unitario', 'vuncom', 'valor_unitario_item', 'preco_unitario_item'
-                ],
-                'valor_total': [
-                    'valor_total', 'vl_total', 'total_item', 'vprod', 'valor_total_item'
-                ]
-            }
-
-            # Encontrar colunas correspondentes usando normalização
-            colunas_encontradas = {}
-            for campo, aliases in sinonimos.items():
-                for alias in aliases:
-                    if alias in mapa_colunas_normalizadas:
-                        colunas_encontradas[campo] = mapa_colunas_normalizadas[alias]
-                        logger.info(f"Campo '{campo}' mapeado para coluna '{mapa_colunas_normalizadas[alias]}' (alias: {alias})")
-                        break
+            # Encontrar colunas correspondentes pelo nome normalizado (acentos, espaços e pontuação ignorados)
+            colunas_encontradas = mapear_colunas_itens(df.columns)
             
             logger.info(f"Colunas encontradas para itens: {colunas_encontradas}")
             
@@ -1659,131 +1642,114 @@ class Dashboard:
                 st.info(f"Colunas disponíveis: {', '.join(df.columns.tolist())}")
                 return []
             
-            # Verificar quantas notas fiscais existem no banco
-            try:
-                with self.db_manager.engine.connect() as connection:
-                    count_query = text("SELECT COUNT(*) FROM notas_fiscais")
-                    total_notas = connection.execute(count_query).fetchone()[0]
-                    logger.info(f"Total de notas fiscais no banco: {total_notas}")
-                    st.info(f"🔍 Verificação: {total_notas} notas fiscais encontradas no banco de dados")
-                    
-                    if total_notas == 0:
+            # Verificar se existem notas fiscais no banco (já feito na pré-validação do upload)
+            if not pre_validado:
+                try:
+                    if not self._ha_notas_no_banco():
                         st.error("❌ ERRO: Nenhuma nota fiscal encontrada no banco de dados!")
                         st.error("📋 SOLUÇÃO: O arquivo de cabeçalho deve ser processado ANTES do arquivo de itens.")
                         st.info("💡 Dica: Verifique se o arquivo de cabeçalho foi incluído no ZIP e se foi processado com sucesso.")
                         return []
-            except Exception as e:
-                logger.error(f"Erro ao contar notas fiscais: {e}")
+                except Exception as e:
+                    logger.error(f"Erro ao verificar notas fiscais: {e}")
             
             # Processar itens e associar às notas fiscais
             itens_processados = 0
             erros_processamento = 0
+            itens_lote = []
+            
+            # Conversão numérica vetorizada: uma operação por coluna, não por célula
+            def coluna_numerica(campo):
+                if campo in colunas_encontradas:
+                    return valores_numericos_csv(df[colunas_encontradas[campo]]).tolist()
+                return [0.0] * len(df)
+            
+            quantidades = coluna_numerica('quantidade')
+            valores_unitarios = coluna_numerica('valor_unitario')
+            valores_totais = coluna_numerica('valor_total')
+            
+            # Colunas de texto como listas de valores nativos, percorridas junto com as numéricas
+            # (evita montar uma pd.Series ou um dict por linha); código, descrição e NCM já
+            # convertidos, sem espaços nas pontas e limitados ao tamanho das colunas
+            numeros_nf = df[colunas_encontradas['numero_nf']].tolist()
+            codigos = df[colunas_encontradas['codigo_produto']].astype(str).str.strip().str.slice(0, 100).tolist()
+            descricoes = df[colunas_encontradas['descricao']].astype(str).str.strip().str.slice(0, 1000).tolist()
+            if 'ncm' in colunas_encontradas:
+                ncms = df[colunas_encontradas['ncm']].astype(str).str.slice(0, 20).tolist()
+            else:
+                ncms = [''] * len(df)
+            
+            # IDs das notas citadas no arquivo, buscados de uma vez (não uma consulta por linha)
+            ids_por_numero = self.db_manager.ids_notas_por_numero(
+                numero for numero in (str(valor).strip() for valor in numeros_nf if valor is not None and valor == valor) if numero
+            )
             
-            for index, row in df.iterrows():
+            # Itens da mesma nota costumam vir em linhas seguidas: reaproveitar a última conversão/busca
+            ultimo_numero_raw = ultimo_numero_nf = ultimo_nota_id = None
+            
+            linhas = zip(numeros_nf, codigos, descricoes, ncms, quantidades, valores_unitarios, valores_totais)
+            for linha, (numero_nf_raw, codigo_produto, descricao, ncm, quantidade, valor_unitario, valor_total) in enumerate(linhas, 1):
                 try:
-                    # Validar número da NF
-                    numero_nf_raw = row.get(colunas_encontradas['numero_nf'], '')
-                    if pd.isna(numero_nf_raw) or numero_nf_raw == '':
-                        logger.debug(f"Linha {index + 1}: Número da NF vazio, pulando")
-                        continue
-                    
-                    numero_nf = str(numero_nf_raw).strip()
-                    if not numero_nf:
-                        logger.debug(f"Linha {index + 1}: Número da NF vazio após limpeza, pulando")
-                        continue
+                    if ultimo_numero_nf is not None and numero_nf_raw == ultimo_numero_raw:
+                        numero_nf, nota_fiscal_id = ultimo_numero_nf, ultimo_nota_id
+                    else:
+                        # Validar número da NF (valor != valor só para NaN, sem o custo de pd.isna)
+                        if numero_nf_raw is None or numero_nf_raw != numero_nf_raw or numero_nf_raw == '':
+                            logger.debug(f"Linha {linha}: Número da NF vazio, pulando")
+                            continue
+                        
+                        numero_nf = str(numero_nf_raw).strip()
+                        if not numero_nf:
+                            logger.debug(f"Linha {linha}: Número da NF vazio após limpeza, pulando")
+                            continue
+                        
+                        # Nota fiscal correspondente (IDs já carregados antes do laço)
+                        nota_fiscal_id = ids_por_numero.get(numero_nf)
+                        ultimo_numero_raw, ultimo_numero_nf, ultimo_nota_id = numero_nf_raw, numero_nf, nota_fiscal_id
                     
-                    # Buscar a nota fiscal correspondente no banco
-                    nota_fiscal_id = self.db_manager.buscar_nota_fiscal_por_numero(numero_nf)
                     if not nota_fiscal_id:
-                        logger.warning(f"Nota fiscal {numero_nf} não encontrada para o item na linha {index + 1}")
+                        logger.warning(f"Nota fiscal {numero_nf} não encontrada para o item na linha {linha}")
                         erros_processamento += 1
                         continue
                     
-                    # Função auxiliar para conversão segura de valores numéricos
-                    def converter_valor_numerico(valor, nome_campo, linha):
-                        """Converte valor para float de forma segura"""
-                        if pd.isna(valor) or valor == '' or valor is None:
-                            return 0.0
-                        
-                        try:
-                            # Converter para string e limpar
-                            valor_str = str(valor).strip()
-                            if not valor_str:
-                                return 0.0
-                            
-                            # Remover caracteres não numéricos exceto vírgula e ponto
-                            valor_limpo = re.sub(r'[^\d,.-]', '', valor_str)
-                            
-                            # Tratar vírgula como separador decimal
-                            if ',' in valor_limpo and '.' in valor_limpo:
-                                # Se tem ambos, assumir que vírgula é separador decimal
-                                valor_limpo = valor_limpo.replace('.', '').replace(',', '.')
-                            elif ',' in valor_limpo:
-                                valor_limpo = valor_limpo.replace(',', '.')
-                            
-                            return float(valor_limpo)
-                        except (ValueError, TypeError) as e:
-                            logger.warning(f"Erro ao converter {nome_campo} na linha {linha}: {valor} -> {e}")
-                            return 0.0
-                    
-                    # Extrair e validar dados do item
-                    quantidade = converter_valor_numerico(
-                        row.get(colunas_encontradas.get('quantidade', 'quantidade'), 0), 
-                        'quantidade', 
-                        index + 1
-                    )
-                    
-                    valor_unitario = converter_valor_numerico(
-                        row.get(colunas_encontradas.get('valor_unitario', 'valor_unitario'), 0), 
-                        'valor_unitario', 
-                        index + 1
-                    )
-                    
-                    valor_total = converter_valor_numerico(
-                        row.get(colunas_encontradas.get('valor_total', 'valor_total'), 0), 
-                        'valor_total', 
-                        index + 1
-                    )
-                    
-                    # Se valor_total não estiver preenchido, calcular
+                    # Valores numéricos já convertidos por coluna; se valor_total não estiver preenchido, calcular
                     if valor_total == 0 and quantidade > 0 and valor_unitario > 0:
                         valor_total = quantidade * valor_unitario
                     
                     # Validar dados essenciais
-                    codigo_produto = str(row.get(colunas_encontradas['codigo_produto'], '')).strip()
-                    descricao = str(row.get(colunas_encontradas['descricao'], '')).strip()
-                    
                     if not codigo_produto and not descricao:
-                        logger.warning(f"Linha {index + 1}: Código e descrição do produto vazios, pulando")
+                        logger.warning(f"Linha {linha}: Código e descrição do produto vazios, pulando")
                         erros_processamento += 1
                         continue
                     
                     # Preparar dados do item
                     item_data = {
                         'nota_fiscal_id': nota_fiscal_id,
-                        'codigo': codigo_produto[:100] if codigo_produto else '',  # Limitar tamanho
-                        'descricao': descricao[:1000] if descricao else '',  # Limitar tamanho
-                        'ncm': str(row.get(colunas_encontradas.get('ncm', 'ncm'), ''))[:20],  # Limitar tamanho
+                        'codigo': codigo_produto,
+                        'descricao': descricao,
+                        'ncm': ncm,
                         'quantidade': quantidade,
                         'valor_unitario': valor_unitario,
                         'valor_total': valor_total
                     }
                     
-                    # Salvar item no banco
-                    if self.db_manager.salvar_item_nota_fiscal(item_data):
-                        itens_processados += 1
-                        logger.debug(f"Item da linha {index + 1} processado com sucesso")
-                    else:
-                        erros_processamento += 1
-                        logger.warning(f"Falha ao salvar item da linha {index + 1}")
+                    # Item gravado junto com os demais do arquivo, após o laço
+                    itens_lote.append(item_data)
                     
                 except Exception as e:
                     erros_processamento += 1
-                    logger.warning(f"Erro ao processar item na linha {index + 1}: {e}")
+                    logger.warning(f"Erro ao processar item na linha {linha}: {e}")
                     import traceback
-                    logger.debug(f"Traceback do erro na linha {index + 1}: {traceback.format_exc()}")
+                    logger.debug(f"Traceback do erro na linha {linha}: {traceback.format_exc()}")
                     continue
             
+            # Gravar todos os itens do arquivo em uma única transação
+            if itens_lote:
+                itens_processados = self.db_manager.salvar_itens_nota_fiscal(itens_lote)
+                if not itens_processados:
+                    erros_processamento += len(itens_lote)
+                    logger.error(f"Falha ao salvar os {len(itens_lote)} itens de {filename}")
+            
             # Relatório final
             total_linhas = len(df)
             logger.info(f"Processamento de itens concluído. Total de linhas: {total_linhas}, Itens processados: {itens_processados}, Erros: {erros_processamento}")
@@ -1816,38 +1782,38 @@ class Dashboard:
                 st.info(f"Colunas disponíveis: {', '.join(df.columns.tolist())}")
                 return []
             
+            # Conversões por coluna (datas inválidas viram a data atual), não linha a linha
+            datas_emissao = datas_csv(df['data_emissao'], datetime.now())
+            valores = pd.to_numeric(df['valor_total'], errors='coerce')
+            invalidos = (valores.isna() & df['valor_total'].notna()).tolist()
+            if any(invalidos):
+                logger.warning(f"{sum(invalidos)} linha(s) do CSV com valor_total inválido ignorada(s)")
+            
+            def texto(coluna, padrao):
+                if coluna in df.columns:
+                    return df[coluna].astype(str).tolist()
+                return [padrao] * len(df)
+            
             # Converter para lista de NotaFiscal
-            notas = []
-            for _, row in df.iterrows():
-                try:
-                    # Processar data_emissao corretamente
-                    data_emissao_str = str(row.get('data_emissao', datetime.now().date()))
-                    try:
-                        # Tentar diferentes formatos de data
-                        if '/' in data_emissao_str:
-                            data_emissao = datetime.strptime(data_emissao_str, '%d/%m/%Y')
-                        elif '-' in data_emissao_str:
-                            data_emissao = datetime.strptime(data_emissao_str, '%Y-%m-%d')
-                        else:
-                            data_emissao = datetime.now()
-                    except ValueError:
-                        logger.warning(f"Formato de data inválido: {data_emissao_str}. Usando data atual.")
-                        data_emissao = datetime.now()
-                    
-                    nota = NotaFiscal(
-                        numero=str(row.get('numero', '')),
-                        serie=str(row.get('serie', '1')),
-                        cnpj_emitente=str(row.get('cnpj_emitente', '')),
-                        nome_emitente=str(row.get('nome_emitente', '')),
-                        data_emissao=data_emissao,
-                        valor_total=float(row.get('valor_total', 0)),
-                        chave_acesso=str(row.get('chave_acesso', '')),
-                        natureza_operacao=str(row.get('natureza_operacao', ''))
-                    )
-                    notas.append(nota)
-                except Exception as e:
-                    logger.warning(f"Erro ao processar linha do CSV: {e}")
-                    continue
+            notas = [
+                NotaFiscal(
+                    numero=numero,
+                    serie=serie,
+                    cnpj_emitente=cnpj_emitente,
+                    nome_emitente=nome_emitente,
+                    data_emissao=data_emissao,
+                    valor_total=valor_total,
+                    chave_acesso=chave_acesso,
+                    natureza_operacao=natureza_operacao
+                )
+                for numero, serie, cnpj_emitente, nome_emitente, data_emissao, valor_total, chave_acesso, natureza_operacao, invalido
+                in zip(
+                    texto('numero', ''), texto('serie', '1'), texto('cnpj_emitente', ''), texto('nome_emitente', ''),
+                    datas_emissao, valores.astype('float64').tolist(), texto('chave_acesso', ''),
+                    texto('natureza_operacao', ''), invalidos
+                )
+                if not invalido
+            ]
             
             return notas
             
@@ -1856,11 +1822,20 @@ class Dashboard:
             return []
 
 if __name__ == "__main__":
+    # Configurar página antes de qualquer outro comando do Streamlit
+    st.set_page_config(
+        page_title="Gestor Fiscal AI", 
+        layout="wide", 
+        initial_sidebar_state="expanded",
+        page_icon="🤖"
+    )
     try:
-        dashboard = Dashboard()
-        dashboard.run()
+        # Dashboard criado uma vez por sessão; cada rerun do Streamlit só executa run()
+        if 'dashboard' not in st.session_state:
+            st.session_state.dashboard = Dashboard()
+        st.session_state.dashboard.run()
     except Exception as e:
-        logger.critical(f"A aplicação falhou: {e}")
+        logger.critical("A aplicação falhou: %s", e, exc_info=True)
         st.error(f"Ocorreu um erro crítico na aplicação: {e}")
         import traceback
         st.code(traceback.format_exc())
\ No newline at end of file
@@ -1,6 +1,5 @@
 import imaplib
-import email
-from email.header import decode_header
+from email.parser import BytesHeaderParser
 import logging
 from datetime import datetime, timedelta
 
@@ -12,6 +11,7 @@ from security_utils import (
     rate_limiter
 )
 from secure_config import get_secure_config, SecureConfigError
+from imap_utils import obter_conexao, montar_criterio_assunto, parse_fetch, listar_anexos, decodificar_parte, decodificar_assunto
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -19,6 +19,12 @@ logger = logging.getLogger(__name__)
 # Lista de palavras-chave para filtrar no assunto (em minúsculo)
 PALAVRAS_CHAVE = ["danfe", "nf-e", "nfc-e", "nf", "nfe", "xml", "nota fiscal"]
 
+# Parser só de cabeçalhos: para na fronteira cabeçalho/corpo
+_HEADER_PARSER = BytesHeaderParser()
+
+# Estrutura MIME e assunto; o conteúdo dos anexos é baixado depois, só das seções XML/PDF
+FETCH_ESTRUTURA = '(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])'
+
 def buscar_e_processar_emails():
     """
     Busca e processa emails com validações de segurança
@@ -57,66 +63,39 @@ def buscar_e_processar_emails():
 
     logger.info("ROBÔ: Iniciando processo de busca de notas fiscais no e-mail...")
     try:
-        mail = imaplib.IMAP4_SSL(config.IMAP_SERVER, config.IMAP_PORT)
-        mail.login(config.EMAIL_USER, config.EMAIL_PASSWORD)
-        mail.select('inbox')
+        # Conexão mantida entre execuções do agendador (sem novo handshake TLS + LOGIN)
+        mail = obter_conexao(config.IMAP_SERVER, config.IMAP_PORT, config.EMAIL_USER, config.EMAIL_PASSWORD)
         
-        # Busca e-mails não lidos
-        status, messages = mail.search(None, 'UNSEEN')
+        # Busca e-mails não lidos com palavra-chave no assunto (filtro feito no servidor)
+        criterio = f'UNSEEN {montar_criterio_assunto(PALAVRAS_CHAVE)}'
+        status, messages = mail.uid('SEARCH', None, criterio)
         
         if status != 'OK' or not messages[0]:
-            logger.info("ROBÔ: Nenhuma mensagem nova encontrada.")
-            mail.logout()
+            logger.info("ROBÔ: Nenhuma mensagem nova com palavras-chave encontrada.")
             return
             
         email_ids = messages[0].split()
         logger.info(f"ROBÔ: Encontrados {len(email_ids)} e-mails novos.")
 
         for email_id in email_ids:
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
+            status, msg_data = mail.uid('FETCH', email_id, FETCH_ESTRUTURA)
             if status != 'OK': continue
 
-            msg = email.message_from_bytes(msg_data[0][1])
+            dados = parse_fetch(msg_data).get(email_id)
+            if not dados: continue
+
+            msg = _HEADER_PARSER.parsebytes(dados.get('BODY[HEADER.FIELDS (SUBJECT)]') or b'', headersonly=True)
 
             # Decodifica o assunto
-            subject_parts = decode_header(msg["Subject"])
-            subject_decoded = []
-
-            for part, enc in subject_parts:
-                if isinstance(part, bytes):
-                    # Se o encoding for None, 'unknown-8bit' ou inválido, usa fallback
-                    if not enc or enc.lower() == "unknown-8bit":
-                        enc = "utf-8"
-                    try:
-                        subject_decoded.append(part.decode(enc, errors="ignore"))
-                    except LookupError:  # caso encoding não seja reconhecido
-                        subject_decoded.append(part.decode("utf-8", errors="ignore"))
-                else:
-                    subject_decoded.append(part)
-
-            # Junta tudo em uma string
-            subject = " ".join(subject_decoded).strip()
-            subject_lower = subject.lower() if subject else ""
-
-            # Verifica se contém alguma palavra-chave
-            if not any(palavra in subject_lower for palavra in PALAVRAS_CHAVE):
-                logger.info(f"ROBÔ: E-mail ignorado (assunto sem palavras-chave): {subject}")
-                # Marca como lido para não processar de novo
-                mail.store(email_id, '+FLAGS', '\\Seen')
-                continue
+            subject = decodificar_assunto(msg["Subject"])
 
             logger.info(f"ROBÔ: Processando e-mail com assunto: {subject}")
 
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart' or part.get('Content-Disposition') is None:
-                    continue
-                
-                filename = part.get_filename()
-                if not filename:
-                    continue
-
+            # Anexos descobertos pelo BODYSTRUCTURE, sem baixar o e-mail inteiro
+            anexos_permitidos = []
+            for anexo in listar_anexos(dados.get('BODYSTRUCTURE')):
                 # Sanitizar nome do arquivo
-                filename_safe = DataSanitizer.sanitize_string(filename)
+                filename_safe = DataSanitizer.sanitize_string(anexo['filename'])
                 filename_lower = filename_safe.lower()
 
                 # Validar extensão de arquivo
@@ -129,9 +108,20 @@ def buscar_e_processar_emails():
                     )
                     continue
 
+                anexos_permitidos.append((anexo, filename_safe, filename_lower))
+
+            # Um único FETCH com as seções dos anexos XML/PDF
+            secoes = {}
+            if anexos_permitidos:
+                itens = " ".join(f"BODY.PEEK[{anexo['secao']}]" for anexo, _, _ in anexos_permitidos)
+                status, msg_data = mail.uid('FETCH', email_id, f'({itens})')
+                if status == 'OK':
+                    secoes = parse_fetch(msg_data).get(email_id, {})
+
+            for anexo, filename_safe, filename_lower in anexos_permitidos:
                 # Obter conteúdo do anexo
                 try:
-                    file_content = part.get_payload(decode=True)
+                    file_content = decodificar_parte(secoes.get(f"BODY[{anexo['secao']}]"), anexo['encoding'])
                     if not file_content:
                         logger.warning(f"ROBÔ: Conteúdo vazio no arquivo: {filename_safe}")
                         continue
@@ -224,9 +214,8 @@ def buscar_e_processar_emails():
                         logger.error(f"ROBÔ: Falha ao extrair dados do PDF '{filename_safe}'")
 
             # Marca como lido
-            mail.store(email_id, '+FLAGS', '\\Seen')
+            mail.uid('STORE', email_id, '+FLAGS', '\\Seen')
 
-        mail.logout()
     except imaplib.IMAP4.error as e:
         logger.error(f"ROBÔ: Erro de IMAP: {e}")
     except Exception as e:
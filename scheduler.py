@@ -2,6 +2,7 @@ import schedule
 import time
 import logging
 from processar_emails import buscar_e_processar_emails
+from migrations import aplicar_migracoes
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -15,7 +16,13 @@ def job():
         logger.error(f"--- AGENDADOR: Erro na execução da tarefa: {e} ---")
 
 if __name__ == "__main__":
-    logger.info("--> Agendador iniciado. Executando a primeira verificação agora...")
+    logger.info("--> Agendador iniciado. Verificando migrações do banco...")
+    try:
+        aplicar_migracoes()
+    except Exception as e:
+        logger.error(f"--- AGENDADOR: Erro ao aplicar migrações: {e} ---")
+    
+    logger.info("--> Executando a primeira verificação agora...")
     job() # Executa a primeira vez imediatamente
     
     schedule.every(5).minutes.do(job)
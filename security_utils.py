@@ -1,19 +1,39 @@
 # security_utils.py
 # Módulo centralizado para funções de segurança e validação
 
+import io
 import re
 import logging
 import hashlib
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Iterator, Tuple
 from datetime import datetime
 import bleach
 import validators
-from defusedxml import ElementTree as ET
-from defusedxml.ElementTree import ParseError
-from xml.etree.ElementTree import Element  # Para type hints
+from lxml import etree
 
 logger = logging.getLogger(__name__)
 
+# Tabela de str.translate que apaga todo caractere ASCII que não é dígito
+_NAO_DIGITOS_ASCII = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+_RE_NAO_DIGITOS = re.compile(r'[^\d]')
+
+# Tabela de str.translate para valores numéricos: mantém dígitos, '.', '-' e troca ',' por '.'
+_VALOR_NUMERICO_ASCII = str.maketrans({
+    **{chr(c): None for c in range(128) if not (chr(c).isdigit() or chr(c) in '.,-')},
+    ',': '.'
+})
+_RE_NAO_NUMERICO = re.compile(r'[^\d.,\-]')
+
+# Caracteres de controle (exceto tab/quebras de linha) e sequências de espaços, para sanitize_string
+_RE_CONTROLE = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
+_RE_ESPACOS = re.compile(r'\s+')
+
+def somente_digitos(texto: str) -> str:
+    """Remove tudo que não for dígito (str.translate; regex só para entrada não-ASCII)"""
+    if texto.isascii():
+        return texto.translate(_NAO_DIGITOS_ASCII)
+    return _RE_NAO_DIGITOS.sub('', texto)
+
 class SecurityConfig:
     """Configurações de segurança centralizadas"""
     
@@ -36,6 +56,17 @@ class SecurityConfig:
         'qCom', 'vUnCom', 'vProd', 'vNF', 'vICMS', 'vIPI', 'vPIS', 'vCOFINS', 'natOp'
     ]
 
+# XPath compilado uma única vez: infNFe com ou sem o namespace da NF-e, em uma só descida
+_XP_TEM_INF_NFE = etree.XPath(
+    'boolean(.//nfe:infNFe | .//infNFe)', namespaces={'nfe': 'http://www.portalfiscal.inf.br/nfe'}
+)
+
+# Opções do parser lxml: sem entidades, DTD ou acesso à rede; sempre UTF-8
+_OPCOES_PARSER_XML = dict(
+    resolve_entities=False, no_network=True, huge_tree=False,
+    load_dtd=False, dtd_validation=False, encoding='utf-8'
+)
+
 class XMLSecurityValidator:
     """Validador seguro para processamento de XML"""
     
@@ -48,22 +79,34 @@ class XMLSecurityValidator:
         return True
     
     @staticmethod
-    def parse_xml_safely(xml_content: bytes) -> Optional[Element]:
-        """Parse seguro de XML usando defusedxml"""
+    def _validate_xml_bytes(xml_content: bytes) -> bool:
+        """Valida tamanho e encoding (UTF-8) antes do parse"""
+        if not XMLSecurityValidator.validate_xml_size(xml_content):
+            return False
+        
+        # Exigir UTF-8 válido (o lxml recebe os próprios bytes)
+        try:
+            xml_content.decode('utf-8', errors='strict')
+        except UnicodeDecodeError:
+            logger.warning("XML rejeitado: encoding inválido")
+            return False
+        return True
+    
+    @staticmethod
+    def parse_xml_safely(xml_content: bytes) -> Optional[etree._Element]:
+        """Parse seguro de XML usando lxml (sem entidades, DTD ou acesso à rede)"""
         try:
-            # Validar tamanho primeiro
-            if not XMLSecurityValidator.validate_xml_size(xml_content):
+            if not XMLSecurityValidator._validate_xml_bytes(xml_content):
                 return None
             
-            # Decodificar com tratamento de erro
-            try:
-                xml_string = xml_content.decode('utf-8', errors='strict')
-            except UnicodeDecodeError:
-                logger.warning("XML rejeitado: encoding inválido")
-                return None
+            # Parse seguro com lxml (parser por chamada: parsers lxml não são thread-safe)
+            parser = etree.XMLParser(**_OPCOES_PARSER_XML)
+            root = etree.fromstring(xml_content, parser)
             
-            # Parse seguro com defusedxml
-            root = ET.fromstring(xml_string)
+            # NF-e não usa DTD: documentos com DOCTYPE são rejeitados
+            if root.getroottree().docinfo.doctype:
+                logger.warning("XML rejeitado: declaração DOCTYPE não permitida")
+                return None
             
             # Validar estrutura básica
             if not XMLSecurityValidator._validate_xml_structure(root):
@@ -72,7 +115,7 @@ class XMLSecurityValidator:
             logger.info("XML processado com segurança")
             return root
             
-        except ParseError as e:
+        except etree.XMLSyntaxError as e:
             logger.error(f"Erro de parsing XML: {e}")
             return None
         except Exception as e:
@@ -80,7 +123,40 @@ class XMLSecurityValidator:
             return None
     
     @staticmethod
-    def _validate_xml_structure(root: Element) -> bool:
+    def iterparse_safely(xml_content: bytes, tags: Optional[List[str]] = None) -> Optional[Iterator[Tuple[str, etree._Element]]]:
+        """
+        Leitura incremental segura (lxml.iterparse, eventos 'start' e 'end')
+        
+        Mesmas proteções de parse_xml_safely, sem montar a árvore antes da leitura.
+        Erros de sintaxe e DOCTYPE surgem durante a iteração (XMLSyntaxError / ValueError).
+        
+        Args:
+            xml_content: Conteúdo do XML em bytes
+            tags: Se informado, só gera eventos dessas tags (filtro feito no libxml2)
+        
+        Returns:
+            Iterador de (evento, elemento) ou None se o conteúdo for rejeitado
+        """
+        if not XMLSecurityValidator._validate_xml_bytes(xml_content):
+            return None
+        
+        contexto = etree.iterparse(io.BytesIO(xml_content), events=('start', 'end'), tag=tags, **_OPCOES_PARSER_XML)
+        return XMLSecurityValidator._eventos_sem_doctype(contexto)
+    
+    @staticmethod
+    def _eventos_sem_doctype(contexto) -> Iterator[Tuple[str, etree._Element]]:
+        """Repassa os eventos do iterparse, rejeitando documentos com DOCTYPE"""
+        primeiro = True
+        for evento, elemento in contexto:
+            if primeiro:
+                primeiro = False
+                # NF-e não usa DTD: documentos com DOCTYPE são rejeitados (como no parse_xml_safely)
+                if elemento.getroottree().docinfo.doctype:
+                    raise ValueError("XML rejeitado: declaração DOCTYPE não permitida")
+            yield evento, elemento
+    
+    @staticmethod
+    def _validate_xml_structure(root: etree._Element) -> bool:
         """Valida a estrutura básica do XML da NF-e"""
         # Verificar se é um XML de NF-e válido (considerando namespace)
         valid_tags = ['nfeProc', 'NFe']
@@ -91,12 +167,7 @@ class XMLSecurityValidator:
             return False
         
         # Verificar presença de elementos obrigatórios
-        ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-        inf_nfe = root.find('.//nfe:infNFe', ns)
-        if inf_nfe is None:
-            inf_nfe = root.find('.//infNFe')
-        
-        if inf_nfe is None:
+        if not _XP_TEM_INF_NFE(root):
             logger.warning("XML rejeitado: elemento infNFe não encontrado")
             return False
         
@@ -115,13 +186,13 @@ class DataSanitizer:
         value = value[:max_length]
         
         # Remover caracteres de controle
-        value = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', value)
+        value = _RE_CONTROLE.sub('', value)
         
         # Sanitizar HTML/XML
         value = bleach.clean(value, tags=[], strip=True)
         
         # Normalizar espaços
-        value = re.sub(r'\s+', ' ', value).strip()
+        value = _RE_ESPACOS.sub(' ', value).strip()
         
         return value
     
@@ -132,7 +203,7 @@ class DataSanitizer:
             return None
         
         # Remover caracteres não numéricos
-        cnpj_clean = re.sub(r'[^\d]', '', cnpj)
+        cnpj_clean = somente_digitos(cnpj)
         
         # Validar formato
         if len(cnpj_clean) != 14:
@@ -149,7 +220,7 @@ class DataSanitizer:
             return None
         
         # Remover caracteres não numéricos e prefixos
-        chave_clean = re.sub(r'[^\d]', '', chave.replace('NFe', ''))
+        chave_clean = somente_digitos(chave.replace('NFe', ''))
         
         # Validar formato
         if len(chave_clean) != 44:
@@ -166,11 +237,12 @@ class DataSanitizer:
         
         try:
             if isinstance(value, str):
-                # Remover caracteres não numéricos exceto ponto e vírgula
-                value_clean = re.sub(r'[^\d.,\-]', '', value)
-                # Substituir vírgula por ponto
-                value_clean = value_clean.replace(',', '.')
-                return float(value_clean)
+                # Remover caracteres não numéricos exceto ponto e vírgula, trocando vírgula por ponto
+                # (ASCII: um único str.translate; regex só para entrada não-ASCII)
+                if value.isascii():
+                    return float(value.translate(_VALOR_NUMERICO_ASCII))
+                value_clean = _RE_NAO_NUMERICO.sub('', value)
+                return float(value_clean.replace(',', '.'))
             return float(value)
         except (ValueError, TypeError):
             logger.warning(f"Valor numérico inválido: {value}")
@@ -0,0 +1,202 @@
+"""
+Testes do parser de respostas FETCH e da listagem de anexos pelo BODYSTRUCTURE (imap_utils)
+
+As respostas seguem o formato devolvido por imaplib.IMAP4.uid('FETCH', ...):
+linhas em bytes e, para literais "{N}", tuplas (linha até o literal, conteúdo do literal).
+
+Executar com: python -m unittest discover -s tests -t .
+"""
+
+import unittest
+
+from imap_utils import fetch_em_lotes, listar_anexos, parse_fetch
+
+# Envelope mínimo (10 campos) de uma mensagem anexada
+_ENVELOPE = b'("Mon, 1 Jan 2024 10:00:00 +0000" "Encaminhada" NIL NIL NIL NIL NIL NIL NIL "<id@exemplo>")'
+
+_TEXTO = b'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 120 3 NIL NIL NIL NIL)'
+_XML_ANEXO = (
+    b'("application" "xml" ("name" "nota.xml") NIL NIL "base64" 2048 NIL '
+    b'("attachment" ("filename" "nota.xml")) NIL NIL)'
+)
+
+
+def _estrutura(resposta):
+    """BODYSTRUCTURE da única mensagem (UID 1) de uma resposta FETCH"""
+    return parse_fetch(resposta)[b'1']['BODYSTRUCTURE']
+
+
+class TestParseFetch(unittest.TestCase):
+
+    def test_varias_mensagens_e_fetch_parcial(self):
+        resposta = [
+            (b'1 (UID 10 FLAGS (\\Seen) BODY[HEADER.FIELDS (SUBJECT)] {15}', b'Subject: NF 1\r\n'),
+            b')',
+            b'2 (UID 11 FLAGS ())',
+            b'2 (UID 11 RFC822.SIZE 512)',
+        ]
+        mensagens = parse_fetch(resposta)
+
+        self.assertEqual(set(mensagens), {b'10', b'11'})
+        self.assertEqual(mensagens[b'10']['FLAGS'], [b'\\Seen'])
+        self.assertEqual(mensagens[b'10']['BODY[HEADER.FIELDS (SUBJECT)]'], b'Subject: NF 1\r\n')
+        # FETCHs parciais da mesma mensagem são combinados
+        self.assertEqual(mensagens[b'11'], {'UID': b'11', 'FLAGS': [], 'RFC822.SIZE': b'512'})
+
+    def test_string_com_escape(self):
+        resposta = [b'1 (UID 1 BODYSTRUCTURE ("application" "pdf" ("name" "a \\"b\\".pdf") NIL NIL "base64" 10 NIL '
+                    b'("attachment" NIL) NIL NIL))']
+        self.assertEqual(listar_anexos(_estrutura(resposta))[0]['filename'], 'a "b".pdf')
+
+
+class TestListarAnexos(unittest.TestCase):
+
+    def test_multipart(self):
+        resposta = [b'1 (UID 1 BODYSTRUCTURE (' + _TEXTO + _XML_ANEXO + b' "mixed" ("boundary" "b1") NIL NIL NIL))']
+        self.assertEqual(
+            listar_anexos(_estrutura(resposta)),
+            [{'filename': 'nota.xml', 'secao': '2', 'encoding': 'base64'}]
+        )
+
+    def test_parte_unica(self):
+        resposta = [b'1 (UID 1 BODYSTRUCTURE ' + _XML_ANEXO + b')']
+        self.assertEqual(
+            listar_anexos(_estrutura(resposta)),
+            [{'filename': 'nota.xml', 'secao': '1', 'encoding': 'base64'}]
+        )
+
+    def test_disposicao_nil_com_idioma(self):
+        # Sem Content-Disposition, mas com Content-Language: não é anexo
+        resposta = [
+            b'1 (UID 1 BODYSTRUCTURE (("text" "plain" ("name" "corpo.txt") NIL NIL "7bit" 10 1 NIL NIL ("pt") NIL)'
+            b'("application" "pdf" ("name" "inline.pdf") NIL NIL "base64" 100 NIL NIL ("en") NIL)'
+            b' "mixed" ("boundary" "b1") NIL NIL NIL))'
+        ]
+        self.assertEqual(listar_anexos(_estrutura(resposta)), [])
+
+    def test_disposicao_de_texto_apos_linhas(self):
+        # Em text/* a disposição vem depois do campo de linhas e do md5
+        resposta = [
+            b'1 (UID 1 BODYSTRUCTURE ("text" "csv" ("charset" "utf-8") NIL NIL "quoted-printable" 300 12 NIL '
+            b'("attachment" ("filename" "notas.csv")) NIL NIL))'
+        ]
+        self.assertEqual(
+            listar_anexos(_estrutura(resposta)),
+            [{'filename': 'notas.csv', 'secao': '1', 'encoding': 'quoted-printable'}]
+        )
+
+    def test_rfc822_aninhada(self):
+        interna = b'(' + _TEXTO + _XML_ANEXO + b' "mixed" ("boundary" "b2") NIL NIL NIL)'
+        encaminhada = (
+            b'("message" "rfc822" NIL NIL NIL "7bit" 5000 ' + _ENVELOPE + b' ' + interna +
+            b' 80 NIL ("attachment" ("filename" "encaminhada.eml")) NIL NIL)'
+        )
+        resposta = [b'1 (UID 1 BODYSTRUCTURE (' + _TEXTO + encaminhada + b' "mixed" ("boundary" "b1") NIL NIL NIL))']
+        self.assertEqual(
+            listar_anexos(_estrutura(resposta)),
+            [
+                {'filename': 'encaminhada.eml', 'secao': '2', 'encoding': '7bit'},
+                {'filename': 'nota.xml', 'secao': '2.2', 'encoding': 'base64'},
+            ]
+        )
+
+    def test_rfc822_com_corpo_simples(self):
+        # Corpo não-multipart da mensagem anexada é a parte "<secao>.1"
+        encaminhada = (
+            b'("message" "rfc822" NIL NIL NIL "7bit" 3000 ' + _ENVELOPE + b' ' + _XML_ANEXO +
+            b' 40 NIL NIL NIL NIL)'
+        )
+        resposta = [b'1 (UID 1 BODYSTRUCTURE (' + _TEXTO + encaminhada + b' "mixed" ("boundary" "b1") NIL NIL NIL))']
+        self.assertEqual(
+            listar_anexos(_estrutura(resposta)),
+            [{'filename': 'nota.xml', 'secao': '2.1', 'encoding': 'base64'}]
+        )
+
+    def test_nome_em_literal(self):
+        resposta = [
+            (b'1 (UID 1 BODYSTRUCTURE ("application" "pdf" NIL NIL NIL "base64" 10 NIL ("attachment" ("filename" {10}',
+             b'nota 1.pdf'),
+            b')) NIL NIL))',
+        ]
+        self.assertEqual(
+            listar_anexos(_estrutura(resposta)),
+            [{'filename': 'nota 1.pdf', 'secao': '1', 'encoding': 'base64'}]
+        )
+
+    def test_nome_rfc2231(self):
+        resposta = [
+            b'1 (UID 1 BODYSTRUCTURE ("application" "xml" NIL NIL NIL "base64" 10 NIL '
+            b'("attachment" ("filename*" "utf-8\'\'nota%C3%A7%C3%A3o.xml")) NIL NIL))'
+        ]
+        self.assertEqual(listar_anexos(_estrutura(resposta))[0]['filename'], 'notação.xml')
+
+    def test_nome_rfc2231_em_segmentos(self):
+        resposta = [
+            b'1 (UID 1 BODYSTRUCTURE ("application" "pdf" NIL NIL NIL "base64" 10 NIL ("attachment" '
+            b'("filename*0*" "iso-8859-1\'pt\'rela%E7%E3o" "filename*1" "_de_notas" "filename*2*" ".pdf")) NIL NIL))'
+        ]
+        self.assertEqual(listar_anexos(_estrutura(resposta))[0]['filename'], 'relação_de_notas.pdf')
+
+    def test_nome_rfc2047_no_parametro_name(self):
+        # Sem filename na disposição: vale o parâmetro name do Content-Type
+        resposta = [
+            b'1 (UID 1 BODYSTRUCTURE ("application" "pdf" ("name" "=?utf-8?B?cmVsYXTDs3Jpby5wZGY=?=") NIL NIL '
+            b'"base64" 10 NIL ("attachment" NIL) NIL NIL))'
+        ]
+        self.assertEqual(listar_anexos(_estrutura(resposta))[0]['filename'], 'relatório.pdf')
+
+    def test_sem_extensoes(self):
+        # Servidores podem omitir os campos de extensão: sem disposição, sem anexo
+        resposta = [b'1 (UID 1 BODYSTRUCTURE ("application" "pdf" ("name" "a.pdf") NIL NIL "base64" 10))']
+        self.assertEqual(listar_anexos(_estrutura(resposta)), [])
+
+
+
+class _ConexaoFalsa:
+    """Conexão IMAP mínima: responde ao UID FETCH com FLAGS vazias para cada UID"""
+
+    def __init__(self):
+        self.comandos = 0
+        self.encerrada = False
+
+    def uid(self, comando, uids, itens):
+        self.comandos += 1
+        return 'OK', [b'%d (UID %s FLAGS ())' % (i, uid) for i, uid in enumerate(uids.split(b','), start=1)]
+
+    def logout(self):
+        self.encerrada = True
+
+
+class TestFetchEmLotes(unittest.TestCase):
+
+    def setUp(self):
+        self.extras = []
+        self.principal = _ConexaoFalsa()
+
+    def _conectar(self):
+        conexao = _ConexaoFalsa()
+        self.extras.append(conexao)
+        return conexao
+
+    def _uids(self, quantidade):
+        return [str(i).encode() for i in range(quantidade)]
+
+    def test_poucos_lotes_usam_so_a_conexao_principal(self):
+        mensagens = fetch_em_lotes(self._conectar, self._uids(120), '(FLAGS)', tamanho_lote=50,
+                                   principal=self.principal, lotes_por_conexao=4)
+        self.assertEqual(len(mensagens), 120)
+        self.assertEqual(self.extras, [])
+        self.assertEqual(self.principal.comandos, 3)
+        self.assertFalse(self.principal.encerrada)
+
+    def test_muitos_lotes_abrem_apenas_as_conexoes_necessarias(self):
+        mensagens = fetch_em_lotes(self._conectar, self._uids(500), '(FLAGS)', tamanho_lote=50, max_conexoes=4,
+                                   principal=self.principal, lotes_por_conexao=4)
+        self.assertEqual(len(mensagens), 500)
+        # 10 lotes / 4 por conexão = 3 conexões: a principal e duas extras, encerradas ao final
+        self.assertEqual(len(self.extras), 2)
+        self.assertTrue(all(conexao.encerrada for conexao in self.extras))
+        self.assertFalse(self.principal.encerrada)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,6 +21,9 @@ load_dotenv()
 class UserManager:
     """Gerenciador de usuários e autenticação"""
     
+    # Senhas maiores são recusadas antes do hash (o PBKDF2 processaria a senha inteira)
+    MAX_PASSWORD_LENGTH = 128
+    
     def __init__(self):
         self.database_url = os.getenv('DATABASE_URL', 'sqlite:///notas_fiscais.db')
         self.engine = create_engine(self.database_url)
@@ -96,6 +99,9 @@ class UserManager:
         if len(password) < 8:
             return False, "A senha deve ter pelo menos 8 caracteres"
         
+        if len(password) > self.MAX_PASSWORD_LENGTH:
+            return False, f"A senha deve ter no máximo {self.MAX_PASSWORD_LENGTH} caracteres"
+        
         if not re.search(r'[A-Z]', password):
             return False, "A senha deve conter pelo menos uma letra maiúscula"
         